@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+import os  # for the database path
+import time
+import json  # for the detail column
+import queue  # for the writer thread
+import threading
+import sqlite3
+
+#
+# Audit Handler
+#
+# Description:
+#  keep a record of every access decision in a database, separate from the log
+#  allowed, denied and lockout events go in one indexed table, so they can be searched by time, user and outcome
+#  (see auditQuery.py for searching)
+#  records are only ever added, never changed
+#  writes are done by a thread, so an access decision never waits for the sd card
+#
+# Table - events:
+#  time - real - unix time of the event
+#  outcome - text - allowed|denied|lockout
+#  reason - text - what decided it - token|lockout for allowed/denied, bruteforce|overspeed|ended for lockout
+#  user - text - user name from allowedTokens, if known
+#  tokenType - text - card|code, if known
+#  token - text - token value, if known and not redacted
+#  detail - text - anything else, as json
+#
+# Variables:
+#  __path - str - path to the database file, False if auditing is off
+#  __params - dict
+#   path - str - database file, relative to root unless it starts with /
+#   queueSize - int - events that can be waiting for the writer thread before new events are dropped
+#   batchTime - float - seconds the writer waits to gather more events before committing
+#   redact - list - columns (user, token) that should not be stored
+#    if it's not set, the logging redact keys and token - raw tokens and codes are only stored if settings say so
+#  __queue - queue.Queue - events waiting for the writer thread, False if not running
+#  __writerThread - threading.Thread - the writer thread
+#  dropped - int - events dropped because the queue was full
+#
+# Functions:
+#
+#  __init__(systemHandler, settings, logger)
+#   get settings, open the database, make the table and indexes, start the writer
+#
+#  record(outcome, reason, [user], [tokenType], [token], [detail])
+#   add an event - returns straight away
+#
+#  __openDatabase(path)
+#   connect, make the table and indexes if they're not there
+#
+#  __writerThreadFunc(eventQueue)
+#   write events in batches, one commit per batch
+#
+#  queueDepth()
+#   events waiting for the writer thread, for status
+#
+#  cleanup([timeout])
+#   write anything that's waiting, and close the database - waits for up to timeout seconds
+#
+
+
+class auditHandler:
+    __path = False
+    __params = {
+        "path": "log/audit.db",
+        "queueSize": 1000,
+        "batchTime": 0.5,
+        "redact": None
+    }
+    __queue = False
+    __writerThread = None
+    dropped = 0
+
+    def __init__(self, systemHandler, settings, logger):
+        # internalise the stuff
+        self.__systemHandler = systemHandler
+        del systemHandler
+        self.__settings = settings
+        del settings
+        self.__logger = logger
+        del logger
+
+        # get settings - they've been checked already, None if not set
+        auditConfig = self.__settings.config.audit
+        if auditConfig is False:
+            self.__logger.log("INFO", "audit: turned off in settings")
+            return
+        params = dict(auditHandler.__params)
+        # settings paths are already absolute, the default isn't
+        params["path"] = self.__settings.config.root + params["path"]
+        for param in params:
+            if getattr(auditConfig, param) is not None:
+                params[param] = getattr(auditConfig, param)
+        # not set - don't keep what the log hides, or tokens and codes, in a file that's kept forever
+        if params["redact"] is None:
+            params["redact"] = (self.__settings.config.logging.redact or frozenset()) | {"token"}
+        self.__params = params
+        path = params["path"]
+
+        # open it here, so any problems show up at startup
+        try:
+            db = self.__openDatabase(path)
+            db.close()
+        except (sqlite3.Error, OSError) as e:
+            self.__logger.log("WARN", "audit: unable to open database - access decisions will only be in the log", {"path": path, "error": e})
+            return
+        self.__path = path
+        self.__logger.log("DBUG", "audit: database ready", {"path": path})
+
+        # start writing
+        self.__queue = queue.Queue(maxsize=self.__params["queueSize"])
+        self.__writerThread = threading.Thread(name='auditWriterThread', target=self.__writerThreadFunc, args=(self.__queue,), daemon=True)
+        self.__writerThread.start()
+        return
+
+    def __openDatabase(self, path):
+        # make the directory if it's not there
+        dirName = os.path.dirname(path)
+        if dirName and not os.path.isdir(dirName):
+            os.makedirs(dirName)
+        db = sqlite3.connect(path, timeout=5)
+        # wal, so auditQuery can read while we write
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS events (time REAL NOT NULL, outcome TEXT NOT NULL, reason TEXT, user TEXT, tokenType TEXT, token TEXT, detail TEXT)")
+        db.execute("CREATE INDEX IF NOT EXISTS eventsTime ON events (time)")
+        db.execute("CREATE INDEX IF NOT EXISTS eventsUserTime ON events (user, time)")
+        db.execute("CREATE INDEX IF NOT EXISTS eventsOutcomeTime ON events (outcome, time)")
+        db.commit()
+        return db
+
+    #
+    # add an event
+    # this is called from access decisions, so it mustn't wait for anything
+    #
+    def record(self, outcome, reason, user=None, tokenType=None, token=None, detail=None):
+        eventQueue = self.__queue
+        if eventQueue is False:
+            return
+        if "user" in self.__params["redact"]:
+            user = None
+        if "token" in self.__params["redact"]:
+            token = None
+        if detail is not None:
+            detail = json.dumps(detail, default=str)
+        try:
+            eventQueue.put_nowait((time.time(), outcome, reason, user, tokenType, token, detail))
+        except queue.Full:
+            self.dropped += 1
+        return
+
+    def __writerThreadFunc(self, eventQueue):
+        db = None
+        running = True
+        while running:
+            # wait for something
+            item = eventQueue.get()
+            batch = []
+            # give it a moment, anything else that comes in goes in the same commit
+            deadline = time.monotonic() + self.__params["batchTime"]
+            while item is not None:
+                batch.append(item)
+                timeLeft = deadline - time.monotonic()
+                try:
+                    if timeLeft > 0:
+                        item = eventQueue.get(timeout=timeLeft)
+                    else:
+                        item = eventQueue.get_nowait()
+                except queue.Empty:
+                    break
+            # None means stop
+            if item is None:
+                running = False
+
+            # write
+            if batch:
+                try:
+                    if db is None:
+                        db = self.__openDatabase(self.__path)
+                    with db:
+                        db.executemany("INSERT INTO events (time, outcome, reason, user, tokenType, token, detail) VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+                except (sqlite3.Error, OSError) as e:
+                    self.dropped += len(batch)
+                    self.__logger.log("WARN", "audit: unable to write to database", {"events": len(batch), "error": e})
+                    # try opening it again next time
+                    if db is not None:
+                        try:
+                            db.close()
+                        except sqlite3.Error:
+                            pass
+                    db = None
+
+        # done
+        if db is not None:
+            db.close()
+        return
+
+    def queueDepth(self):
+        eventQueue = self.__queue
+        if eventQueue is False:
+            return 0
+        return eventQueue.qsize()
+
+    #
+    # write out anything that's waiting
+    #
+    def cleanup(self, timeout=5):
+        if self.__writerThread is None:
+            return
+        deadline = time.monotonic() + timeout
+        eventQueue = self.__queue
+        self.__queue = False
+        try:
+            eventQueue.put(None, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+        self.__writerThread.join(timeout=max(deadline - time.monotonic(), 0))
+        if self.__writerThread.is_alive():
+            self.__logger.log("WARN", "audit: not everything was written in time", {"waiting": eventQueue.qsize()})
+        self.__writerThread = None
+        if self.dropped > 0:
+            self.__logger.log("WARN", "audit: events were dropped", {"dropped": self.dropped})
+        return
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import os  # for finding settings.json
+import sys
+import json  # for settings and json output
+import time
+import datetime
+import argparse
+import sqlite3
+
+#
+# Audit Query
+#
+# Description:
+#  search the audit database made by auditHandler
+#  run from the project root, eg.
+#   python3 auditQuery.py --from "2024-03-12 08:00" --to "2024-03-12 09:00" --outcome allowed
+#   python3 auditQuery.py --user Me --from 2024-03-01 --json
+#  times are local time, and can be a date, a date and time, or a unix time
+#  the database is opened read only, so it can be used while DIYAC is running
+#
+# Functions:
+#
+#  __parseTime(value)
+#   turn a command line time into unix time
+#
+#  __defaultPath()
+#   the database path from settings.json, or the default
+#
+#  query(path, [start], [end], [user], [outcome], [limit])
+#   returns a list of matching events as dicts, oldest first
+#
+#  main()
+#   parse arguments, query, print
+#
+
+
+def __parseTime(value):
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for timeFormat in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d"]:
+        try:
+            return time.mktime(time.strptime(value, timeFormat))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("unrecognised time: " + value)
+
+
+def __defaultPath():
+    root = os.path.dirname(os.path.realpath(__file__)) + "/"
+    path = "log/audit.db"
+    try:
+        with open(root + "settings.json", "r") as f:
+            allSettings = json.load(f)
+        root = allSettings.get("root", root)
+        path = allSettings["audit"]["path"]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    if path[0] != "/":
+        path = root + path
+    return path
+
+
+def query(path, start=None, end=None, user=None, outcome=None, limit=None):
+    # read only, and don't make a new file if it's not there
+    db = sqlite3.connect("file:" + path + "?mode=ro", uri=True)
+    db.row_factory = sqlite3.Row
+
+    # build the query - every filter is on an indexed column
+    where = []
+    args = []
+    if start is not None:
+        where.append("time >= ?")
+        args.append(start)
+    if end is not None:
+        where.append("time < ?")
+        args.append(end)
+    if user is not None:
+        where.append("user = ?")
+        args.append(user)
+    if outcome is not None:
+        where.append("outcome = ?")
+        args.append(outcome)
+    sql = "SELECT time, outcome, reason, user, tokenType, token, detail FROM events"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY time"
+    if limit is not None:
+        sql += " LIMIT ?"
+        args.append(limit)
+
+    try:
+        events = [dict(row) for row in db.execute(sql, args)]
+    finally:
+        db.close()
+    for event in events:
+        if event["detail"] is not None:
+            event["detail"] = json.loads(event["detail"])
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the DIYAC audit database")
+    parser.add_argument("--from", dest="start", type=__parseTime, help="start time (local), inclusive")
+    parser.add_argument("--to", dest="end", type=__parseTime, help="end time (local), exclusive")
+    parser.add_argument("--user", help="user name")
+    parser.add_argument("--outcome", choices=["allowed", "denied", "lockout"])
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--db", help="database path - default from settings.json")
+    parser.add_argument("--json", action="store_true", help="one json object per line")
+    args = parser.parse_args()
+
+    path = args.db or __defaultPath()
+    if not os.path.exists(path):
+        sys.stderr.write("audit database not found: " + path + "\n")
+        return 1
+
+    queryStart = time.perf_counter()
+    events = query(path, args.start, args.end, args.user, args.outcome, args.limit)
+    queryTime = time.perf_counter() - queryStart
+
+    for event in events:
+        if args.json:
+            sys.stdout.write(json.dumps(event) + "\n")
+            continue
+        line = datetime.datetime.fromtimestamp(event["time"]).strftime("%Y-%m-%d %H:%M:%S") + " " + event["outcome"].upper() + " (" + str(event["reason"]) + ")"
+        for key in ["user", "tokenType", "token"]:
+            if event[key] is not None:
+                line += " " + key + "=" + str(event[key])
+        if event["detail"] is not None:
+            line += " " + json.dumps(event["detail"])
+        sys.stdout.write(line + "\n")
+    sys.stderr.write(str(len(events)) + " events in " + str(round(queryTime * 1000, 2)) + "ms\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
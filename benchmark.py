@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+import time
+import os
+import sys
+import tempfile
+import threading
+import json  # for results files
+import argparse
+import platform
+import subprocess  # for the git commit
+
+#
+# Benchmarks
+#
+# Description:
+#  time the hot paths, without any hardware
+#  run from the project root: python3 benchmark.py
+#  results can be saved as json, and compared with a saved run to catch slow downs between commits, eg.
+#   python3 benchmark.py --json before.json
+#   (change things)
+#   python3 benchmark.py --json after.json --compare before.json
+#  a benchmark has regressed if its median (p50us) is more than --threshold percent slower - the exit code is 1 if any have
+#
+# Variables:
+#  __tokenSizes - list - numbers of allowed tokens to time the token functions with
+#  __threshold - float - default percent slower that counts as a regression
+#
+# Functions:
+#
+#  __timeCalls(func, count)
+#   call func count times, timing each call
+#   returns calls per second and latency percentiles in microseconds
+#
+#  __makeLogger(loggingSettings, [runMode])
+#   a logger with the given logging settings, in daemon mode (no display) unless told otherwise
+#   the settings are checked by settingsHandler, like they would be from settings.json
+#
+#  benchLoggerFile()
+#   logger.log with the file output on, like an access decision
+#
+#  benchLoggerRedact()
+#   logger.log to display and file, with redaction on - like an access decision with a debug display
+#
+#  benchLoggerDisabled()
+#   logger.log("DBUG", ...) when no output is logging DBUG, only the flight recorder - the cost of a debug line in production
+#
+#  benchLoggerStorm()
+#   the same WARN over and over to the file, like a miswired wiegand line - nearly all should be rate limited
+#   also gives the number of lines that actually got to the file
+#
+#  benchLoggerSyslog()
+#   logger.log with only syslog on
+#
+#  benchLoggerJournal()
+#   logger.log with only the journal on - goes to syslog instead if there's no journal socket
+#
+#  benchLoggerDisplay()
+#   logger.log with only the display on, to /dev/null
+#
+#  __makeTokens(size)
+#   a tokenHandler with size allowed card tokens, and the code 1234
+#   returns the tokenHandler and a function to remove the tokens file
+#
+#  benchTokenCheck(size)
+#   tokenHandler.checkToken with size tokens, for the last card token in the file
+#
+#  benchTokenLoad(size)
+#   tokenHandler.getAllowedTokens with size tokens - what a reload costs
+#   timed for about a second, as it's slow with lots of tokens
+#
+#  __makeInputHandler()
+#   an inputHandler without pigpiod, pins or the wiegand decoder
+#   the door is a null output, so nothing opens
+#
+#  benchWiegandToHex()
+#   inputHandler.__wiegandToHex for a 34 bit read
+#
+#  benchNumpadInput()
+#   inputHandler.__newNumpadInput for each key of "#1234#" in turn, so every sixth key is an access decision
+#
+#  benchCallbackGeneral()
+#   main.__callbackGeneral for an input change, with DBUG going nowhere - run for every gpio change
+#
+#  benchControlSocket()
+#   load test of the control socket - clients all asking for stats at once, each on its own connection
+#   gives requests per second across all clients, and latency percentiles per request
+#
+#  __gitCommit()
+#   the commit being benchmarked, None if it can't be found
+#
+#  runAll()
+#   run every benchmark, returns the results
+#
+#  compare(results, baseline, threshold)
+#   each benchmark's p50us against the baseline, returns the ones that are more than threshold percent slower
+#
+#  main()
+#   parse arguments, run, save, compare
+#
+
+__tokenSizes = [10, 100, 1000, 5000]
+__threshold = 25
+
+
+def __timeCalls(func, count):
+    latencies = []
+    startTime = time.perf_counter()
+    for i in range(count):
+        callStart = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - callStart)
+    totalTime = time.perf_counter() - startTime
+    latencies.sort()
+    return {
+        "calls": count,
+        "callsPerSecond": round(count / totalTime),
+        "p50us": round(latencies[int(count * 0.5)] * 1000000, 2),
+        "p99us": round(latencies[int(count * 0.99)] * 1000000, 2),
+        "maxus": round(latencies[-1] * 1000000, 2)
+    }
+
+
+def __makeLogger(loggingSettings, runMode="daemon"):
+    import logging  # our own logging module
+    import settingsHandler
+    settings = settingsHandler.settingsHandler(False, allSettings={"root": tempfile.gettempdir() + "/", "logging": loggingSettings})
+    return logging.logger(settings, runMode=runMode)
+
+
+def benchLoggerFile():
+    logDir = tempfile.mkdtemp(prefix="diyacBench")
+    logFile = os.path.join(logDir, "logFile")
+    # every call is the same message, so rate limiting is off to time the real thing
+    l = __makeLogger({"rateLimit": False, "syslog": {"level": "NONE"}, "file": {"level": "INFO", "path": logFile}})
+    results = __timeCalls(lambda: l.log("INFO", "ACCESS ALLOWED BY TOKEN", {"token": "a1eeb099", "type": "card", "user": "Me"}), 20000)
+    # the time to get it all onto disk as well
+    drainStart = time.perf_counter()
+    try:
+        l.cleanup()
+    except AttributeError:
+        # older loggers write as they go
+        pass
+    results["drainms"] = round((time.perf_counter() - drainStart) * 1000, 2)
+    os.remove(logFile)
+    os.rmdir(logDir)
+    return results
+
+
+def benchLoggerRedact():
+    logDir = tempfile.mkdtemp(prefix="diyacBench")
+    logFile = os.path.join(logDir, "logFile")
+    # display output goes nowhere
+    sys.stdout = open(os.devnull, "w")
+    l = __makeLogger({"rateLimit": False, "redact": ["token"], "syslog": {"level": "NONE"}, "display": {"level": "INFO"}, "file": {"level": "INFO", "path": logFile, "redact": ["user"]}}, runMode="normal")
+    try:
+        results = __timeCalls(lambda: l.log("INFO", "ACCESS ALLOWED BY TOKEN", {"token": "a1eeb099", "type": "card", "user": "Me"}), 20000)
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+    try:
+        l.cleanup()
+    except AttributeError:
+        pass
+    os.remove(logFile)
+    os.rmdir(logDir)
+    return results
+
+
+def benchLoggerDisabled():
+    l = __makeLogger({"syslog": {"level": "NOTE"}, "file": {"level": "NONE"}})
+    return __timeCalls(lambda: l.log("DBUG", "GPI Change", {"gpio": 26, "level": 0, "name": "doorbellButton"}), 200000)
+
+
+def benchLoggerStorm():
+    logDir = tempfile.mkdtemp(prefix="diyacBench")
+    logFile = os.path.join(logDir, "logFile")
+    l = __makeLogger({"syslog": {"level": "NONE"}, "file": {"level": "INFO", "path": logFile}})
+    results = __timeCalls(lambda: l.log("WARN", "New read - unexpected amount of bits", {"bits": 3, "code": 5}), 100000)
+    try:
+        l.flushSuppressed()
+        l.cleanup()
+    except AttributeError:
+        pass
+    with open(logFile, "r") as f:
+        results["linesWritten"] = sum(1 for line in f)
+    os.remove(logFile)
+    os.rmdir(logDir)
+    return results
+
+
+def benchLoggerSyslog():
+    l = __makeLogger({"rateLimit": False, "syslog": {"level": "INFO"}})
+    return __timeCalls(lambda: l.log("INFO", "ACCESS ALLOWED BY TOKEN", {"token": "a1eeb099", "type": "card", "user": "Me"}), 20000)
+
+
+def benchLoggerJournal():
+    l = __makeLogger({"rateLimit": False, "syslog": {"level": "NONE"}, "journal": {"level": "INFO"}})
+    return __timeCalls(lambda: l.log("INFO", "ACCESS ALLOWED BY TOKEN", {"token": "a1eeb099", "type": "card", "user": "Me"}), 20000)
+
+
+def benchLoggerDisplay():
+    sys.stdout = open(os.devnull, "w")
+    try:
+        l = __makeLogger({"rateLimit": False, "syslog": {"level": "NONE"}, "display": {"level": "INFO"}}, runMode="normal")
+        results = __timeCalls(lambda: l.log("INFO", "ACCESS ALLOWED BY TOKEN", {"token": "a1eeb099", "type": "card", "user": "Me"}), 20000)
+    finally:
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+    return results
+
+
+def __makeTokens(size):
+    import tokenHandler
+    import settingsHandler
+    tokenDir = tempfile.mkdtemp(prefix="diyacBench")
+    tokenFile = os.path.join(tokenDir, "allowedTokens.json")
+    allowedTokens = [{"token": format(i, "08x"), "type": "card", "user": "user" + str(i)} for i in range(size)]
+    allowedTokens.append({"token": "1234", "type": "code", "user": "Me"})
+    with open(tokenFile, "w") as f:
+        json.dump(allowedTokens, f)
+    settings = settingsHandler.settingsHandler(False, allSettings={"root": tokenDir + "/", "allowedTokens": {"path": tokenFile}})
+    tokens = tokenHandler.tokenHandler(False, settings, __makeLogger({"syslog": {"level": "NONE"}}))
+
+    def remove():
+        os.remove(tokenFile)
+        os.rmdir(tokenDir)
+    return tokens, remove
+
+
+def benchTokenCheck(size=1000):
+    tokens, remove = __makeTokens(size)
+    results = __timeCalls(lambda: tokens.checkToken(format(size - 1, "08X"), "card"), 100000)
+    remove()
+    return results
+
+
+def benchTokenLoad(size=1000):
+    tokens, remove = __makeTokens(size)
+    # a load gets slow quickly with more tokens, so about a second's worth - at least 3, at most 2000
+    callStart = time.perf_counter()
+    tokens.getAllowedTokens()
+    callTime = time.perf_counter() - callStart
+    results = __timeCalls(tokens.getAllowedTokens, max(min(2000, int(1 / callTime)), 3))
+    remove()
+    return results
+
+
+def __makeInputHandler():
+    import inputHandler
+    import auditHandler
+    import metricsHandler
+    import settingsHandler
+    # overspeed and lockout off, so a benchmark can't lock itself out
+    settings = settingsHandler.settingsHandler(False, allSettings={
+        "root": tempfile.gettempdir() + "/",
+        "inputHandling": {"overspeedThresholdTime": 0, "lockoutTime": 0},
+        "audit": False
+    })
+    l = __makeLogger({"syslog": {"level": "NONE"}})
+    # the tokens are in memory once loaded, the file isn't needed after that
+    tokens, remove = __makeTokens(100)
+    remove()
+
+    class nullOutputs:
+        def openDoor(self):
+            return True
+
+        def playPattern(self, patternId):
+            return
+
+    audit = auditHandler.auditHandler(False, settings, l)
+    metrics = metricsHandler.metricsHandler(False, settings, l)
+    return inputHandler.inputHandler(False, settings, l, tokens, nullOutputs(), False, False, audit, metrics)
+
+
+def benchWiegandToHex():
+    inH = __makeInputHandler()
+    # private, so by its mangled name
+    wiegandToHex = inH._inputHandler__wiegandToHex
+    return __timeCalls(lambda: wiegandToHex(34, 0x99b0eea1 << 1), 200000)
+
+
+def benchNumpadInput():
+    inH = __makeInputHandler()
+    newNumpadInput = inH._inputHandler__newNumpadInput
+    keys = "#1234#"
+    position = [0]
+
+    def pressKey():
+        newNumpadInput(keys[position[0]])
+        position[0] = (position[0] + 1) % len(keys)
+    return __timeCalls(pressKey, 60000)
+
+
+def benchCallbackGeneral():
+    import main
+    import pinDef
+    import metricsHandler
+    import settingsHandler
+    settings = settingsHandler.settingsHandler(False, allSettings={"root": tempfile.gettempdir() + "/", "pinDef": {"pcbVersion": 2.1}})
+    # what __init would have set up
+    main.l = __makeLogger({"syslog": {"level": "NOTE"}})
+    main.p = pinDef.pinDef(False, settings, main.l)
+    main.metrics = metricsHandler.metricsHandler(False, settings, main.l)
+    gpio = main.p.pins["doorbellButton"]
+    return __timeCalls(lambda: main.__callbackGeneral(gpio, 0, 0, "input"), 200000)
+
+
+def benchControlSocket(clients=16, requestsPerClient=500):
+    import controlHandler
+    import controlClient
+    import settingsHandler
+    sockDir = tempfile.mkdtemp(prefix="diyacBench")
+    sockPath = os.path.join(sockDir, "control.sock")
+    settings = settingsHandler.settingsHandler(False, allSettings={"root": sockDir + "/", "logging": {"syslog": {"level": "NONE"}}, "control": {"path": sockPath}})
+    l = __makeLogger({"syslog": {"level": "NONE"}})
+    control = controlHandler.controlHandler(False, settings, l)
+    # about the size of a real stats answer
+    stats = {"allowedLastMinute": 2, "deniedLastMinute": 1, "lockout": "unlocked", "decisionP95ms": 0.3, "tokens": 120, "logQueue": 0, "auditQueue": 0, "loopLag": 0.001}
+    control.addCommand("stats", lambda request: stats, "stats")
+    control.start()
+
+    latencies = []
+    latenciesLock = threading.Lock()
+    errors = []
+
+    def client():
+        clientLatencies = []
+        try:
+            conn = controlClient.connect(sockPath)
+            for i in range(requestsPerClient):
+                callStart = time.perf_counter()
+                response = controlClient.request(conn, "stats")
+                clientLatencies.append(time.perf_counter() - callStart)
+                if response["ok"] is not True:
+                    errors.append(response)
+            conn.close()
+        except OSError as e:
+            errors.append(e)
+        with latenciesLock:
+            latencies.extend(clientLatencies)
+
+    clientThreads = [threading.Thread(target=client) for i in range(clients)]
+    startTime = time.perf_counter()
+    for clientThread in clientThreads:
+        clientThread.start()
+    for clientThread in clientThreads:
+        clientThread.join()
+    totalTime = time.perf_counter() - startTime
+    control.cleanup()
+    os.rmdir(sockDir)
+
+    latencies.sort()
+    count = len(latencies)
+    return {
+        "clients": clients,
+        "requests": count,
+        "errors": len(errors),
+        "requestsPerSecond": round(count / totalTime),
+        "p50us": round(latencies[int(count * 0.5)] * 1000000, 2),
+        "p99us": round(latencies[int(count * 0.99)] * 1000000, 2),
+        "maxus": round(latencies[-1] * 1000000, 2)
+    }
+
+
+#
+# run them all
+#
+def __gitCommit():
+    try:
+        output = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.realpath(__file__)), capture_output=True, text=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    if output.returncode != 0:
+        return None
+    return output.stdout.strip()
+
+
+def runAll():
+    benches = []
+    for bench in [benchLoggerFile, benchLoggerRedact, benchLoggerDisabled, benchLoggerStorm, benchLoggerSyslog, benchLoggerJournal, benchLoggerDisplay]:
+        benches.append((bench.__name__, bench, ()))
+    for size in __tokenSizes:
+        benches.append(("benchTokenCheck-" + str(size), benchTokenCheck, (size,)))
+    for size in __tokenSizes:
+        benches.append(("benchTokenLoad-" + str(size), benchTokenLoad, (size,)))
+    for bench in [benchWiegandToHex, benchNumpadInput, benchCallbackGeneral, benchControlSocket]:
+        benches.append((bench.__name__, bench, ()))
+
+    results = {}
+    for name, bench, args in benches:
+        results[name] = bench(*args)
+        sys.stdout.write(name + " - " + format(results[name]) + "\n")
+        sys.stdout.flush()
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = {}
+    for name in results:
+        if name not in baseline or not baseline[name].get("p50us"):
+            continue
+        change = (results[name]["p50us"] - baseline[name]["p50us"]) / baseline[name]["p50us"] * 100
+        if change > threshold:
+            regressions[name] = {"p50us": results[name]["p50us"], "baselineP50us": baseline[name]["p50us"], "slowerPercent": round(change, 1)}
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the DIYAC hot paths, without any hardware")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--compare", help="results file from an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=__threshold, help="percent slower that counts as a regression - default " + str(__threshold))
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        # read it first, so a bad file doesn't waste a run
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    run = {
+        "commit": __gitCommit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": runAll()
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(run, f, indent=4)
+
+    if baseline is None:
+        return 0
+    regressions = compare(run["results"], baseline["results"], args.threshold)
+    sys.stdout.write("compared with " + str(baseline.get("commit")) + " - " + str(len(regressions)) + " regressions over " + str(args.threshold) + "%\n")
+    for name in regressions:
+        sys.stdout.write("  " + name + " - " + format(regressions[name]) + "\n")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+import os  # for finding settings.json
+import sys
+import json  # for settings, requests and responses
+import socket
+import argparse
+
+#
+# Control Client
+#
+# Description:
+#  send a command to the control socket made by controlHandler
+#  run from the project root, eg.
+#   python3 controlClient.py help
+#   python3 controlClient.py openDoor
+#   python3 controlClient.py addToken token=a1:ee:b0:99 type=card user=Me
+#   python3 controlClient.py decisions count:=10
+#  arguments are name=value for a string, or name:=value for json (numbers, true/false, lists)
+#
+# Functions:
+#
+#  __defaultPath()
+#   the socket path from settings.json, or the default
+#
+#  connect(path)
+#   connect to the control socket, returns a file to use with request
+#
+#  request(conn, command, [args])
+#   send one command, returns the response as a dict
+#
+#  main()
+#   parse arguments, send, print
+#
+
+
+def __defaultPath():
+    root = os.path.dirname(os.path.realpath(__file__)) + "/"
+    path = "/run/diyac/control.sock"
+    try:
+        with open(root + "settings.json", "r") as f:
+            allSettings = json.load(f)
+        root = allSettings.get("root", root)
+        path = allSettings["control"]["path"]
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    if path[0] != "/":
+        path = root + path
+    return path
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    conn = sock.makefile("rwb")
+    # the file keeps the socket open
+    sock.close()
+    return conn
+
+
+def request(conn, command, args=None):
+    body = dict(args or {})
+    body["command"] = command
+    conn.write((json.dumps(body) + "\n").encode())
+    conn.flush()
+    line = conn.readline()
+    if not line:
+        raise ConnectionError("control socket closed the connection")
+    return json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a command to DIYAC")
+    parser.add_argument("command", help="command to send - help lists them")
+    parser.add_argument("args", nargs="*", help="name=value (string) or name:=value (json)")
+    parser.add_argument("--socket", help="control socket path - default from settings.json")
+    args = parser.parse_args()
+
+    commandArgs = {}
+    for arg in args.args:
+        if "=" not in arg:
+            parser.error("arguments should be name=value or name:=value: " + arg)
+        name, value = arg.split("=", 1)
+        if name.endswith(":"):
+            try:
+                commandArgs[name[:-1]] = json.loads(value)
+            except ValueError:
+                parser.error("not valid json: " + arg)
+        else:
+            commandArgs[name] = value
+
+    path = args.socket or __defaultPath()
+    try:
+        conn = connect(path)
+        response = request(conn, args.command, commandArgs)
+        conn.close()
+    except OSError as e:
+        sys.stderr.write("unable to use control socket " + path + ": " + str(e) + "\n")
+        return 1
+
+    if response.get("ok") is not True:
+        sys.stderr.write("error: " + str(response.get("error")) + "\n")
+        return 1
+    sys.stdout.write(json.dumps(response["result"], indent=4) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
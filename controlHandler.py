@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+import os  # for the socket file
+import stat  # for checking an old socket file
+import json
+import threading
+import socketserver
+
+#
+# Control Handler
+#
+# Description:
+#  a local control and query socket, so operators don't have to edit files and send signals
+#  a unix socket, so only users that can get to the file can use it (owner and group)
+#  one json object per line in, one json object per line back - {"ok": true, "result": ...} or {"ok": false, "error": "..."}
+#   eg. {"command": "decisions", "count": 10}
+#  the server runs in its own thread, with a thread for each client, so it never holds up gpio callbacks
+#  the commands are added by main (addCommand), and should answer from what's already in memory
+#  see controlClient.py for a command line client
+#
+# Variables:
+#  __params - dict - False if the control socket is turned off
+#   path - str - socket file, relative to root unless it starts with /
+#   redact - list - keys whose values are not given out, anywhere in a result
+#    if it's not set, the logging redact keys and token - so recent tokens and codes aren't given out unless settings say so
+#  __commands - dict - command name: {func, description}
+#  __server - socketserver.ThreadingUnixStreamServer - False if not running
+#  __clientTimeout - float - seconds a client can be idle before it's disconnected
+#  __maxRequestSize - int - longest request line, in bytes
+#  __stats - dict - requests and errors since startup
+#
+# Functions:
+#
+#  __init__(systemHandler, settings, logger)
+#   get settings, add the help command
+#
+#  addCommand(name, func, description)
+#   func gets the request dict, and returns the result - raise ValueError for a bad request
+#
+#  start()
+#   make the socket and start the server thread - after the commands have been added
+#
+#  __handleRequest(line)
+#   decode, run the command, encode the response
+#
+#  __redact(data)
+#   copy of data with the values of the redact keys replaced, all the way down
+#
+#  getStats()
+#   requests and errors since startup
+#
+#  cleanup()
+#   stop the server and remove the socket
+#
+
+
+class controlHandler:
+    __params = {
+        "path": "/run/diyac/control.sock",
+        "redact": None
+    }
+    __server = False
+    __clientTimeout = 10
+    __maxRequestSize = 65536
+    __redactWord = "-REDACTED-"
+
+    def __init__(self, systemHandler, settings, logger):
+        # internalise the stuff
+        self.__systemHandler = systemHandler
+        del systemHandler
+        self.__settings = settings
+        del settings
+        self.__logger = logger
+        del logger
+        self.__commands = {}
+        self.__stats = {"requests": 0, "errors": 0}
+        self.__statsLock = threading.Lock()
+
+        # get settings - they've been checked already, None if not set
+        controlConfig = self.__settings.config.control
+        if controlConfig is False:
+            self.__params = False
+            self.__logger.log("INFO", "control: control socket turned off in settings")
+            return
+        params = dict(controlHandler.__params)
+        for param in params:
+            if getattr(controlConfig, param) is not None:
+                params[param] = getattr(controlConfig, param)
+        # not set - don't give out what the log hides, or tokens and codes
+        if params["redact"] is None:
+            params["redact"] = (self.__settings.config.logging.redact or frozenset()) | {"token"}
+        self.__params = params
+
+        self.addCommand("help", self.__helpCommand, "list the commands")
+        return
+
+    def addCommand(self, name, func, description):
+        self.__commands[name] = {"func": func, "description": description}
+        return
+
+    def __helpCommand(self, request):
+        commands = {}
+        for name in self.__commands:
+            commands[name] = self.__commands[name]["description"]
+        return commands
+
+    #
+    # start the server
+    #
+    def start(self):
+        if self.__params is False:
+            return
+        path = self.__params["path"]
+
+        # a socket left over from last time would stop the bind
+        try:
+            if stat.S_ISSOCK(os.lstat(path).st_mode):
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            self.__logger.log("WARN", "control: unable to remove old control socket", {"path": path, "error": e})
+
+        # the server makes a thread for each client
+        handleRequest = self.__handleRequest
+        clientTimeout = self.__clientTimeout
+        maxRequestSize = self.__maxRequestSize
+
+        class requestHandler(socketserver.StreamRequestHandler):
+            timeout = clientTimeout
+
+            def handle(self):
+                while True:
+                    try:
+                        line = self.rfile.readline(maxRequestSize)
+                    except OSError:
+                        return
+                    if not line:
+                        return
+                    try:
+                        self.wfile.write(handleRequest(line))
+                    except OSError:
+                        return
+
+        try:
+            dirName = os.path.dirname(path)
+            if dirName and not os.path.isdir(dirName):
+                os.makedirs(dirName)
+            # owner and group only - the socket is made by the bind, so the umask has to be set before it, or it's open until the chmod
+            # the umask is for the whole process, so it only takes away what "other" could have
+            oldUmask = os.umask(0o007)
+            try:
+                server = socketserver.ThreadingUnixStreamServer(path, requestHandler)
+            finally:
+                os.umask(oldUmask)
+            os.chmod(path, 0o660)
+        except OSError as e:
+            self.__logger.log("WARN", "control: unable to start control socket", {"path": path, "error": e})
+            return
+        server.daemon_threads = True
+        self.__server = server
+        serverThread = threading.Thread(name='controlServerThread', target=server.serve_forever, kwargs={"poll_interval": 0.5}, daemon=True)
+        serverThread.start()
+        self.__logger.log("INFO", "control: listening", {"path": path, "commands": list(self.__commands)})
+        return
+
+    def __handleRequest(self, line):
+        command = None
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("request should be an object")
+            command = request.get("command")
+            if command not in self.__commands:
+                raise ValueError("unknown command - try help")
+            result = self.__commands[command]["func"](request)
+            if self.__params["redact"]:
+                result = self.__redact(result)
+            response = {"ok": True, "result": result}
+        except ValueError as e:
+            response = {"ok": False, "error": str(e)}
+        except Exception as e:
+            self.__logger.log("WARN", "control: command failed", {"command": command, "error": e})
+            response = {"ok": False, "error": "command failed"}
+
+        with self.__statsLock:
+            self.__stats["requests"] += 1
+            if response["ok"] is False:
+                self.__stats["errors"] += 1
+        return (json.dumps(response, default=str) + "\n").encode()
+
+    def __redact(self, data):
+        if isinstance(data, dict):
+            out = {}
+            for key, value in data.items():
+                if key in self.__params["redact"] and value is not None:
+                    out[key] = self.__redactWord
+                else:
+                    out[key] = self.__redact(value)
+            return out
+        if isinstance(data, list):
+            return [self.__redact(value) for value in data]
+        return data
+
+    def getStats(self):
+        with self.__statsLock:
+            return dict(self.__stats)
+
+    #
+    # stop
+    #
+    def cleanup(self):
+        if self.__server is False:
+            return
+        server = self.__server
+        self.__server = False
+        server.shutdown()
+        server.server_close()
+        try:
+            os.remove(self.__params["path"])
+        except OSError:
+            pass
+        return
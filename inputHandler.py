@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import time
 import threading
+import collections  # for recent decisions
 
 #
 # Input Handler
@@ -23,12 +24,49 @@ import threading
 #  previousAttemps - list of times of last 3 attempts
 #
 # Functions:
+#  __setupInputs()
+#   pull ups, glitch filters, initial reads and the wiegand decoder
+#
+#  loadSettings()
+#   get settings, at startup and when settings are reloaded
+#
+#  reconnect(pi)
+#   use a new pigpio connection and set the inputs up again
+#
+#  stop()
+#   stop taking input, for shutdown
+#
+#  snapshotInputs()
+#   every input pin name: level, all read at once with read_bank_1 - None if it can't be read
+#
+#  reconcileInputs()
+#   take a snapshot and compare it with what the callbacks have told us, to catch any missed changes
+#   compared under __inputLock, the same as gpiCallback, and pins with a callback newer than the snapshot are skipped
+#   a missed change goes to the missed input callback, the same way a gpio callback would (tick is None)
+#   done at startup, after a reconnect, and every minute by main
+#
+#  __tickAfter(tick, than)
+#   true if pigpio tick is after than - ticks are microseconds that wrap every 72 minutes
+#
+#  setMissedInputCallback(func)
+#   func(gpio, level, tick) - main gives it __callbackInput
+#
 #  __newNumpadInput(rx)
 #   process new entry from keypad (deals with each individual key press)
 #
 #  __checkInput(rx, type)
 #   called when there is a full token to be checked
 #   take token and check if in allowedTokens list
+#   the decision goes to the audit handler as well as the log, and is counted in metrics
+#
+#  getStats()
+#   allowed and denied in the last minute, lockout state, and 95th percentile decision time - for status
+#
+#  recentDecisions([count])
+#   the last count decisions, newest last - for the control socket
+#
+#  clearLockout()
+#   end a lockout early, returns False if there wasn't one
 #
 #  __checkLockout()
 #   see if the lock is active or not, and if it should be activated
@@ -46,9 +84,14 @@ import threading
 #   called by wiegand library, process & translate input from reader
 #   includes translation from incoming int to hex string
 #
+#  __parityOk(bits, code)
+#   check the parity bits of a card read - first bit even parity for the first half, last bit odd parity for the second half
+#   only counted in metrics, the token is still checked, as some readers don't send proper parity
+#
 # gpiCallback(gpio, level, tick, gpiName)
 #  called by __callbackInput in main
 #  note that __callbackGeneral in main is ALSO called before gpiCallback
+#  a callback that's no newer than a change reconcileInputs has already handled is dropped - it was delivered late
 
 
 class inputHandler:
@@ -68,23 +111,22 @@ class inputHandler:
     __numpadLastInputTime = None
     lockout = {"state": "unlocked"}
     __previousBadAttempts = []
+    __wiegandDecoder = None
+    __stopped = False
+    __inputLevels = None
+    __missedInputCallback = None
+    # ticks older than this are too old to compare, they may have wrapped
+    __tickMaxAge = 600
+    # decisions are kept for this long, for status
+    __statsTime = 60
+    # and this many, for the control socket
+    __recentDecisionsSize = 100
 
     #
     # init
     # this is mostly to get lockout bits from __settings
-    def __init__(self, systemHandler, settings, logger, tokens, outputHandler, pi, pinDef):
-        import pigpio  # pigpio is started in main, but this is necessary here for pullup definitions
-        try:
-            import wiegand
-        except ImportError:
-            print("*** Wiegand.py not found - please download it and place it in the root directory for this folder ***\n")
-            print("This should do the trick, assuming you're in the root directory now:")
-            print("wget http://abyz.me.uk/rpi/pigpio/code/wiegand_py.zip")
-            print("unzip wiegand_py.zip")
-            print("rm -rf wiegand_old.py wiegand_py.zip\n")
-            exit()
-
-        # internalise settings, tokens, logger, outputHandler, pi and pinDef
+    def __init__(self, systemHandler, settings, logger, tokens, outputHandler, pi, pinDef, auditHandler, metrics):
+        # internalise settings, tokens, logger, outputHandler, pi, pinDef, auditHandler and metrics
         self.__systemHandler = systemHandler
         del systemHandler
         self.__settings = settings
@@ -99,24 +141,72 @@ class inputHandler:
         del pi
         self.__pinDef = pinDef
         del pinDef
+        self.__audit = auditHandler
+        del auditHandler
+        self.__metrics = metrics
+        del metrics
+        # (time, allowed, seconds taken) for each decision in the last __statsTime
+        self.__decisions = []
+        self.__decisionsLock = threading.Lock()
+        self.__recentDecisions = collections.deque(maxlen=self.__recentDecisionsSize)
+        # what the callbacks (and reconcileInputs) have told us - name: level, and name: (tick, monotonic time)
+        self.__inputTicks = {}
+        self.__inputLock = threading.Lock()
+        # set to end a lockout early
+        self.__lockoutEnd = threading.Event()
 
         # see if __settings are set
-        if self.__settings.allSettings is False:
+        if self.__settings.config is False:
             return
 
+        # get settings
+        self.loadSettings()
+
+        # no pigpiod, no pins - benchmark.py uses it like this, without any hardware
+        if self.__pi is False:
+            return
+
+        try:
+            import wiegand
+        except ImportError:
+            print("*** Wiegand.py not found - please download it and place it in the root directory for this folder ***\n")
+            print("This should do the trick, assuming you're in the root directory now:")
+            print("wget http://abyz.me.uk/rpi/pigpio/code/wiegand_py.zip")
+            print("unzip wiegand_py.zip")
+            print("rm -rf wiegand_old.py wiegand_py.zip\n")
+            exit()
+
+        # set up the pins and the wiegand decoder
+        self.__setupInputs()
+
+        # done
+        return
+
+    #
+    # get settings - at startup, and again when settings are reloaded
+    # anything that's not set goes back to the default
+    def loadSettings(self):
+        params = dict(inputHandler.__params)
+
         # the __settings we're going to get are
         settingsToGet = ["delimiter", "timeout", "bruteforceThresholdTime", "bruteforceThresholdAttempts", "overspeedThresholdTime", "lockoutTime", "doorSensorOpen"]
-        # make sure they exist
-        # if exist, overwrite __params list with user defined settings
+        # they've been checked already, None if not set
+        # if set, overwrite __params list with user defined settings
+        inputConfig = self.__settings.config.inputHandling
         for s in settingsToGet:
-            try:
-                self.__settings.allSettings["inputHandling"][s]
-            except Exception:
-                # self.__logger.log("WARN", "unable to read setting", e)
-                pass
-            else:
-                self.__logger.log("DBUG", "input handler: new setting", {"parameter": s, "value": self.__settings.allSettings["inputHandling"][s]})
-                self.__params[s] = self.__settings.allSettings["inputHandling"][s]
+            value = getattr(inputConfig, s)
+            if value is not None:
+                self.__logger.log("DBUG", "input handler: new setting", {"parameter": s, "value": value})
+                params[s] = value
+        self.__params = params
+        return
+
+    #
+    # pull ups, glitch filters and the wiegand decoder all live in pigpiod
+    # so this is done at startup, and again when pigpiod is reconnected
+    def __setupInputs(self):
+        import pigpio  # pigpio is started in main, but this is necessary here for pullup definitions
+        import wiegand  # checked in __init__
 
         # initialise some pins for pullup and glitchfilter
         self.__pi.set_glitch_filter(self.__pinDef.pins["doorbellButton"], 100000)
@@ -125,19 +215,104 @@ class inputHandler:
         self.__pi.set_pull_up_down(self.__pinDef.pins["doorbellButton"], pigpio.PUD_UP)
         self.__pi.set_pull_up_down(self.__pinDef.pins["doorSensor"], pigpio.PUD_UP)
 
-        doorbellState=self.__pi.read(self.__pinDef.pins["doorbellButton"])
-        self.__logger.log("DBUG", "Doorbell Initial GPI State", {"doorbellState": doorbellState})
-
-        doorSensorState=self.__pi.read(self.__pinDef.pins["doorSensor"])
-        self.__logger.log("DBUG", "Door Sensor Initial GPI State", {"doorSensorState": doorSensorState})
+        # where the inputs are now - after a reconnect, this finds anything that changed while we were away
+        self.reconcileInputs()
 
         # set the wiegand reading
         # will call function __wiegandCallback on receiving data
-        w = wiegand.decoder(self.__pi, self.__pinDef.pins["wiegand0"], self.__pinDef.pins["wiegand1"], self.__wiegandCallback)
+        self.__wiegandDecoder = wiegand.decoder(self.__pi, self.__pinDef.pins["wiegand0"], self.__pinDef.pins["wiegand1"], self.__wiegandCallback)
 
         # done
         return
 
+    #
+    # pigpiod has been reconnected
+    # the old decoder's callbacks went with the old connection
+    def reconnect(self, pi):
+        if self.__stopped is True:
+            return
+        try:
+            self.__wiegandDecoder.cancel()
+        except Exception:
+            pass
+        self.__pi = pi
+        self.__setupInputs()
+        self.__logger.log("INFO", "input handler: inputs set up again after pigpiod reconnect")
+        return
+
+    #
+    # stop taking input - the first thing done on shutdown
+    # a decision that's already being made is left to finish
+    def stop(self):
+        self.__stopped = True
+        try:
+            self.__wiegandDecoder.cancel()
+        except Exception:
+            pass
+        self.__logger.log("DBUG", "input handler: stopped taking input")
+        return
+
+    #
+    # input snapshot
+    # all the inputs in one go, so they're all from the same moment
+    def snapshotInputs(self):
+        try:
+            bank = self.__pi.read_bank_1()
+        except Exception as e:
+            self.__logger.log("WARN", "unable to read inputs", e)
+            return None
+        return self.__pinDef.inputLevels(bank)
+
+    def reconcileInputs(self):
+        # the tick from just before the read - a callback after this knows better than the snapshot
+        try:
+            snapshotTick = self.__pi.get_current_tick()
+        except Exception as e:
+            self.__logger.log("WARN", "unable to read inputs", e)
+            return
+        levels = self.snapshotInputs()
+        if levels is None:
+            return
+
+        with self.__inputLock:
+            # first time
+            if self.__inputLevels is None:
+                self.__inputLevels = levels
+                self.__logger.log("DBUG", "Initial GPI States", levels)
+                return
+
+            # anything the callbacks didn't tell us about
+            # handled as if the callback had come now - a press and release that were both missed can't be seen
+            missed = {}
+            timeNow = time.monotonic()
+            for name, level in levels.items():
+                known = self.__inputTicks.get(name)
+                if known is not None and timeNow - known[1] < self.__tickMaxAge and not self.__tickAfter(snapshotTick, known[0]):
+                    continue
+                if self.__inputLevels.get(name) != level:
+                    missed[name] = level
+                    self.__inputLevels[name] = level
+                    # so a late callback for the same change is dropped
+                    self.__inputTicks[name] = (snapshotTick, timeNow)
+        if not missed:
+            return
+        self.__logger.log("INFO", "input changes found without a callback", missed)
+        if self.__missedInputCallback is None:
+            return
+        for name, level in missed.items():
+            try:
+                self.__missedInputCallback(self.__pinDef.pins[name], level, None)
+            except Exception as e:
+                self.__logger.log("WARN", "unable to handle missed input change", {"name": name, "level": level, "error": e})
+        return
+
+    def setMissedInputCallback(self, func):
+        self.__missedInputCallback = func
+        return
+
+    def __tickAfter(self, tick, than):
+        return 0 < ((tick - than) & 0xffffffff) < 0x80000000
+
     #
     # function to be run with each incoming bit
     # will work out if input should go into buffer, be ignored, or starts the buffer
@@ -231,24 +406,72 @@ class inputHandler:
     # this if for a fully formed input to be checked/approved by lockout and then token checked
     #
     def __checkInput(self, rx, rxType):
+        decisionStart = time.perf_counter()
         # check the lockout, bail if locked
         if self.__checkLockout() == "locked":
             self.__logger.log("INFO", "ACCESS DENIED BY LOCKOUT", {"token": rx})
+            self.__audit.record("denied", "lockout", tokenType=rxType, token=rx)
+            self.__addDecision(False, "lockout", decisionStart, None, rxType, rx)
             return
 
         # check the token, true if approved, false if denied
         tokenCheckOutput = self.__tokens.checkToken(rx, rxType)
         if tokenCheckOutput["allow"] is True:
-            self.__outputHandler.openDoor()
-            self.__logger.log("INFO", "ACCESS ALLOWED BY TOKEN", {"token": rx, "type": rxType, "user": tokenCheckOutput["user"]})
+            # still allowed if the door couldn't be opened, but it's kept with the decision
+            doorOpened = self.__outputHandler.openDoor()
+            self.__logger.log("INFO", "ACCESS ALLOWED BY TOKEN", {"token": rx, "type": rxType, "user": tokenCheckOutput["user"], "doorOpened": doorOpened})
+            self.__audit.record("allowed", "token", tokenCheckOutput["user"], rxType, rx, None if doorOpened is True else {"doorOpened": False})
         else:
             # add bad attempt to __previousBadAttempts
             self.__addBadAttempt()
             self.__logger.log("INFO", "ACCESS DENIED BY TOKEN", {"token": rx, "type": rxType})
+            self.__audit.record("denied", "token", tokenType=rxType, token=rx)
+            self.__outputHandler.playPattern("accessDenied")
+        self.__addDecision(tokenCheckOutput["allow"] is True, "token", decisionStart, tokenCheckOutput.get("user"), rxType, rx)
 
         # done
         return
 
+    #
+    # decision stats, for status
+    #
+    def __addDecision(self, allowed, reason, decisionStart, user, tokenType, token):
+        timeNow = time.monotonic()
+        decisionTime = time.perf_counter() - decisionStart
+        outcome = "allowed" if allowed else "denied"
+        self.__metrics.inc("diyac_access_decisions_total", (("outcome", outcome), ("reason", reason), ("type", tokenType)))
+        self.__metrics.observe("diyac_decision_seconds", decisionTime)
+        with self.__decisionsLock:
+            self.__decisions.append((timeNow, allowed, decisionTime))
+            self.__recentDecisions.append({"time": time.time(), "outcome": outcome, "reason": reason, "user": user, "tokenType": tokenType, "token": token})
+        return
+
+    def recentDecisions(self, count=__recentDecisionsSize):
+        with self.__decisionsLock:
+            decisions = list(self.__recentDecisions)
+        if count <= 0:
+            return []
+        return decisions[-count:]
+
+    def getStats(self):
+        timeNow = time.monotonic()
+        with self.__decisionsLock:
+            # forget anything older than __statsTime
+            while self.__decisions and self.__decisions[0][0] < timeNow - self.__statsTime:
+                del self.__decisions[0]
+            decisions = list(self.__decisions)
+        allowed = sum(1 for decision in decisions if decision[1] is True)
+        decisionTimes = sorted(decision[2] for decision in decisions)
+        p95 = None
+        if decisionTimes:
+            p95 = round(decisionTimes[int(len(decisionTimes) * 0.95)] * 1000, 2)
+        return {
+            "allowedLastMinute": allowed,
+            "deniedLastMinute": len(decisions) - allowed,
+            "lockout": self.lockout["state"],
+            "decisionP95ms": p95
+        }
+
     #
     # add attempt into __previousBadAttempts
     # remove last value if more than 3
@@ -298,7 +521,7 @@ class inputHandler:
         # run the thread function
         # but only if it's not already locked
         if self.lockout["state"] != "locked":
-            lockoutThread = threading.Thread(name='lockoutThread', target=self.lockoutThreadFunc, args=("bruteforce",))
+            lockoutThread = threading.Thread(name='lockoutThread', target=self.lockoutThreadFunc, args=("bruteforce",), daemon=True)
             lockoutThread.start()
 
         # done
@@ -321,7 +544,7 @@ class inputHandler:
 
         # lets lock it oot
         if self.lockout["state"] != "locked":
-            lockoutThread = threading.Thread(name='lockoutThread', target=self.lockoutThreadFunc, args=("overspeed",))
+            lockoutThread = threading.Thread(name='lockoutThread', target=self.lockoutThreadFunc, args=("overspeed",), daemon=True)
             lockoutThread.start()
 
         # done
@@ -336,19 +559,36 @@ class inputHandler:
         timeNow = time.time()
         # start
         self.__logger.log("INFO", "Lockout started", {"method": method, "duration": self.__params["lockoutTime"]})
+        self.__lockoutEnd.clear()
         self.lockout = {"state": "locked", "type": method, "start": timeNow}
-        # wait
-        time.sleep(self.__params["lockoutTime"])
+        self.__metrics.inc("diyac_lockouts_total", (("method", method),))
+        self.__audit.record("lockout", method, detail={"duration": self.__params["lockoutTime"]})
+        self.__outputHandler.playPattern("lockout")
+        # wait - clearLockout can cut it short
+        cleared = self.__lockoutEnd.wait(self.__params["lockoutTime"])
         # end
-        self.__logger.log("INFO", "Lockout ended")
+        self.__logger.log("INFO", "Lockout ended", {"cleared": cleared})
+        self.__audit.record("lockout", "ended", detail={"method": method, "cleared": cleared})
         self.lockout = {"state": "unlocked"}
         self.__previousBadAttempts = []
         return
 
+    #
+    # end a lockout early
+    def clearLockout(self):
+        if self.lockout["state"] != "locked":
+            return False
+        self.__lockoutEnd.set()
+        return True
+
     #
     # this function is called by the wiegand library when it has read something
     #
     def __wiegandCallback(self, bits, code):
+        if self.__stopped is True:
+            return
+        self.__metrics.inc("diyac_wiegand_frames_total", (("bits", bits),))
+
         # if bits == 34 or 26, it's a card token
         #  convert to binary string
         #  trim "0b", start parity bit, end parity bit
@@ -362,6 +602,9 @@ class inputHandler:
         #
         # we have a card
         if bits == 34 or bits == 26:
+            if self.__parityOk(bits, code) is False:
+                self.__metrics.inc("diyac_wiegand_parity_errors_total", (("bits", bits),))
+                self.__logger.log("DBUG", "New token read has a parity error", {"bits": bits, "code": code})
             # make input into a hex string
             #
             output = self.__wiegandToHex(bits, code)
@@ -395,6 +638,14 @@ class inputHandler:
             self.__logger.log("WARN", "New read - unexpected amount of bits", {"bits": bits, "code": code})
             return
 
+    def __parityOk(self, bits, code):
+        # half is the data bits each parity bit covers, 12 for 26 bits and 16 for 34 bits
+        half = (bits - 2) // 2
+        # first parity bit and the first half, then the second half and the last parity bit
+        firstHalf = code >> (half + 1)
+        secondHalf = code & ((1 << (half + 1)) - 1)
+        return bin(firstHalf).count("1") % 2 == 0 and bin(secondHalf).count("1") % 2 == 1
+
     def __wiegandToHex(self, bits, code):
         if bits == 34:
             binaryFormatter = "#036b"
@@ -416,6 +667,19 @@ class inputHandler:
         return output
 
     def gpiCallback(self, gpi, level, tick, gpiName):
+        if self.__stopped is True:
+            return
+        # a missed change from reconcileInputs has no tick, and it's already stored
+        if gpiName is not None and tick is not None:
+            with self.__inputLock:
+                known = self.__inputTicks.get(gpiName)
+                timeNow = time.monotonic()
+                if known is not None and timeNow - known[1] < self.__tickMaxAge and not self.__tickAfter(tick, known[0]):
+                    self.__logger.log("DBUG", "GPI change already handled by input reconcile", {"GPI": gpi, "GPI Name": gpiName, "levl": level})
+                    return
+                self.__inputTicks[gpiName] = (tick, timeNow)
+                if self.__inputLevels is not None:
+                    self.__inputLevels[gpiName] = level
         # if it's the doorbell button, ring the doorbell
         if gpiName == "doorbellButton" and level == 0:
             self.__logger.log("DBUG", "doorbell button pushed", {"GPI": gpi, "GPI Name": gpiName, "levl": level})
@@ -2,8 +2,17 @@
 import datetime  # used for logging
 import json  # for outputting pretty strings from data
 import syslog
-import re  # for redacting data
+import socket  # for the journald native socket
+import struct  # for journald binary field lengths
 import sys # for stdout writing
+import time
+import queue  # for the file writer thread
+import threading
+import os  # for log rotation
+import gzip  # for compressing rotated logs
+import shutil  # for compressing rotated logs
+import traceback  # for unhandled exceptions
+import itertools  # for the flight recorder slot counter
 
 #
 # log
@@ -23,15 +32,58 @@ import sys # for stdout writing
 #
 # Variables:
 #  __levelTable - list - levels of logging available
+#  __levelNumbers - dict - level: int, so levels can be compared with one integer comparison
+#  __levelOff - int - level number for an output set to NONE, above every message level
+#  __syslogLevelNo, __displayLevelNo, __fileLevelNo, __journalLevelNo - int - level numbers for each output
+#  __minLevel - int - lowest level number that any output or the flight recorder will take, anything below is thrown away straight away
+#  __outputMinLevel - int - lowest level number that any output will log
+#  __isoSecond, __isoTime - int, str - the last timestamp made, so it's only made once a second
+#  __redactWord - str - what redacted values are replaced with
+#  __redactKeys - dict - output: frozenset of keys to redact
 #  __syslogLevelConversion - dict - lookup for converting log level to something recognisable by syslog
 #  __filePath - str - path to logfile
 #  __fileLevel - str - message level to to into logfile - deafult NONE
 #  __syslogLevel - str - message level for syslog - default NOTE
+#  __journalLevel - str - message level for the journald native socket - default NONE
+#  __journalPath - str - path to the journald native socket
+#  __journalSocket - socket - connection to journald, kept open - False if not connected
+#  __journalFields - dict - data key: journal field name, for structured fields
 #  __displayLevel - str - message level to go to display - default INFO
 #  __displayColour - bool - whether or not to colourize display output - default FALSE
 #  __ansiEscape - str - ansi escape string for making colour output to terminal
 #  __colourLookup - list of dicts - list of colour stuff for each log level
 #  __settings - bool - where the settings object goes, false when no settings obj available
+#  __fileParams - dict - settings for the file writer thread
+#   queueSize - int - lines that can be waiting to be written, after that lines are dropped (and counted)
+#   flushSize - int - bytes written before a flush
+#   flushTime - float - seconds before anything written is flushed
+#   maxSize - int - bytes in the log file before it's rotated, 0 for no limit
+#   rotateDaily - bool - rotate when the day changes
+#   keep - int - number of rotated files to keep, older ones are deleted
+#  __fileQueue - queue.Queue - lines waiting for the writer thread, False if the writer isn't running
+#  __fileWriterThread - threading.Thread - the writer thread
+#  __fileDropped - int - lines dropped because the queue was full
+#  __fileIdCheckTime - float - seconds between checks that the log file hasn't been moved by something else (eg. logrotate)
+#  __compressLock - threading.Lock - only one compressor thread works on the rotated files at a time
+#  __rateParams - dict - settings for rate limiting, False if it's turned off
+#   burst - int - messages with the same level and text that can be logged in one go
+#   rate - float - messages per second allowed after the burst is used up
+#   summaryTime - float - seconds between "suppressed similar messages" summaries during a storm
+#   maxKeys - int - different messages to keep track of, the oldest are forgotten after that
+#  __rateState - dict - (lvlNo, msg): [allowance, last time, suppressed count, last summary time]
+#  __rateLock - threading.Lock - log() is called from lots of threads
+#  __recorderParams - dict - settings for the flight recorder
+#   size - int - number of recent messages to keep, 0 to turn it off
+#   level - str - lowest level kept - DBUG by default, so there's more in a dump than the log file already has
+#   path - str - dump files are this path + "-YYYYMMDD-HHMMSS.log"
+#   keep - int - number of dump files to keep
+#   minInterval - float - seconds between dumps caused by ERRR messages
+#  __recorder - list - ring buffer of (number, time, lvl, msg, data), made once at full size - False if off
+#  __recorderCounter - itertools.count - numbers the messages, the slot is number % size
+#   next() on it is atomic, so threads never get the same slot without a lock
+#  __recorderLevelNo - int - level number of recorderParams level
+#  __recorderPath - str - full dump path, False until settings are loaded
+#  __recorderLastDump - float - monotonic time of the last dump caused by an ERRR
 #
 #
 # Functions:
@@ -47,38 +99,138 @@ import sys # for stdout writing
 #  __setLogToSysLogSettings()
 #  __setLogToDisplaySettings()
 #  __setLogToFileSettings()
+#  __setLogToJournalSettings()
 #   go through settings and get the ones related to the respective outputs
+#   if the journal socket can't be used, journal messages go to syslog instead
+#
+#  __connectJournal()
+#   open the journald native socket
 #
 #  log(lvl, msg, [data])
 #   log message to outputs
+#   unless the same message is coming too fast, then it's counted instead
+#
+#  __setRateLimitSettings()
+#   get rate limit settings
+#
+#  __rateLimit(lvl, lvlNo, msg)
+#   token bucket for each level and message - true if the message can be logged
+#   during a storm, logs a summary of suppressed messages every summaryTime
+#
+#  flushSuppressed()
+#   log summaries for anything suppressed that hasn't been reported yet
+#   called regularly by main, so the end of a storm gets reported
+#
+#  __takeSuppressed(now)
+#   get the counts that haven't been reported, and reset them
+#
+#  __logSuppressed(summaries)
+#   log the summaries, straight to the outputs so they aren't rate limited themselves
+#
+#  __output(lvl, lvlNo, msg, data)
+#   send a message to every output
+#
+#  __setFlightRecorderSettings()
+#   get flight recorder settings, and make the ring buffer
+#
+#  __setRecorderLevel(levelNo)
+#   set the flight recorder level, and __minLevel to go with it
+#
+#  dumpFlightRecorder([reason], [wait])
+#   write everything in the ring buffer to a new dump file, redacted like the log file
+#   done in a thread unless wait is true
+#   used for SIGUSR1, and done automatically on ERRR messages and unhandled exceptions
+#
+#  __writeFlightRecorder(records, reason)
+#   write the dump file, and delete old ones
+#
+#  __installExceptHooks()
+#   log unhandled exceptions in any thread as ERRR, which also dumps the flight recorder
+#
+#  isEnabledFor(lvl)
+#   true if any output, or the flight recorder, would take a message of this level
+#   so callers can skip making log data that nobody will see
+#
+#  __setLevel(destination, level)
+#   set the level for an output, and work out the level numbers again
 #
-#  __logToSysLog(lvl, msg)
-#  __logToDisplay(time, lvl, msg, data)
-#  __logToFile(time, lvl, msg, data)
+#  __getIsoTime()
+#   timestamp for log lines
+#
+#  __logToSysLog(lvl, lvlNo, msg)
+#  __logToJournal(lvl, lvlNo, msg, data, dataCache)
+#  __logToDisplay(time, lvl, lvlNo, msg, data, dataCache)
+#  __logToFile(time, lvl, lvlNo, msg, data, dataCache)
 #   perform checks and log to each output
 #
-#  __checkLevel(destination, incomingLevel)
-#   checks whether an incoming message is high enough level to be logged to this destination
-#   returns true if it whould be logged
+#  __startFileWriter()
+#   start the file writer thread, if it's not already running
+#
+#  __fileWriterThreadFunc(fileQueue)
+#   keeps the log file open, writes lines from __fileQueue in batches
+#   flushes after flushSize bytes, flushTime seconds, or a NOTE or higher line
+#   rotates the file when it gets to maxSize, or the day changes if rotateDaily
+#   opens the file again if something else has renamed or deleted it
+#
+#  __rotateFile()
+#   rename the log file out of the way (logFile.YYYYMMDD-HHMMSS), done in the writer thread
+#   starts a compressor thread, so the writer goes straight back to writing
+#   returns the new name, or False if it couldn't be renamed
+#
+#  __compressRotated()
+#   gzip any rotated files that aren't compressed yet, then delete all but the newest keep
+#   runs in its own thread, and also picks up anything left over if a previous one was interrupted
+#
+#  __rotatedFiles()
+#   list of rotated log files, oldest first
+#
+#  queueDepth()
+#   lines waiting in __fileQueue, for status
+#
+#  cleanup([timeout])
+#   drain __fileQueue, flush and close the log file - waits for up to timeout seconds
+#   anything logged after this is written straight to the file
 #
-#  __dataFormat(destination, data)
+#  __setRedactKeys()
+#   work out the set of keys to redact for each output from settings
+#
+#  __dataRedact(redactKeys, data)
+#   copy of data with the values of redactKeys replaced, all the way down
+#
+#  __dataFormat(destination, data, dataCache)
 #   makes incoming data into a nice string
 #   will also redact any information, as specified in settings
+#   the string is kept in dataCache so other outputs with the same redact keys can use it
 #
-#  __inList(needle, haystack)
-#   find if needle is in haystack
-#   if it is, return the index
+#  __journalField(name, value)
+#   make one field in the journald native format
 #
 
 
 class logger:
     # let's have some default vars
     __levelTable = ["DBUG", "INFO", "NOTE", "WARN", "ERRR", "NONE"]
+    __levelNumbers = {"DBUG": 0, "INFO": 1, "NOTE": 2, "WARN": 3, "ERRR": 4, "NONE": 5}
+    __levelOff = 6
     __syslogLevelConversion = {"DBUG": syslog.LOG_DEBUG, "INFO": syslog.LOG_INFO, "NOTE": syslog.LOG_NOTICE, "WARN": syslog.LOG_WARNING, "ERRR": syslog.LOG_ERR}
     __filePath = False
     __fileLevel = "NONE"
     __syslogLevel = "NOTE"
     __displayLevel = "INFO"
+    __journalLevel = "NONE"
+    __fileLevelNo = __levelOff
+    __syslogLevelNo = 2
+    __journalLevelNo = __levelOff
+    __displayLevelNo = 1
+    __minLevel = 1
+    __outputMinLevel = 1
+    __isoSecond = None
+    __isoTime = ""
+    __redactWord = "-REDACTED-"
+    __redactKeys = {"display": frozenset(), "file": frozenset(), "journal": frozenset()}
+    __journalPath = "/run/systemd/journal/socket"
+    __journalSocket = False
+    __journalFields = {"type": "TOKEN_TYPE", "user": "USER", "token": "TOKEN", "door": "DOOR", "method": "LOCKOUT_METHOD"}
     __displayColour = False
     __ansiEscape = "\033["
     # the order must be the same as the level table, it uses the indexes
@@ -110,12 +262,54 @@ class logger:
         }
     ]
     __settings = False
+    __fileParams = {
+        "queueSize": 10000,
+        "flushSize": 4096,
+        "flushTime": 1,
+        "maxSize": 10485760,
+        "rotateDaily": False,
+        "keep": 7
+    }
+    __fileQueue = False
+    __fileWriterThread = None
+    __fileDropped = 0
+    __fileIdCheckTime = 1
+    __compressLock = threading.Lock()
+    __rateParams = {
+        "burst": 20,
+        "rate": 5,
+        "summaryTime": 10,
+        "maxKeys": 500
+    }
+    __recorderParams = {
+        "size": 2000,
+        "level": "DBUG",
+        "path": "log/flightRecorder",
+        "keep": 5,
+        "minInterval": 60
+    }
+    __recorder = False
+    __recorderLevelNo = 0
+    __recorderPath = False
+    __recorderLastDump = None
 
     def __init__(self, settings=False, runMode="normal"):
+        # rate limiting
+        self.__rateState = {}
+        self.__rateLock = threading.Lock()
+
+        # flight recorder - on from the start, so it has everything from startup
+        self.__recorder = [None] * self.__recorderParams["size"]
+        self.__recorderCounter = itertools.count()
+        self.__installExceptHooks()
+
+        # syslog is opened once, and left open
+        syslog.openlog(ident="diyac", logoption=syslog.LOG_PID)
+
         # run mode - stop output to display
         self.__runMode = runMode
         if self.__runMode == "daemon":
-            self.__displayLevel = "NONE"
+            self.__setLevel("display", "NONE")
 
         # if there's no settings, only use defaults
         if settings is False:
@@ -126,7 +320,7 @@ class logger:
         self.__settings = settings
 
         # if no settings, there's nothing more can be done
-        if self.__settings.allSettings is False:
+        if self.__settings.config is False:
             self.log("WARN", "no settings - no logging to file, display logging will be INFO")
             return
 
@@ -144,21 +338,111 @@ class logger:
             self.__settings = settings
 
         # make some loading happen
+        self.__setRedactKeys()
+        self.__setRateLimitSettings()
+        self.__setFlightRecorderSettings()
         self.__setLogToDisplaySettings()
         self.__setLogToFileSettings()
         self.__setLogToSysLogSettings()
+        self.__setLogToJournalSettings()
+
+    def __setRateLimitSettings(self):
+        rateConfig = self.__settings.config.logging.rateLimit
+        if rateConfig is False:
+            self.__rateParams = False
+            self.log("INFO", "log rate limiting turned off")
+            return
+        rateParams = dict(logger.__rateParams)
+        for param in rateParams:
+            if getattr(rateConfig, param) is not None:
+                rateParams[param] = getattr(rateConfig, param)
+        self.__rateParams = rateParams
+        self.log("DBUG", "log rate limiting set", rateParams)
+        return
+
+    def __setFlightRecorderSettings(self):
+        recorderConfig = self.__settings.config.logging.flightRecorder
+        recorderParams = dict(logger.__recorderParams)
+        # settings paths are already absolute, the default isn't
+        recorderParams["path"] = self.__settings.config.root + recorderParams["path"]
+        if recorderConfig is False:
+            recorderParams["size"] = 0
+        else:
+            for param in recorderParams:
+                if getattr(recorderConfig, param) is not None:
+                    recorderParams[param] = getattr(recorderConfig, param)
+        self.__recorderParams = recorderParams
+
+        # off
+        if recorderParams["size"] <= 0 or recorderParams["level"] == "NONE":
+            self.__recorder = False
+            self.__setRecorderLevel(self.__levelOff)
+            self.log("INFO", "flight recorder turned off")
+            return
+
+        # new size - what's already there is kept, as long as it fits
+        # a message logged while this happens might not make it into the new one
+        if self.__recorder is False or len(self.__recorder) != recorderParams["size"]:
+            records = self.__recorderRecords()[-recorderParams["size"]:]
+            recorder = [None] * recorderParams["size"]
+            for i in range(len(records)):
+                recorder[i] = (i,) + records[i][1:]
+            self.__recorderCounter = itertools.count(len(records))
+            self.__recorder = recorder
+        self.__setRecorderLevel(self.__levelNumbers[recorderParams["level"]])
+
+        self.__recorderPath = recorderParams["path"]
+        self.log("DBUG", "flight recorder set", {"size": recorderParams["size"], "level": recorderParams["level"], "path": self.__recorderPath})
+        return
 
     def __setLogToSysLogSettings(self):
         # this will only get the level for output to syslog
         # might have more in future
+        level = self.__settings.config.logging.syslog.level
+        if level is None:
+            level = logger.__syslogLevel
+        self.__setLevel("syslog", level)
+
+    def __setLogToJournalSettings(self):
+        # if it's not set, it's off
+        level = self.__settings.config.logging.journal.level
+        if level is None or level == "NONE":
+            self.__closeJournal()
+            self.__setLevel("journal", "NONE")
+            return
+
+        # connect - if we can't, syslog will have to do
+        if self.__connectJournal() is False:
+            self.__setLevel("journal", "NONE")
+            if self.__levelNumbers[level] < self.__syslogLevelNo:
+                self.__setLevel("syslog", level)
+            self.log("WARN", "journald socket not available - journal logging will go to syslog", {"level": self.__syslogLevel})
+            return
+
+        self.__setLevel("journal", level)
+        self.log("INFO", "journal logging level set", {"level": level})
+        return
+
+    def __connectJournal(self):
+        if self.__journalSocket is not False:
+            return True
         try:
-            self.__settings.allSettings["logging"]["syslog"]["level"]
-        except:
+            journalSocket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            journalSocket.connect(self.__journalPath)
+        except OSError:
+            return False
+        self.__journalSocket = journalSocket
+        return True
+
+    def __closeJournal(self):
+        if self.__journalSocket is False:
+            return
+        try:
+            self.__journalSocket.close()
+        except OSError:
             pass
-        else:
-            # make sure it's a valid value, then set
-            if self.__settings.allSettings["logging"]["syslog"]["level"] in self.__levelTable:
-                self.__syslogLevel = self.__settings.allSettings["logging"]["syslog"]["level"]
+        self.__journalSocket = False
+        return
 
     def __setLogToDisplaySettings(self):
         #
@@ -169,35 +453,20 @@ class logger:
 
         # if running as a daemon - none
         if self.__runMode == "daemon":
-            self.__displayLevel = "NONE"
+            self.__setLevel("display", "NONE")
             return
 
-        # check if colour enabled
-        try:
-            self.__settings.allSettings["logging"]["display"]["colour"]
-        except:
-            pass
-        else:
-            # the if is only here to validate input
-            if self.__settings.allSettings["logging"]["display"]["colour"] is True:
-                # set the vairbale
-                self.__displayColour = True
+        displayConfig = self.__settings.config.logging.display
 
-        # make sure it exists
-        try:
-            self.__settings.allSettings["logging"]["display"]["level"]
-        except NameError:
-            self.log("INFO", "display logging level not set - no logs will be printed to stdout")
-            self.__displayLevel = "NONE"
-            return
+        # check if colour enabled
+        self.__displayColour = displayConfig.colour is True
 
-        # make sure it's in __levelTable
-        if self.__settings.allSettings["logging"]["display"]["level"] in self.__levelTable:
-            self.__displayLevel = self.__settings.allSettings["logging"]["display"]["level"]
-            self.log("INFO", "display logging level set", {"level": self.__displayLevel})
-        else:
-            self.log("WARN", "display logging level is incorrect - no more logs to stdout", {"value in settings": self.__settings.allSettings["logging"]["display"]["level"]})
-            self.__displayLevel = "NONE"
+        # not set - default
+        level = displayConfig.level
+        if level is None:
+            level = logger.__displayLevel
+        self.__setLevel("display", level)
+        self.log("INFO", "display logging level set", {"level": self.__displayLevel})
 
         # done
         return
@@ -213,50 +482,30 @@ class logger:
         #  test if file can be opened and closed
         #
 
+        fileConfig = self.__settings.config.logging.file
+
         # test exists
-        try:
-            self.__settings.allSettings["logging"]["file"]["level"]
-        except NameError:
+        if fileConfig.level is None:
             self.log("INFO", "file logging level not set - no logs will be printed to file")
-            self.__fileLevel = "NONE"
+            self.__setLevel("file", "NONE")
             return
 
         # temporary var for file level
-        tmpFileLevel = "NONE"
-
-        # czech in __levelTable
-        if self.__settings.allSettings["logging"]["file"]["level"] in self.__levelTable:
-            tmpFileLevel = self.__settings.allSettings["logging"]["file"]["level"]
-            self.log("INFO", "file logging level set", {"level": tmpFileLevel})
-        else:
-            self.__fileLevel = "NONE"
-            self.log("WARN", "file logging level is incorrect in settings", {"value": self.__settings.allSettings["logging"]["file"]["level"]})
-            return
+        tmpFileLevel = fileConfig.level
+        self.log("INFO", "file logging level set", {"level": tmpFileLevel})
 
         # see if it's none, if so we don't need to do anything more
         if tmpFileLevel == "NONE":
+            self.__setLevel("file", "NONE")
             return
 
-        # test if path set
-        try:
-            self.__settings.allSettings["logging"]["file"]["path"]
-        except NameError:
+        # test if path set - it's already absolute
+        if fileConfig.path is None:
             # not set, no log to file and return
             self.log("WARN", "File path not set - no logs to file")
-            self.__fileLevel = "NONE"
+            self.__setLevel("file", "NONE")
             return
-        else:
-            self.__filePath = self.__settings.allSettings["logging"]["file"]["path"]
-
-        # change path to absolute if necessary
-        if self.__filePath[0] != "/":
-            # still gotta test settings["root"] exists
-            try:
-                self.__settings.allSettings["root"]
-            except NameError:
-                self.log("DBUG", "root dir not in settings - will use relative path for log file")
-            else:
-                self.__filePath = self.__settings.allSettings["root"] + self.__filePath
+        self.__filePath = fileConfig.path
         self.log("DBUG", "log file path set ", {"path": self.__filePath})
 
         # open the file - this will also create the file if it doens't already exist
@@ -266,7 +515,7 @@ class logger:
         except:
             # unable to open
             self.log("WARN", "unable to open log file (" + self.__filePath + ")- will not perform logging to file")
-            self.__fileLevel = "NONE"
+            self.__setLevel("file", "NONE")
             return
 
         # close the file
@@ -276,13 +525,241 @@ class logger:
         except:
             # unable to close file
             self.log("WARN", "unable to close log file - will not perform logging to file")
-            self.__fileLevel = "NONE"
+            self.__setLevel("file", "NONE")
             return
 
+        # writer thread settings
+        fileParams = dict(logger.__fileParams)
+        for param in fileParams:
+            if getattr(fileConfig, param) is not None:
+                fileParams[param] = getattr(fileConfig, param)
+        self.__fileParams = fileParams
+
         # get out __fileLevel and put it into the object
-        self.__fileLevel = tmpFileLevel
+        self.__setLevel("file", tmpFileLevel)
+
+        # start writing
+        self.__startFileWriter()
+
+        # done
+        return
+
+    #
+    # file writer thread
+    # so the callers of log() never wait for the sd card
+    #
+    def __startFileWriter(self):
+        if self.__fileWriterThread is not None and self.__fileWriterThread.is_alive():
+            return
+        self.__fileQueue = queue.Queue(maxsize=self.__fileParams["queueSize"])
+        self.__fileWriterThread = threading.Thread(name='logWriterThread', target=self.__fileWriterThreadFunc, args=(self.__fileQueue,), daemon=True)
+        self.__fileWriterThread.start()
+        return
+
+    def __fileWriterThreadFunc(self, fileQueue):
+        f = None
+        filePath = None
+        fileSize = 0
+        fileDay = None
+        fileId = None
+        lastIdCheck = time.monotonic()
+        batch = []
+        unflushedBytes = 0
+        lastFlush = time.monotonic()
+        running = True
+        while running:
+            # wait for something, but not so long that a flush is missed
+            try:
+                item = fileQueue.get(timeout=self.__fileParams["flushTime"])
+            except queue.Empty:
+                item = False
+
+            # grab anything else that's waiting while we're here
+            urgent = False
+            while item is not False:
+                # None means stop
+                if item is None:
+                    running = False
+                    break
+                batch.append(item[0])
+                if item[1] is True:
+                    urgent = True
+                try:
+                    item = fileQueue.get_nowait()
+                except queue.Empty:
+                    item = False
+
+            # write
+            if batch:
+                outStr = "".join(batch)
+                batch = []
+                try:
+                    # the path can change when settings are reloaded
+                    if f is not None and filePath != self.__filePath:
+                        f.close()
+                        f = None
+                    # something else (eg. logrotate) may have moved the file - check once a second, it's a stat
+                    if f is not None and time.monotonic() - lastIdCheck >= self.__fileIdCheckTime:
+                        lastIdCheck = time.monotonic()
+                        try:
+                            pathStat = os.stat(filePath)
+                            moved = (pathStat.st_dev, pathStat.st_ino) != fileId
+                        except FileNotFoundError:
+                            moved = True
+                        if moved is True:
+                            f.close()
+                            f = None
+                    if f is None:
+                        filePath = self.__filePath
+                        f = open(filePath, "a")
+                        fileStat = os.fstat(f.fileno())
+                        fileSize = fileStat.st_size
+                        fileDay = time.localtime(fileStat.st_mtime)[:3]
+                        fileId = (fileStat.st_dev, fileStat.st_ino)
+
+                    # time to rotate?
+                    # a file is never rotated while empty, so one huge line can't cause a rotate every time
+                    rotate = False
+                    if fileSize > 0:
+                        if self.__fileParams["maxSize"] and fileSize + len(outStr) > self.__fileParams["maxSize"]:
+                            rotate = True
+                        elif self.__fileParams["rotateDaily"] and time.localtime()[:3] != fileDay:
+                            rotate = True
+                    if rotate is True:
+                        f.close()
+                        f = None
+                        self.__rotateFile()
+                        f = open(filePath, "a")
+                        fileStat = os.fstat(f.fileno())
+                        fileSize = fileStat.st_size
+                        fileDay = time.localtime()[:3]
+                        fileId = (fileStat.st_dev, fileStat.st_ino)
+
+                    f.write(outStr)
+                    unflushedBytes += len(outStr)
+                    fileSize += len(outStr)
+                except Exception:
+                    # try opening it again next time
+                    f = None
+                    unflushedBytes = 0
+
+            # flush
+            if f is not None and unflushedBytes > 0:
+                if urgent or running is False or unflushedBytes >= self.__fileParams["flushSize"] or time.monotonic() - lastFlush >= self.__fileParams["flushTime"]:
+                    try:
+                        f.flush()
+                    except Exception:
+                        f = None
+                    unflushedBytes = 0
+                    lastFlush = time.monotonic()
 
         # done
+        if f is not None:
+            try:
+                f.close()
+            except Exception:
+                pass
+        return
+
+    #
+    # rotation
+    # the rename is quick, and done in the writer thread so no lines go into the old file after it
+    # compression is slow on an sd card, so it gets its own thread
+    #
+    def __rotateFile(self):
+        rotatedPath = self.__filePath + "." + time.strftime("%Y%m%d-%H%M%S")
+        # more than one rotate in the same second
+        count = 1
+        while os.path.exists(rotatedPath) or os.path.exists(rotatedPath + ".gz"):
+            rotatedPath = self.__filePath + "." + time.strftime("%Y%m%d-%H%M%S") + "-" + str(count)
+            count += 1
+        try:
+            os.rename(self.__filePath, rotatedPath)
+        except OSError:
+            # keep writing to the same file, better than losing lines
+            return False
+        compressThread = threading.Thread(name='logCompressThread', target=self.__compressRotated, daemon=True)
+        compressThread.start()
+        return rotatedPath
+
+    def __compressRotated(self):
+        with self.__compressLock:
+            # compress
+            for path in self.__rotatedFiles():
+                if path.endswith(".gz"):
+                    continue
+                try:
+                    with open(path, "rb") as fIn, gzip.open(path + ".gz.tmp", "wb") as fOut:
+                        shutil.copyfileobj(fIn, fOut, 65536)
+                    os.rename(path + ".gz.tmp", path + ".gz")
+                    os.remove(path)
+                except OSError:
+                    # leave it uncompressed, it'll be tried again next rotate
+                    try:
+                        os.remove(path + ".gz.tmp")
+                    except OSError:
+                        pass
+
+            # only keep the newest
+            rotatedFiles = self.__rotatedFiles()
+            for path in rotatedFiles[:max(len(rotatedFiles) - self.__fileParams["keep"], 0)]:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return
+
+    def __rotatedFiles(self):
+        logDir, logName = os.path.split(self.__filePath)
+        prefix = logName + "."
+        rotatedFiles = []
+        try:
+            names = os.listdir(logDir or ".")
+        except OSError:
+            return rotatedFiles
+        for name in names:
+            # logFile.YYYYMMDD-HHMMSS[-n][.gz]
+            if not name.startswith(prefix) or name.endswith(".tmp"):
+                continue
+            stamp = name[len(prefix):]
+            if len(stamp) < 15 or not stamp[:8].isdigit() or stamp[8] != "-" or not stamp[9:15].isdigit():
+                continue
+            # sort by date, time, then the count for more than one in a second
+            stamp = stamp.split(".")[0].split("-")
+            count = int(stamp[2]) if len(stamp) > 2 and stamp[2].isdigit() else 0
+            rotatedFiles.append(((stamp[0], stamp[1], count), os.path.join(logDir, name)))
+        rotatedFiles.sort()
+        return [path for stamp, path in rotatedFiles]
+
+    #
+    # lines waiting for the file writer, for status
+    #
+    def queueDepth(self):
+        fileQueue = self.__fileQueue
+        if fileQueue is False:
+            return 0
+        return fileQueue.qsize()
+
+    #
+    # drain everything that's waiting, and close the file
+    #
+    def cleanup(self, timeout=2):
+        if self.__fileWriterThread is None:
+            return
+        deadline = time.monotonic() + timeout
+        fileQueue = self.__fileQueue
+        # anything from now on gets written directly
+        self.__fileQueue = False
+        try:
+            fileQueue.put(None, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            pass
+        self.__fileWriterThread.join(timeout=max(deadline - time.monotonic(), 0))
+        if self.__fileWriterThread.is_alive():
+            self.log("WARN", "logging: not everything was written to the log file in time", {"waiting": fileQueue.qsize()})
+        self.__fileWriterThread = None
+        if self.__fileDropped > 0:
+            self.log("WARN", "logging: lines were dropped because the file writer could not keep up", {"dropped": self.__fileDropped})
         return
 
     def log(self, lvl, msg, data="NoLoggingDataGiven"):
@@ -298,50 +775,314 @@ class logger:
         #  write
         #  close
 
-        # check in __levelTable
-        if lvl in self.__levelTable:
-            pass
-        else:
+        # check level is valid
+        try:
+            lvlNo = self.__levelNumbers[lvl]
+        except KeyError:
             self.log("WARN", "logging: message sent with incorrect level", {"level": lvl, "message": msg})
             return
 
-        # time
-        isoTime = datetime.datetime.now().replace(microsecond=0).isoformat()
+        # check that something wants it - the outputs or the flight recorder
+        if lvlNo < self.__minLevel:
+            return
+
+        # flight recorder - just a reference to what we've been given, nothing is formatted and there's no lock
+        recorder = self.__recorder
+        if lvlNo >= self.__recorderLevelNo and recorder is not False:
+            number = next(self.__recorderCounter)
+            recorder[number % len(recorder)] = (number, time.time(), lvl, msg, data)
+            # ERRR - something's gone badly wrong, keep what led up to it
+            if lvlNo == 4:
+                self.__errorDump()
+
+        # check that an output wants it
+        if lvlNo < self.__outputMinLevel:
+            return
 
         # format msg
         msg = format(msg)
 
-        self.__logToSysLog(lvl, msg)
-        self.__logToDisplay(isoTime, lvl, msg, data)
-        self.__logToFile(isoTime, lvl, msg, data)
+        # too many of the same?
+        if self.__rateParams is not False and self.__rateLimit(lvl, lvlNo, msg) is False:
+            return
+
+        self.__output(lvl, lvlNo, msg, data)
+        return
+
+    def __output(self, lvl, lvlNo, msg, data):
+        # time
+        isoTime = self.__getIsoTime()
+
+        # formatted data, shared by the outputs
+        dataCache = {}
+
+        self.__logToSysLog(lvl, lvlNo, msg)
+        self.__logToJournal(lvl, lvlNo, msg, data, dataCache)
+        self.__logToDisplay(isoTime, lvl, lvlNo, msg, data, dataCache)
+        self.__logToFile(isoTime, lvl, lvlNo, msg, data, dataCache)
+        return
+
+    #
+    # rate limiting
+    # each level + message has its own allowance, which goes down by one for each message
+    # and back up by rate every second, up to burst
+    # messages that come in when it's used up are counted, and reported as a summary
+    #
+    def __rateLimit(self, lvl, lvlNo, msg):
+        rateParams = self.__rateParams
+        key = (lvlNo, msg)
+        now = time.monotonic()
+        summaries = []
+        with self.__rateLock:
+            state = self.__rateState.get(key)
+            if state is None:
+                # too many different messages, report what's been missed and start again
+                if len(self.__rateState) >= rateParams["maxKeys"]:
+                    summaries = self.__takeSuppressed(now)
+                    self.__rateState.clear()
+                state = [rateParams["burst"], now, 0, now]
+                self.__rateState[key] = state
+
+            # top up the allowance
+            allowance = min(rateParams["burst"], state[0] + (now - state[1]) * rateParams["rate"])
+            state[1] = now
+            if allowance >= 1:
+                state[0] = allowance - 1
+                allowed = True
+            else:
+                state[0] = allowance
+                state[2] += 1
+                allowed = False
+            # during a storm, say how many were missed every now and then
+            # anything left when it stops is reported by flushSuppressed
+            if state[2] > 0 and now - state[3] >= rateParams["summaryTime"]:
+                summaries.append((key, state[2], now - state[3]))
+                state[2] = 0
+                state[3] = now
+
+        self.__logSuppressed(summaries)
+        return allowed
+
+    def flushSuppressed(self):
+        with self.__rateLock:
+            summaries = self.__takeSuppressed(time.monotonic())
+        self.__logSuppressed(summaries)
         return
 
-    def __logToSysLog(self, lvl, msg):
-        # sanity
-        if self.__syslogLevel == "NONE":
+    #
+    # needs __rateLock
+    def __takeSuppressed(self, now):
+        summaries = []
+        for key, state in self.__rateState.items():
+            if state[2] > 0:
+                summaries.append((key, state[2], now - state[3]))
+                state[2] = 0
+                state[3] = now
+        return summaries
+
+    def __logSuppressed(self, summaries):
+        for key, suppressed, since in summaries:
+            lvlNo, msg = key
+            self.__output(self.__levelTable[lvlNo], lvlNo, "logging: suppressed " + str(suppressed) + " similar messages", {"message": msg, "suppressed": suppressed, "seconds": round(since, 1)})
+        return
+
+    #
+    # flight recorder
+    # the ring buffer is only looked at when something goes wrong
+    #
+    def __recorderRecords(self):
+        recorder = self.__recorder
+        if recorder is False:
+            return []
+        # copying the list is atomic, then oldest first by number
+        records = [record for record in list(recorder) if record is not None]
+        records.sort(key=lambda record: record[0])
+        return records
+
+    def __errorDump(self):
+        if self.__recorderPath is False:
+            return
+        now = time.monotonic()
+        if self.__recorderLastDump is not None and now - self.__recorderLastDump < self.__recorderParams["minInterval"]:
             return
+        self.__recorderLastDump = now
+        self.dumpFlightRecorder("ERRR")
+        return
+
+    def dumpFlightRecorder(self, reason="requested", wait=False):
+        if self.__recorder is False or self.__recorderPath is False:
+            return False
+        # take a copy now, so the dump is what happened up to here
+        records = self.__recorderRecords()
+        if wait is True:
+            return self.__writeFlightRecorder(records, reason)
+        dumpThread = threading.Thread(name='flightRecorderDumpThread', target=self.__writeFlightRecorder, args=(records, reason), daemon=True)
+        dumpThread.start()
+        return True
+
+    def __writeFlightRecorder(self, records, reason):
+        path = self.__recorderPath + "-" + time.strftime("%Y%m%d-%H%M%S") + ".log"
+        try:
+            with open(path, "a") as f:
+                f.write("# flight recorder dump - " + reason + " - " + str(len(records)) + " messages\n")
+                for number, recordTime, lvl, msg, data in records:
+                    outStr = datetime.datetime.fromtimestamp(recordTime).isoformat(timespec="milliseconds") + " [" + lvl + "] " + format(msg)
+                    if data != "NoLoggingDataGiven":
+                        outStr += " - " + self.__dataFormat("file", data, {})
+                    f.write(outStr + "\n")
+        except Exception as e:
+            self.__output("WARN", self.__levelNumbers["WARN"], "logging: unable to write flight recorder dump", {"path": path, "error": e})
+            return False
+
+        # only keep the newest
+        logDir, prefix = os.path.split(self.__recorderPath)
+        prefix += "-"
+        try:
+            dumps = sorted(name for name in os.listdir(logDir or ".") if name.startswith(prefix) and name.endswith(".log"))
+            for name in dumps[:max(len(dumps) - self.__recorderParams["keep"], 0)]:
+                os.remove(os.path.join(logDir, name))
+        except OSError:
+            pass
+        self.__output("NOTE", self.__levelNumbers["NOTE"], "logging: flight recorder dumped", {"path": path, "reason": reason, "messages": len(records)})
+        return True
+
+    #
+    # unhandled exceptions
+    # main thread and other threads have different hooks, the old ones are still run afterwards
+    #
+    def __installExceptHooks(self):
+        oldExceptHook = sys.excepthook
+        oldThreadingExceptHook = threading.excepthook
+
+        def exceptHook(excType, excValue, excTraceback):
+            if not issubclass(excType, (KeyboardInterrupt, SystemExit)):
+                self.__logUnhandled(threading.current_thread().name, excType, excValue, excTraceback)
+            oldExceptHook(excType, excValue, excTraceback)
+
+        def threadingExceptHook(args):
+            if not issubclass(args.exc_type, SystemExit):
+                threadName = args.thread.name if args.thread is not None else "unknown"
+                self.__logUnhandled(threadName, args.exc_type, args.exc_value, args.exc_traceback)
+            oldThreadingExceptHook(args)
+
+        sys.excepthook = exceptHook
+        threading.excepthook = threadingExceptHook
+        return
+
+    def __logUnhandled(self, threadName, excType, excValue, excTraceback):
+        # stop the ERRR doing its own dump in a thread - the program might be about to end
+        self.__recorderLastDump = time.monotonic()
+        self.log("ERRR", "Unhandled exception", {"thread": threadName, "type": excType.__name__, "error": str(excValue), "traceback": "".join(traceback.format_tb(excTraceback))})
+        self.dumpFlightRecorder("unhandled exception in " + threadName, wait=True)
+        return
+
+    #
+    # timestamp, made at most once a second
+    def __getIsoTime(self):
+        second = int(time.time())
+        if second != self.__isoSecond:
+            self.__isoTime = datetime.datetime.fromtimestamp(second).isoformat()
+            self.__isoSecond = second
+        return self.__isoTime
+
+    def isEnabledFor(self, lvl):
+        return self.__levelNumbers.get(lvl, -1) >= self.__minLevel
 
+    #
+    # set the level for an output
+    # the level numbers are worked out here so log() doesn't have to
+    def __setLevel(self, destination, level):
+        levelNo = self.__levelNumbers[level]
+        if level == "NONE":
+            levelNo = self.__levelOff
+        if destination == "syslog":
+            self.__syslogLevel = level
+            self.__syslogLevelNo = levelNo
+        elif destination == "display":
+            self.__displayLevel = level
+            self.__displayLevelNo = levelNo
+        elif destination == "file":
+            self.__fileLevel = level
+            self.__fileLevelNo = levelNo
+        elif destination == "journal":
+            self.__journalLevel = level
+            self.__journalLevelNo = levelNo
+        self.__outputMinLevel = min(self.__syslogLevelNo, self.__displayLevelNo, self.__fileLevelNo, self.__journalLevelNo)
+        self.__minLevel = min(self.__outputMinLevel, self.__recorderLevelNo)
+        return
+
+    def __setRecorderLevel(self, levelNo):
+        self.__recorderLevelNo = levelNo
+        self.__minLevel = min(self.__outputMinLevel, self.__recorderLevelNo)
+        return
+
+    def __logToSysLog(self, lvl, lvlNo, msg):
         # level compare
-        if self.__checkLevel("syslog", lvl) is False:
+        if lvlNo < self.__syslogLevelNo:
             return
 
         # make a string
         outStr = "[" + lvl + "] " + msg
-        # open / write / close
-        syslog.openlog(ident="diyac", logoption=syslog.LOG_PID)
+        # write - it was opened in __init__
         syslog.syslog(self.__syslogLevelConversion[lvl], outStr)
-        syslog.closelog()
 
         # done
         return
 
-    def __logToDisplay(self, isoTime, lvl, msg, data):
-        # sanity
-        if self.__displayLevel == "NONE":
+    def __logToJournal(self, lvl, lvlNo, msg, data, dataCache):
+        # level compare
+        if lvlNo < self.__journalLevelNo:
             return
 
+        # the basics
+        fields = [
+            self.__journalField("MESSAGE", "[" + lvl + "] " + msg),
+            self.__journalField("PRIORITY", str(self.__syslogLevelConversion[lvl])),
+            self.__journalField("SYSLOG_IDENTIFIER", "diyac"),
+            self.__journalField("LEVEL", lvl)
+        ]
+
+        # structured fields from the data, redacted for the journal
+        if data != "NoLoggingDataGiven":
+            fields.append(self.__journalField("DATA", self.__dataFormat("journal", data, dataCache)))
+            if isinstance(data, dict):
+                redactKeys = self.__redactKeys["journal"]
+                for key in self.__journalFields:
+                    if key in data:
+                        if key in redactKeys:
+                            value = self.__redactWord
+                        else:
+                            value = format(data[key])
+                        fields.append(self.__journalField(self.__journalFields[key], value))
+
+        # send - if journald has restarted, connect again and have one more go
+        packet = b"".join(fields)
+        for attempt in range(2):
+            journalSocket = self.__journalSocket
+            if journalSocket is False:
+                return
+            try:
+                journalSocket.send(packet)
+                return
+            except OSError:
+                self.__closeJournal()
+                self.__connectJournal()
+        return
+
+    #
+    # journald native format
+    #  KEY=value\n - or if the value has a newline in it
+    #  KEY\n, 64 bit little endian length, value, \n
+    #
+    def __journalField(self, name, value):
+        value = value.encode("utf-8", "replace")
+        if b"\n" in value:
+            return name.encode() + b"\n" + struct.pack("<Q", len(value)) + value + b"\n"
+        return name.encode() + b"=" + value + b"\n"
+
+    def __logToDisplay(self, isoTime, lvl, lvlNo, msg, data, dataCache):
         # level compare
-        if self.__checkLevel("display", lvl) is False:
+        if lvlNo < self.__displayLevelNo:
             return
 
         # make output string
@@ -349,13 +1090,12 @@ class logger:
 
         # pretty-up the data and put into output string - if it's there
         if data != "NoLoggingDataGiven":
-            data = self.__dataFormat("display", data)
+            data = self.__dataFormat("display", data, dataCache)
             outStr += " - " + data
 
         # apply colour
         if self.__displayColour is True:
-            iln = self.__inList(lvl, self.__levelTable)  # just to make the next line not horribly long
-            colStr = self.__ansiEscape + self.__colourLookup[iln]["style"] + ";" + self.__colourLookup[iln]["colour"] + ";" + self.__colourLookup[iln]["bg"] + "m"
+            colStr = self.__ansiEscape + self.__colourLookup[lvlNo]["style"] + ";" + self.__colourLookup[lvlNo]["colour"] + ";" + self.__colourLookup[lvlNo]["bg"] + "m"
             outStr = colStr + outStr + self.__ansiEscape + "0;0;0m"
 
         # do an output
@@ -364,13 +1104,9 @@ class logger:
         # done
         return
 
-    def __logToFile(self, isoTime, lvl, msg, data):
-        # sanity
-        if self.__fileLevel == "NONE":
-            return
-
+    def __logToFile(self, isoTime, lvl, lvlNo, msg, data, dataCache):
         # level compare
-        if self.__checkLevel("file", lvl) is False:
+        if lvlNo < self.__fileLevelNo:
             return
 
         # make output string
@@ -378,10 +1114,19 @@ class logger:
 
         # pretty-up the data and put into output string - if it's there
         if data != "NoLoggingDataGiven":
-            data = self.__dataFormat("file", data)
+            data = self.__dataFormat("file", data, dataCache)
             outStr += " - " + data
 
-        # do an output
+        # give it to the writer thread, never wait for it
+        fileQueue = self.__fileQueue
+        if fileQueue is not False:
+            try:
+                fileQueue.put_nowait((outStr + "\n", lvlNo >= self.__levelNumbers["NOTE"]))
+            except queue.Full:
+                self.__fileDropped += 1
+            return
+
+        # no writer thread - do an output
         try:
             f = open(self.__filePath, "a")
             f.write(outStr + "\n")
@@ -390,84 +1135,45 @@ class logger:
             pass
 
     #
-    # see if the incoming message is of sufficient level to log
+    # work out the keys to redact for each output, once
+    # global keys plus the output's own keys
     #
-    def __checkLevel(self, destination, incomingLevel):
-        # syslog
-        if destination == "syslog":
-            currentLevelNumber = self.__inList(self.__syslogLevel, self.__levelTable)
-        # display
-        elif destination == "display":
-            currentLevelNumber = self.__inList(self.__displayLevel, self.__levelTable)
-        # file
-        elif destination == "file":
-            currentLevelNumber = self.__inList(self.__fileLevel, self.__levelTable)
-        # sanity check
-        else:
-            return False
-
-        # get number for incoming
-        incomingLevelNumber = self.__inList(incomingLevel, self.__levelTable)
-
-        # compare
-        if incomingLevelNumber >= currentLevelNumber:
-            return True
-        # done, and we don't want to log the message to this destination
-        else:
-            return False
-
-    def __dataRedact(self, redactList, data):
-        redactWord = "-REDACTED-"
-        for redactKey in redactList:
-            regex = r"\"" + redactKey + r"\":\s\"([^\"]+)\""
-            subst = "\"" + redactKey + "\": \"" + redactWord + "\""
-            data = re.sub(regex, subst, data)
-        return data
+    def __setRedactKeys(self):
+        redactKeys = {"display": frozenset(), "file": frozenset(), "journal": frozenset()}
+        loggingConfig = self.__settings.config.logging
+        globalKeys = loggingConfig.redact or frozenset()
+        for destination in redactKeys:
+            redactKeys[destination] = globalKeys | (getattr(loggingConfig, destination).redact or frozenset())
+        self.__redactKeys = redactKeys
+        return
 
     #
-    # format data into a nice string
-    #  TODO
-    #  redact things should happen here
+    # go through the data and replace the value of any key in redactKeys
+    # works on nested dicts and lists, and on any type of value
+    # makes copies, the caller's data is not changed
     #
-    def __dataFormat(self, destination, data):
-        if destination == "display" or destination == "file":
-            try:
-                data = json.dumps(data)
-                loggingSetting = self.__settings.allSettings.get("logging")
-                # If there is a logging section in settings...
-                if loggingSetting:
-                    redactList = self.__settings.allSettings["logging"].get("redact")
-                    # If there is a global redact list apply it
-                    if redactList:
-                        data = self.__dataRedact(redactList, data)
-
-                    destSetting = self.__settings.allSettings["logging"].get(destination)
-                    if destSetting:
-                        redactList = destSetting.get("redact")
-                        # If destination redact list exists, apply it
-                        if redactList:
-                            data = self.__dataRedact(redactList, data)
-            except:
-                data = format(data)
-        else:
-            self.log("WARN", "Logging - Unable to format data - destination not specified")
-            return False
+    def __dataRedact(self, redactKeys, data):
+        if isinstance(data, dict):
+            return {k: (self.__redactWord if k in redactKeys else self.__dataRedact(redactKeys, v)) for k, v in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [self.__dataRedact(redactKeys, v) for v in data]
         return data
 
     #
-    # helper function
-    #  returns false if not in list
-    #  returns index if it is in the list
-    def __inList(self, needle, haystack):
-        # do some checking
-        if needle in haystack:
-            # loop through
-            i = 0
-            for x in haystack:
-                if x == needle:
-                    return i
-                else:
-                    i += 1
-        else:
-            # needle is not in haystack
-            return False
+    # format data into a nice string
+    #  outputs with the same redact keys share the same string
+    #  so it's only made once per message (per set of redact keys)
+    #
+    def __dataFormat(self, destination, data, dataCache):
+        redactKeys = self.__redactKeys[destination]
+        if redactKeys in dataCache:
+            return dataCache[redactKeys]
+        # only the redacted copy is ever formatted, so a value json can't do can't leak anything
+        if redactKeys:
+            data = self.__dataRedact(redactKeys, data)
+        try:
+            formatted = json.dumps(data, default=str)
+        except Exception:
+            formatted = format(data)
+        dataCache[redactKeys] = formatted
+        return formatted
@@ -1,65 +1,147 @@
 #!/usr/bin/env python
 import time
 import sys  # for nice exit
-import subprocess
 import os  # used for systemd related ops
+import threading  # for the reload lock
+
+# for measuring time to ready
+startTime = time.monotonic()
+
+# shutdown deadlines, in seconds - all of it has to fit in TimeoutStopSec (see diyac.service_example)
+shutdownTime = 4
+shutdownDoorTime = 2
+
+# a reload can come from SIGHUP or the control socket
+reloadLock = threading.Lock()
 
 
 #
 # file synopsis
 #
 # cleanup
+# function: __timeLeft(deadline)
 # nice exit
 # function: init() - main script initialisation
-#  settings
 #  logger
-#  gpio
+#  start connecting to pigpiod
+#  settings
 #  tokens
+#  metrics
+#  audit
+#  status
 #  pins
+#  wait for pigpiod
 #  out
 #  in
+#  control socket
+#  metrics endpoint
 #  bind gpio callbacks
-#  start iwegand
+#  start pigpiod connection supervisor
+# function: __registerCallbacks()
+# function: __pigpioReconnected(newPi)
 # function: keepalive()
+# function: __getStatus()
+# function: __publishStatus()
+# functions: control socket commands
 # function: __cbf(gpio, level, tick)
-# some code to actually run the program
+# some code to actually run the program, if not imported
 
 
 #
 # cleanup
 # makes things clean at exit
+# each step has a deadline, so it's all done well inside systemd's TimeoutStopSec
+#  stop taking input
+#  let an open door or a playing pattern finish, or cut them short
+#  write out what the audit handler and logger have waiting
+#  release gpio resources
 #
 def cleanup():
+    global __flagExit
+    __flagExit = True
+    shutdownStart = time.monotonic()
+    shutdownDeadline = shutdownStart + shutdownTime
+
     # log
     l.log("DBUG", "cleanup started")
 
-    # close the door
+    # no more input
+    try:
+        inH.stop()
+    except Exception as e:
+        l.log("WARN", "Unable to stop input handling", e)
+    try:
+        control.cleanup()
+    except Exception as e:
+        l.log("WARN", "Unable to stop control socket", e)
     try:
-        outH.setDoor("closed")
+        metrics.cleanup()
     except Exception as e:
-        l.log("WARN", "Unable to close the door", e)
+        l.log("WARN", "Unable to stop metrics endpoint", e)
 
-    # turn off the active led
+    # close the door, stop any pattern, turn off the active led
     try:
-        outH.switchPiActiveLed("off")
+        outputs = outH.shutdown(min(shutdownDoorTime, __timeLeft(shutdownDeadline)))
+        l.log("DBUG", "Outputs shut down", outputs)
     except Exception as e:
-        l.log("WARN", "Unable to turn off active led", e)
+        l.log("WARN", "Unable to shut down outputs", e)
+
+    # write out anything the audit handler and logger still have waiting
+    # the logger goes last, anything logged after it goes straight to the file
+    try:
+        audit.cleanup(__timeLeft(shutdownDeadline) / 2)
+    except Exception as e:
+        l.log("WARN", "Unable to finish writing the audit database", e)
+    l.log("DBUG", "cleanup done")
+    l.cleanup(__timeLeft(shutdownDeadline))
 
     # release gpio resources
+    # stop the supervisor first, or it will see this as an outage
     try:
+        piH.stopSupervisor()
         pi.stop()
     except Exception as e:
         l.log("WARN", "Unable to stop PiGPIO conenction", e)
         pass
 
+    l.log("NOTE", "DIYAC stopped", {"shutdownTime": round(time.monotonic() - shutdownStart, 3)})
+
     # done
     return
 
 
+def __timeLeft(deadline):
+    return max(deadline - time.monotonic(), 0)
+
+
 # SIGHUP handler
-# to reload tokens
+# to reload settings and tokens
+# only the sections that have changed are given to the handlers
+# if settings.json has errors, or changes that need a restart, the old settings are kept
+# returns the sections that changed, or False
 def sigHup_callback():
-    tokens.getAllowedTokens()
+    with reloadLock:
+        reloadStart = time.perf_counter()
+        changed = s.reload()
+        if changed is not False:
+            if "logging" in changed:
+                l.loadSettings()
+            if "inputHandling" in changed:
+                inH.loadSettings()
+            if "outputHandling" in changed:
+                outH.loadSettings()
+            if "status" in changed:
+                status.loadSettings()
+            l.log("NOTE", "settings reloaded", {"changed": changed})
+        tokens.getAllowedTokens()
+        metrics.observe("diyac_reload_seconds", time.perf_counter() - reloadStart)
+    return changed
+
+
+# SIGUSR1 handler
+# to dump the logger's flight recorder
+def __sigUsr1_callback():
+    l.dumpFlightRecorder("SIGUSR1")
     return
 
 
@@ -67,13 +149,11 @@ def sigHup_callback():
 # initialisation
 #
 def __init():
+    # only import what's needed to get logging and the pigpiod connection going
+    # the rest are imported as they're needed
     import logging  # our own logging module
-    import outputHandler
-    import tokenHandler  # our ouwn token hangling module
-    import settingsHandler
-    import pinDef  # our own pin definition module
     import systemHandler
-    import inputHandler  # our own input handling module
+    import pigpioHandler  # our own pigpiod connection module
     try:
         import pigpio
     except ImportError:
@@ -110,113 +190,281 @@ def __init():
     sysH.setup("sigInt", runQuit=True)
     sysH.setup("sigTerm", runQuit=True)
     sysH.setup("sigHup", sigHup_callback, runQuit=False)
+    sysH.setup("sigUsr1", __sigUsr1_callback)
     sysH.setup("quit", cleanup)
 
-    # get all the settings
+    # connect to pigpiod in the background
+    # pigpiod is started by systemd before us (see diyac.service), so just connect to it
+    # rather than asking systemctl - retries cover it still starting up after a power blip
+    global piH
+    piH = pigpioHandler.pigpioHandler(sysH, l)
+    del pigpioHandler
+    piH.connectInBackground()
+
+    # while that's happening, get all the settings
+    import settingsHandler
+    global s
     s = settingsHandler.settingsHandler(sysH, l)
     del settingsHandler
 
     # update the logger with new settings
     l.loadSettings(s)
 
-    # see if pigpiod is running
-    # if not running
-    #  try to start
-    #  check again
-    #  if not running
-    #   exit
-    # pigpiod.pi()
-    # if not connected
-    #  exit
-    stat = subprocess.call("systemctl status pigpiod > /dev/null", shell=True)
-    if stat != 0:
-        l.log("WARN", "PIGPIOD is not running, will try to start")
-        subprocess.call("sudo systemctl start pigpiod > /dev/null", shell=True)
-        stat = subprocess.call("service pigpiod status > /dev/null", shell=True)
-        if stat != 0:
-            l.log("ERRR", "Unable to start pigpiod daemon")
-            sysH.quit(code=1, status="Fail - PIGPIO not started and unable to start")
-        else:
-            l.log("INFO", "Starting pigpiod daemon successful")
-    global pi
-    pi = pigpio.pi()
-    if not pi.connected:
-        l.log("ERRR", "PiGPIO - Unable to connect")
-        sysH.quit(code=1, status="Failed - unable to connect to PIGPIOD")
-
     # set tokens
+    import tokenHandler  # our ouwn token hangling module
     global tokens
     tokens = tokenHandler.tokenHandler(sysH, s, l)
     del tokenHandler
 
+    # metrics - counting starts now, the endpoint once everything is there
+    import metricsHandler  # our own metrics module
+    global metrics
+    metrics = metricsHandler.metricsHandler(sysH, s, l)
+    del metricsHandler
+
+    # access decisions audit database
+    import auditHandler  # our own audit module
+    global audit
+    audit = auditHandler.auditHandler(sysH, s, l)
+    del auditHandler
+
+    # control socket - commands are added once everything is there
+    import controlHandler  # our own control socket module
+    global control
+    control = controlHandler.controlHandler(sysH, s, l)
+    del controlHandler
+
+    # status for systemd and monitoring
+    import statusHandler  # our own status module
+    global status
+    status = statusHandler.statusHandler(sysH, s, l)
+    del statusHandler
+
     # pin definitions
+    import pinDef  # our own pin definition module
     global p
     p = pinDef.pinDef(sysH, s, l)
     del pinDef
 
+    # now we need pigpiod
+    global pi
+    pi = piH.waitForConnection()
+    if pi is False:
+        sysH.quit(code=1, status="Failed - unable to connect to PIGPIOD")
+
     # output handler (settings, logger, gpio, pins
+    import outputHandler
     global outH
     outH = outputHandler.outputHandler(sysH, s, l, pi, p)
     del outputHandler
 
     # Input handler
+    import inputHandler  # our own input handling module
     global inH
-    inH = inputHandler.inputHandler(sysH, s, l, tokens, outH, pi, p)
+    inH = inputHandler.inputHandler(sysH, s, l, tokens, outH, pi, p, audit, metrics)
     del inputHandler
 
-    time.sleep(0.1)
+    # control socket
+    control.addCommand("openDoor", __controlOpenDoor, "open the door, like an allowed token")
+    control.addCommand("addToken", __controlAddToken, "allow a token - token, type (card|code), user")
+    control.addCommand("revokeToken", __controlRevokeToken, "stop allowing a token - token, type (card|code)")
+    control.addCommand("clearLockout", __controlClearLockout, "end a lockout now")
+    control.addCommand("reload", __controlReload, "reload settings and tokens, like SIGHUP")
+    control.addCommand("stats", __controlStats, "the same as the status file, but right now")
+    control.addCommand("decisions", __controlDecisions, "recent access decisions, newest last - [count]")
+    control.start()
+
+    # metrics endpoint
+    metrics.addGauge("diyac_log_queue_depth", "Log lines waiting to be written to the log file", l.queueDepth)
+    metrics.addGauge("diyac_audit_queue_depth", "Access decisions waiting to be written to the audit database", audit.queueDepth)
+    metrics.addGauge("diyac_tokens", "Allowed tokens", tokens.tokenCount)
+    metrics.start()
+
+    # gpio callbacks
+    # changes found by inH.reconcileInputs go the same way
+    inH.setMissedInputCallback(__callbackInput)
+    __registerCallbacks()
+
+    # look after the pigpiod connection from now on
+    piH.onReconnect(__pigpioReconnected)
+    piH.startSupervisor()
+
+    # state ready
+    sysH.notifyUp("READY=1")
+    readyTime = round(time.monotonic() - startTime, 3)
+    sysH.notifyUp("STATUS=Running - ready in " + str(readyTime) + "s")
+    l.log("NOTE", "DIYAC running", {"runMode": runMode, "timeToReady": readyTime})
+    import getpass
+    l.log("DBUG", "Running program as user", getpass.getuser())
+
+
+#
+# register callbacks for GPI and GPO pins
+# done at startup, and again after a pigpiod reconnect
+def __registerCallbacks():
+    import pigpio  # already imported in __init
 
     # register these GPI pins to run __cbf on rising or falling edge
     for pin in p.pins["input"]:
         pi.callback(p.pins[pin], pigpio.EITHER_EDGE, __callbackInput)
 
     # register these GPO pins to run __cbf on rising or falling edge
+    # not piActiveLed - it's flashed by the heartbeat and really clogs up the log
     for pin in p.pins["output"]:
+        if pin == "piActiveLed":
+            continue
         pi.callback(p.pins[pin], pigpio.EITHER_EDGE, __callbackOutput)
+    return
 
-    # state ready
-    sysH.notifyUp("READY=1")
-    sysH.notifyUp("STATUS=Running")
-    l.log("NOTE", "DIYAC running", runMode)
-    import getpass
-    l.log("DBUG", "Running program as user", getpass.getuser())
+
+#
+# pigpiod has come back after going away
+# everything that was registered with the old connection has to be done again
+def __pigpioReconnected(newPi):
+    global pi
+    pi = newPi
+    outH.reconnect(pi)
+    inH.reconnect(pi)
+    __registerCallbacks()
+    return
 
 
 def __keepAlive():
-    keepAliveCounter = 0
+    # no more than half of WatchdogSec (see diyac.service_example), so a slow pass round the loop doesn't trip it
+    keepAliveTime = 5
+    # read back outputs and inputs every minute
+    resyncLoops = 60 // keepAliveTime
+    resyncCounter = 0
+    sysH.registerLoop("main", keepAliveTime * 2)
+    healthy = True
     # GO!
     while 1:
-        # wait
-        time.sleep(1)
-        # flash
-        outH.switchPiActiveLed()
-        # hit the systemd watchdog every 10 seconds
-        if keepAliveCounter == 10:
+        # cleanup is running in another thread, leave everything to it
+        if __flagExit is True:
+            sysH.disarmStackDump()
+            time.sleep(keepAliveTime)
+            continue
+
+        # if this pass doesn't finish, dump every thread's stack before systemd kills us
+        # keepAliveTime * 2 is before WatchdogSec runs out after the last hit
+        sysH.armStackDump(keepAliveTime * 2)
+
+        # flash - pigpiod keeps the led going for a bit longer than we sleep for
+        # if this loop stops, or anything else has stalled, the led stops
+        if healthy is True:
+            outH.heartbeat(keepAliveTime * 1.5)
+        # wait, and see how late we wake up
+        sleepStart = time.monotonic()
+        time.sleep(keepAliveTime)
+        lag = time.monotonic() - sleepStart - keepAliveTime
+        sysH.loopAlive("main", lag)
+        if lag > 1:
+            l.log("WARN", "Main loop woke up late", {"lag": round(lag, 3)})
+        # hit the systemd watchdog every keepAliveTime - but only if every critical loop has reported in
+        healthy = sysH.checkLoops()
+        if healthy is True:
             # l.log("DBUG", "Bopity - Program still running OK")
             sysH.notifyUp("WATCHDOG=1")
-            keepAliveCounter = 1
+        l.log("DBUG", "Loop stats", sysH.getLoopStats())
+        # report any log storms that have finished
+        l.flushSuppressed()
+        # let systemd and anything else watching know how things are going
+        __publishStatus()
+        # read the outputs back every minute, in case something changed them without telling us
+        # and the inputs, in case a callback was missed
+        if resyncCounter == resyncLoops:
+            outH.resyncOutputs()
+            inH.reconcileInputs()
+            resyncCounter = 1
         else:
-            keepAliveCounter += 1
+            resyncCounter += 1
+    return
+
+
+#
+# gather up the status from everything
+# it's all kept in memory, so this is quick
+def __getStatus():
+    loops = sysH.getLoopStats()
+    stats = inH.getStats()
+    stats.update({
+        "tokens": tokens.tokenCount(),
+        "logQueue": l.queueDepth(),
+        "auditQueue": audit.queueDepth(),
+        "loopLag": loops["main"]["lag"] if "main" in loops else None,
+        "loops": loops,
+        "signals": sysH.getSignalStats(),
+        "control": control.getStats()
+    })
+    return stats
+
+
+#
+# and publish it
+def __publishStatus():
+    try:
+        status.publish(__getStatus())
+    except Exception as e:
+        l.log("WARN", "Unable to publish status", e)
     return
 
 
+#
+# control socket commands
+# each gets the request, and returns the result - ValueError for a bad request
+# they're run in the control socket's threads
+def __controlOpenDoor(request):
+    doorOpened = outH.openDoor()
+    l.log("INFO", "ACCESS ALLOWED BY CONTROL SOCKET", {"doorOpened": doorOpened})
+    audit.record("allowed", "control", detail=None if doorOpened is True else {"doorOpened": False})
+    metrics.inc("diyac_access_decisions_total", (("outcome", "allowed"), ("reason", "control"), ("type", None)))
+    return {"opened": doorOpened}
+
+
+def __controlAddToken(request):
+    return tokens.addToken(request.get("token"), request.get("type"), request.get("user"))
+
+
+def __controlRevokeToken(request):
+    return tokens.revokeToken(request.get("token"), request.get("type"))
+
+
+def __controlClearLockout(request):
+    cleared = inH.clearLockout()
+    if cleared is True:
+        l.log("NOTE", "Lockout cleared by control socket")
+    return {"cleared": cleared}
+
+
+def __controlReload(request):
+    return {"changed": sigHup_callback()}
+
+
+def __controlStats(request):
+    return __getStatus()
+
+
+def __controlDecisions(request):
+    count = request.get("count", 20)
+    if isinstance(count, bool) or not isinstance(count, int):
+        raise ValueError("count should be a whole number")
+    return inH.recentDecisions(count)
+
+
 #
 # callback function that is hit whenever the GPIO changes
 def __callbackGeneral(gpio, level, tick, inputOutput):
-    # log
     # see if we know which pin it is
-    logData = {"gpio": gpio, "level": level}
-    for pin in p.pins[inputOutput]:
-        if p.pins[pin] == gpio:
-            logData["name"] = pin
-            # Break out of the for loop as soon as we've found it (if we find it)
-            break
-    if inputOutput == "input":
-        logMsg = "GPI Change"
-    else:
-        logMsg = "GPO Change"
-    l.log("DBUG", logMsg, logData)
-    return logData["name"]
+    gpioName = p.gpioLookup.get(gpio, (None, None))[0]
+    metrics.inc("diyac_gpio_edges_total", (("pin", gpioName if gpioName is not None else gpio),))
+    # log - but don't bother making the data if DBUG isn't going anywhere
+    if l.isEnabledFor("DBUG"):
+        if inputOutput == "input":
+            logMsg = "GPI Change"
+        else:
+            logMsg = "GPO Change"
+        l.log("DBUG", logMsg, {"gpio": gpio, "level": level, "name": gpioName})
+    return gpioName
 
 
 #
@@ -230,9 +478,6 @@ def __callbackInput(gpi, level, tick):
 #
 # callback function that is hit whenever the GPO changes
 def __callbackOutput(gpo, level, tick):
-    if gpo == p.pins["piActiveLed"]:
-        # Do nothing with piActiveLed - as it really clogs up the log
-        return
     gpoName = __callbackGeneral(gpo, level, tick, "output")
 
     outH.gpoCallback(gpo, level, tick, gpoName)
@@ -240,10 +485,11 @@ def __callbackOutput(gpo, level, tick):
 
 #
 # Let's start doing things
+# not when imported - benchmark.py imports main to time the callbacks
 #
+if __name__ == "__main__":
+    # run initialisation
+    __init()
 
-# run initialisation
-__init()
-
-# Keep the program running to wait for callbacks
-__keepAlive()
+    # Keep the program running to wait for callbacks
+    __keepAlive()
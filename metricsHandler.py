@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+import threading
+import http.server  # for the metrics endpoint
+
+#
+# Metrics Handler
+#
+# Description:
+#  counters and histograms, served over http in the prometheus text format (GET /metrics)
+#  counting is always on, it's cheap - the endpoint is only there if metrics.port is set
+#  counting must not slow down gpio callbacks, so there are no locks when counting
+#   each thread has its own counters, only that thread writes to them
+#   a scrape copies them (a dict copy is atomic) and adds them up
+#   counters from threads that have finished are added into __finished, so they don't go backwards
+#    done whenever a new thread starts counting, as well as on a scrape, so short lived threads don't pile up with no scraper
+#  gauges are functions, run when scraped
+#
+# Variables:
+#  __params - dict
+#   address - str - address to listen on, local only by default
+#   port - int - port to listen on, None for no endpoint
+#  __metrics - dict - name: (type, help) - every counter and histogram
+#  __buckets - dict - histogram name: upper bounds, in seconds
+#  __local - threading.local - this thread's counters
+#  __threadCounts - list - (thread, counters) for every thread that has counted something
+#  __finished - dict - counters from threads that have finished
+#  __gauges - dict - name: (help, func)
+#  __server - http.server.ThreadingHTTPServer - False if not running
+#
+# Functions:
+#
+#  __init__(systemHandler, settings, logger)
+#   get settings
+#
+#  inc(name, [labels], [amount])
+#   add to a counter - labels is a tuple of (label, value) pairs
+#
+#  observe(name, value, [labels])
+#   add a value to a histogram
+#
+#  addGauge(name, help, func)
+#   func is run on each scrape, and returns a number
+#
+#  __counts()
+#   this thread's counters, made the first time a thread counts something
+#
+#  __mergeFinished()
+#   add the counters of finished threads into __finished, and forget the threads - with __threadCountsLock held
+#
+#  __collect()
+#   add up every thread's counters
+#
+#  render()
+#   everything in the prometheus text format
+#
+#  __labelString(labels)
+#   labels as {label="value",...}, escaped
+#
+#  __number(value)
+#   a value as prometheus wants it
+#
+#  start()
+#   start the endpoint, if metrics.port is set
+#
+#  cleanup()
+#   stop the endpoint
+#
+
+
+class metricsHandler:
+    __params = {
+        "address": "127.0.0.1",
+        "port": None
+    }
+    __metrics = {
+        "diyac_access_decisions_total": ("counter", "Access decisions, by outcome, reason and token type"),
+        "diyac_lockouts_total": ("counter", "Lockouts started, by method"),
+        "diyac_wiegand_frames_total": ("counter", "Wiegand frames read, by bit length"),
+        "diyac_wiegand_parity_errors_total": ("counter", "Wiegand card frames with a parity error, by bit length"),
+        "diyac_gpio_edges_total": ("counter", "GPIO level changes, by pin name"),
+        "diyac_decision_seconds": ("histogram", "Time to make an access decision"),
+        "diyac_reload_seconds": ("histogram", "Time to reload settings and tokens")
+    }
+    __buckets = {
+        "diyac_decision_seconds": [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1],
+        "diyac_reload_seconds": [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+    }
+    __server = False
+
+    def __init__(self, systemHandler, settings, logger):
+        # internalise the stuff
+        self.__systemHandler = systemHandler
+        del systemHandler
+        self.__settings = settings
+        del settings
+        self.__logger = logger
+        del logger
+        self.__local = threading.local()
+        self.__threadCounts = []
+        self.__threadCountsLock = threading.Lock()
+        self.__finished = {}
+        self.__gauges = {}
+
+        # get settings - they've been checked already, None if not set
+        metricsConfig = self.__settings.config.metrics
+        params = dict(metricsHandler.__params)
+        for param in params:
+            if getattr(metricsConfig, param) is not None:
+                params[param] = getattr(metricsConfig, param)
+        self.__params = params
+        return
+
+    #
+    # counting - no locks, see the description
+    #
+    def __counts(self):
+        counts = getattr(self.__local, "counts", None)
+        if counts is None:
+            counts = {}
+            self.__local.counts = counts
+            # only the first time for each thread
+            with self.__threadCountsLock:
+                self.__mergeFinished()
+                self.__threadCounts.append((threading.current_thread(), counts))
+        return counts
+
+    def __mergeFinished(self):
+        alive = []
+        for thread, counts in self.__threadCounts:
+            if thread.is_alive():
+                alive.append((thread, counts))
+                continue
+            for key, value in counts.copy().items():
+                self.__finished[key] = self.__finished.get(key, 0) + value
+        self.__threadCounts = alive
+        return
+
+    def inc(self, name, labels=(), amount=1):
+        counts = self.__counts()
+        key = (name, labels)
+        counts[key] = counts.get(key, 0) + amount
+        return
+
+    def observe(self, name, value, labels=()):
+        counts = self.__counts()
+        buckets = self.__buckets[name]
+        # buckets are not cumulative here, they're added up on a scrape
+        bucket = len(buckets)
+        for i in range(len(buckets)):
+            if value <= buckets[i]:
+                bucket = i
+                break
+        key = (name, labels, bucket)
+        counts[key] = counts.get(key, 0) + 1
+        key = (name, labels, "sum")
+        counts[key] = counts.get(key, 0) + value
+        return
+
+    def addGauge(self, name, help, func):
+        self.__gauges[name] = (help, func)
+        return
+
+    #
+    # scraping
+    #
+    def __collect(self):
+        total = {}
+        with self.__threadCountsLock:
+            # counters from finished threads are kept, the threads aren't
+            self.__mergeFinished()
+            for key, value in self.__finished.items():
+                total[key] = value
+            for thread, counts in self.__threadCounts:
+                for key, value in counts.copy().items():
+                    total[key] = total.get(key, 0) + value
+        return total
+
+    def render(self):
+        total = self.__collect()
+        lines = []
+        for name, (metricType, help) in self.__metrics.items():
+            lines.append("# HELP " + name + " " + help)
+            lines.append("# TYPE " + name + " " + metricType)
+            if metricType == "counter":
+                # label values can be any type, so they're sorted as text
+                for key in sorted((k for k in total if k[0] == name), key=str):
+                    lines.append(name + self.__labelString(key[1]) + " " + self.__number(total[key]))
+                continue
+            # histogram - one set of buckets for each set of labels
+            buckets = self.__buckets[name]
+            for labels in sorted(set(k[1] for k in total if k[0] == name), key=str):
+                cumulative = 0
+                for i in range(len(buckets) + 1):
+                    cumulative += total.get((name, labels, i), 0)
+                    le = self.__number(buckets[i]) if i < len(buckets) else "+Inf"
+                    lines.append(name + "_bucket" + self.__labelString(labels + (("le", le),)) + " " + str(cumulative))
+                lines.append(name + "_sum" + self.__labelString(labels) + " " + self.__number(total.get((name, labels, "sum"), 0)))
+                lines.append(name + "_count" + self.__labelString(labels) + " " + str(cumulative))
+        for name, (help, func) in self.__gauges.items():
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append("# HELP " + name + " " + help)
+            lines.append("# TYPE " + name + " gauge")
+            lines.append(name + " " + self.__number(value))
+        return "\n".join(lines) + "\n"
+
+    def __labelString(self, labels):
+        if not labels:
+            return ""
+        parts = []
+        for label, value in labels:
+            if value is None:
+                value = "none"
+            value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            parts.append(label + "=\"" + value + "\"")
+        return "{" + ",".join(parts) + "}"
+
+    def __number(self, value):
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
+
+    #
+    # the endpoint
+    #
+    def start(self):
+        if self.__params["port"] is None:
+            self.__logger.log("DBUG", "metrics: no port set, metrics endpoint not started")
+            return
+        render = self.render
+
+        class requestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # not to stderr
+            def log_message(self, format, *args):
+                return
+
+        try:
+            server = http.server.ThreadingHTTPServer((self.__params["address"], self.__params["port"]), requestHandler)
+        except OSError as e:
+            self.__logger.log("WARN", "metrics: unable to start metrics endpoint", {"address": self.__params["address"], "port": self.__params["port"], "error": e})
+            return
+        server.daemon_threads = True
+        self.__server = server
+        serverThread = threading.Thread(name='metricsServerThread', target=server.serve_forever, kwargs={"poll_interval": 0.5}, daemon=True)
+        serverThread.start()
+        self.__logger.log("INFO", "metrics: listening", {"address": self.__params["address"], "port": self.__params["port"]})
+        return
+
+    def cleanup(self):
+        if self.__server is False:
+            return
+        server = self.__server
+        self.__server = False
+        server.shutdown()
+        server.server_close()
+        return
@@ -9,12 +9,25 @@ import threading
 #  Do anything that involves making an output happen
 #
 # Variables:
-#  __doorRinging - bool - shows whether the doorbell is currently ringing
+#  __doorbellBusyUntil - float - time until which the doorbell will not ring again (pattern + cooldown)
 #  __doorbellCount - int - used for debounce
 #  __doorbellOutputs - list of dicts - the individual doorbell outputs and whether they are inverted
 #  __params - dict
 #   doorOpenTime - int - seconds that the door will stay open after a successful token compare
 #   doorbellCcTime - float - seconds that the doorbell closed contact output will be changed for
+#   doorbellCooldown - float - seconds after a ring finishes before the doorbell can ring again
+#  __patterns - dict - pattern id: outputs and pattern string ("on 0.7, off 0.3, ...")
+#  __waveCache - dict - pattern id: compiled pigpio wave id and duration (or False if it can't be played)
+#  __wavesToDelete - list - pigpio wave ids that were busy when they were replaced, deleted when nothing is being sent
+#  __waveEndTime - float - monotonic time that the last wave sent will have finished playing
+#  __doorState - str - "open" or "closed" - what the strike was last set to
+#  __doorDeadline - float - monotonic time that the door should close at, while it is open
+#  __doorCondition - threading.Condition - guards the door state, wakes the door thread on a new deadline
+#  __pinLevels - dict - gpio: level - shadow of what the outputs are set to, None if unknown
+#  __pinLock - threading.Lock - guards __pinLevels
+#  __heartbeatScript - int - pigpio script id for the heartbeat, None if not stored
+#  __stopping - bool - true once shutdown has started, no more door opens or patterns
+#  __doorThread - threading.Thread - the door thread
 #
 # Functions:
 #
@@ -23,30 +36,74 @@ import threading
 #   set initial state of some outputs
 #   get parameters from __settings
 #
+#  loadSettings()
+#   get parameters and patterns from __settings, at startup and when settings are reloaded
+#   compiles any patterns that have changed
+#
+#  __deleteWave(patternId)
+#   free a pattern's pigpio wave - if a wave is being sent, it's put in __wavesToDelete instead
+#
+#  __deletePendingWaves()
+#   free the waves in __wavesToDelete, if nothing is being sent
+#
 #  openDoor()
 #   called to open the door
-#   starts __openDoorThreadFunc in its own thread
+#   opens the door if it's closed, and moves the close deadline to doorOpenTime from now
+#   returns True if the door is open, False if it couldn't be opened - errors are logged, not raised
+#
+#  __doorThreadFunc()
+#   the one door thread, started in __init__
+#   sleeps until the deadline, closes the door when it's passed
+#   a new grant moves the deadline, so the door won't close on someone still inside their window
+#   reports to the systemHandler watchdog each time round, with how late the close was as its lag
+#
+#  __write(name, level, [force])
+#   write an output pin through pigpiod
+#   skipped if __pinLevels says the pin is already at that level (unless forced)
+#
+#  __restoreOutputs()
+#   force the door to __doorState, then every other output to its idle level
+#
+#  reconnect(pi)
+#   use a new pigpio connection, restore the outputs and rebuild the waves
 #
-#  __openDoorThreadFunc()
-#   open
-#   wait for time
-#   close
+#  resyncOutputs()
+#   read all output levels back from pigpiod with one read_bank_1 and store them in __pinLevels
+#   the read and the store are both under __pinLock, so a write can't happen in between
+#   called periodically by main, and should be called after a pigpiod reconnect
+#
+#  shutdown(timeout)
+#   stop the door thread, let an open door and a playing pattern finish if there's time, or cut them short
+#   returns what happened to the door and pattern
+#
+#  heartbeat(runTime)
+#   flash piActiveLed for at least runTime more seconds, timed by a script running in pigpiod
+#   called by main each time it hits the watchdog, if main hangs the led stops
+#
+#  stopHeartbeat()
+#   stop and delete the heartbeat script
+#
+#  switchPiActiveLed([state])
+#   set piActiveLed on or off, or toggle it
 #
 #  setDoor(state)
-#   close or open the door strike
-#   do the readerLed too
+#   close or open the door strike, __doorState goes with the strike
+#   do the readerLed too, if it fails the strike is left as it is
 #   and log
 #
 #  ringDoorbell()
-#   makes sure the doorbell is not already ringing
-#   does a ring
+#   makes sure the doorbell is not already ringing (or cooling down)
+#   plays the doorbell pattern
 #
-#  __doorbellHit()
-#   on/off cycle for the doorbell
-#   calls setDoorbellOutState
+#  playPattern(patternId)
+#   plays a pattern as a pigpio wave, compiling it first if it's not in __waveCache
+#   returns the seconds until the pattern has finished - its duration, plus any wave it's waiting behind - or False if it was not played
 #
-#  setDoorbellOutState(state)
-#   sets each output as described in __doorbellOutputs
+#  __parsePattern(patternStr)
+#   turn "on 0.7, off 0.3" into [(1, 0.7), (0, 0.3)]
+#
+#  __compilePattern(patternId)
+#   build the pigpio wave for a pattern and store it in __waveCache
 #
 # gpoCallback(gpio, level, tick, gpoName)
 #  called by __callbackOutput in main
@@ -56,7 +113,7 @@ import threading
 
 
 class outputHandler:
-    __doorRinging = False
+    __doorbellBusyUntil = 0
     __doorbellCount = 0
     __doorbellOutputs = [
         {
@@ -70,7 +127,31 @@ class outputHandler:
     ]
     __params = {
         "doorOpenTime": 5,
-        "doorbellCcTime": 0.1
+        "doorbellCcTime": 0.1,
+        "doorbellCooldown": 2,
+        "heartbeatTime": 1,
+        "doorLoopTime": 5
+    }
+    # pigpio script for the heartbeat, it runs inside pigpiod so no python timing is needed
+    # p0 - number of on/off cycles left, p1 - gpio, p2 - milliseconds on (and then off)
+    # it stops by itself when p0 runs out, so if we stop re-arming it the led stops flashing
+    __heartbeatScriptCode = "tag 999 w p1 1 mils p2 w p1 0 mils p2 dcr p0 jnz 999"
+    # patterns are a comma separated list of "on|off seconds" steps
+    # the last step should leave the outputs how they were found
+    # a pattern of None will not be played
+    __patterns = {
+        "doorbell": {
+            "outputs": __doorbellOutputs,
+            "pattern": "on 0.7, off 0.3, on 0.4, off 0.2, on 0.4, off 0"
+        },
+        "accessDenied": {
+            "outputs": [{"name": "readerBuzz", "inverted": True}],
+            "pattern": None
+        },
+        "lockout": {
+            "outputs": [{"name": "readerLed", "inverted": True}],
+            "pattern": None
+        }
     }
 
     #
@@ -92,32 +173,236 @@ class outputHandler:
         self.__pinDef = pinDef
         del pinDef
         self.__piActiveLedState = "on"
+        self.__waveCache = {}
+        self.__wavesToDelete = []
+        self.__waveEndTime = 0
+        self.__waveLock = threading.Lock()
+        self.__doorState = "closed"
+        self.__doorDeadline = 0
+        self.__doorCondition = threading.Condition()
+        self.__pinLevels = {}
+        self.__pinLock = threading.Lock()
+        self.__heartbeatScript = None
+        self.__stopping = False
 
         # set some outputs
+        self.__restoreOutputs()
+
+        # any waves left over in pigpiod are not ours to play any more
         try:
-            self.__pi.write(self.__pinDef.pins["doorStrike"], 0)
-            self.__pi.write(self.__pinDef.pins["doorbell12"], 0)
-            self.__pi.write(self.__pinDef.pins["doorbellCc"], 0)
-            self.__pi.write(self.__pinDef.pins["spareLed"], 0)
-            self.__pi.write(self.__pinDef.pins["readerLed"], 1)
-            self.__pi.write(self.__pinDef.pins["readerBuzz"], 1)
-            self.__pi.write(self.__pinDef.pins["piActiveLed"], 1)
+            self.__pi.wave_clear()
         except Exception as e:
-            self.__logger.log("ERRR", "There was an issue setting output pins", e)
+            self.__logger.log("WARN", "unable to clear pigpio waves", e)
+
+        # get __settings, and compile the patterns now, so the first ring doesn't have to wait for it
+        self.loadSettings()
+
+        # start the door thread
+        # it wakes up at least every doorLoopTime to tell the watchdog it's alive
+        self.__systemHandler.registerLoop("door", self.__params["doorLoopTime"] * 3)
+        self.__doorThread = threading.Thread(name='doorThread', target=self.__doorThreadFunc, daemon=True)
+        self.__doorThread.start()
+        return
+
+    #
+    # get __settings - at startup, and again when settings are reloaded
+    # anything that's not set goes back to the default
+    # patterns that have changed are compiled again, the others keep their waves
+    def loadSettings(self):
+        params = dict(outputHandler.__params)
+        patterns = {}
+        for patternId, pattern in outputHandler.__patterns.items():
+            patterns[patternId] = dict(pattern)
 
-        # get __settings
-        settingsToGet = ["doorOpenTime", "doorbellCcTime"]
-        if self.__settings.allSettings is False:
+        # they've been checked already, None if not set
+        settingsToGet = ["doorOpenTime", "doorbellCcTime", "doorbellCooldown", "heartbeatTime"]
+        if self.__settings.config is not False:
+            outputConfig = self.__settings.config.outputHandling
             for s in settingsToGet:
-                try:
-                    self.__settings.allSettings["outputHandling"][s]
-                except Exception as e:
-                    self.__logger.log("WARN", "unable to read setting", e)
-                    pass
-                else:
-                    self.__params[s] = self.__settings.allSettings["outputHandling"][s]
-                    self.__logger.log("INFO", "new setting for output handling", {"parameter": s, "value": self.__params[s]})
-            # done
+                value = getattr(outputConfig, s)
+                if value is not None:
+                    params[s] = value
+                    self.__logger.log("INFO", "new setting for output handling", {"parameter": s, "value": value})
+
+            # get any patterns from settings
+            if outputConfig.patterns is not None:
+                for patternId, pattern in outputConfig.patterns.items():
+                    patterns[patternId]["pattern"] = pattern
+                    self.__logger.log("INFO", "new pattern for output handling", {"pattern": patternId, "value": pattern})
+        self.__params = params
+
+        with self.__waveLock:
+            oldPatterns = self.__patterns
+            self.__patterns = patterns
+            for patternId in patterns:
+                if patternId in self.__waveCache and oldPatterns[patternId]["pattern"] == patterns[patternId]["pattern"]:
+                    continue
+                self.__deleteWave(patternId)
+                self.__compilePattern(patternId)
+        return
+
+    #
+    # free a pattern's wave in pigpiod
+    # a wave can't be deleted while it's being sent, so if anything is playing it's left there
+    # must be called with __waveLock held
+    def __deleteWave(self, patternId):
+        wave = self.__waveCache.pop(patternId, False)
+        if wave is False:
+            return
+        # it's not lost if it can't be deleted now, it's deleted next time
+        self.__wavesToDelete.append(wave["id"])
+        self.__deletePendingWaves()
+        return
+
+    # must be called with __waveLock held
+    def __deletePendingWaves(self):
+        if not self.__wavesToDelete:
+            return
+        try:
+            if self.__pi.wave_tx_busy():
+                self.__logger.log("DBUG", "output pattern wave is busy, will be deleted later", {"waves": self.__wavesToDelete})
+                return
+        except Exception as e:
+            self.__logger.log("WARN", "unable to delete pigpio wave", {"waves": self.__wavesToDelete, "error": e})
+            return
+        while self.__wavesToDelete:
+            waveId = self.__wavesToDelete.pop(0)
+            try:
+                self.__pi.wave_delete(waveId)
+            except Exception as e:
+                self.__logger.log("WARN", "unable to delete pigpio wave", {"wave": waveId, "error": e})
+        return
+
+    #
+    # put every output where it should be
+    # these are forced, as the write is also what puts the pin into output mode
+    # the door goes first, put back however the door state machine thinks it is
+    # each pin is on its own, so one that fails (or isn't defined) doesn't stop the rest
+    def __restoreOutputs(self):
+        if self.__doorState == "open":
+            levels = [("doorStrike", 1), ("readerLed", 0)]
+        else:
+            levels = [("doorStrike", 0), ("readerLed", 1)]
+        levels += [("doorbell12", 0), ("doorbellCc", 0), ("spareLed", 0), ("readerBuzz", 1), ("piActiveLed", 1)]
+        for name, level in levels:
+            # pins that aren't critical may not be defined
+            if name not in self.__pinDef.pins:
+                continue
+            try:
+                self.__write(name, level, force=True)
+            except Exception as e:
+                self.__logger.log("ERRR" if name == "doorStrike" else "WARN", "There was an issue setting an output pin", {"pin": name, "error": e})
+        return
+
+    #
+    # pigpiod has been reconnected
+    # anything that was stored in the old pigpiod (waves, scripts) has gone
+    # and the outputs may have been reset, so put them back from what we know
+    def reconnect(self, pi):
+        with self.__waveLock, self.__doorCondition:
+            self.__pi = pi
+            self.__heartbeatScript = None
+            with self.__pinLock:
+                self.__pinLevels = {}
+            self.__restoreOutputs()
+            # the old waves went with the old pigpiod
+            self.__waveCache = {}
+            self.__wavesToDelete = []
+            self.__waveEndTime = 0
+            for patternId in self.__patterns:
+                self.__compilePattern(patternId)
+        self.__logger.log("INFO", "output handler: outputs restored after pigpiod reconnect", {"door": self.__doorState})
+        return
+
+    #
+    # write an output
+    # returns True if there was a write, False if it was skipped
+    def __write(self, name, level, force=False):
+        gpio = self.__pinDef.pins[name]
+        with self.__pinLock:
+            if force is False and self.__pinLevels.get(gpio) == level:
+                return False
+            self.__pi.write(gpio, level)
+            self.__pinLevels[gpio] = level
+        return True
+
+    #
+    # read back every output in one go
+    # catches anything that changed the outputs without going through __write
+    def resyncOutputs(self):
+        changed = []
+        # the read is under the same lock as __write, or a write between the read and the update would be lost
+        # (eg. the door opening, then the stale level saying it's already closed)
+        with self.__pinLock:
+            try:
+                # a wave that's playing would give us levels from the middle of a pattern, try again next time
+                if self.__pi.wave_tx_busy():
+                    return
+                bank = self.__pi.read_bank_1()
+            except Exception as e:
+                self.__logger.log("WARN", "unable to read outputs for resync", e)
+                return
+            for name in self.__pinDef.pins["output"]:
+                # the heartbeat script owns this one
+                if name == "piActiveLed" and self.__heartbeatScript is not None:
+                    continue
+                gpio = self.__pinDef.pins[name]
+                level = (bank >> gpio) & 1
+                if self.__pinLevels.get(gpio) != level:
+                    changed.append(name)
+                self.__pinLevels[gpio] = level
+        if changed:
+            self.__logger.log("DBUG", "output resync found changed outputs", {"outputs": changed})
+        return
+
+    #
+    # keep the heartbeat going for at least another runTime seconds
+    # the first call stores the script in pigpiod
+    # the script is restarted with a new cycle count each time
+    def heartbeat(self, runTime):
+        import pigpio  # pigpio is started in main, but this is necessary here for script status
+        if "piActiveLed" not in self.__pinDef.pins or self.__stopping is True:
+            return
+
+        # store it, and wait for pigpiod to finish checking it
+        if self.__heartbeatScript is None:
+            try:
+                scriptId = self.__pi.store_script(self.__heartbeatScriptCode)
+                for i in range(50):
+                    if self.__pi.script_status(scriptId)[0] != pigpio.PI_SCRIPT_INITING:
+                        break
+                    time.sleep(0.01)
+            except Exception as e:
+                self.__logger.log("WARN", "unable to store heartbeat script in pigpiod - piActiveLed will not flash", e)
+                return
+            self.__heartbeatScript = scriptId
+            self.__logger.log("DBUG", "heartbeat script stored", {"script": scriptId})
+
+        # how many on/off cycles will cover the time
+        cycles = int(runTime / (self.__params["heartbeatTime"] * 2)) + 1
+        try:
+            self.__pi.stop_script(self.__heartbeatScript)
+            self.__pi.run_script(self.__heartbeatScript, [cycles, self.__pinDef.pins["piActiveLed"], int(self.__params["heartbeatTime"] * 1000)])
+        except Exception as e:
+            self.__logger.log("WARN", "unable to run heartbeat script", e)
+            return
+
+        # the script is changing the led, so we don't know what level it's at
+        with self.__pinLock:
+            self.__pinLevels[self.__pinDef.pins["piActiveLed"]] = None
+        return
+
+    #
+    # stop the heartbeat script and take it out of pigpiod
+    def stopHeartbeat(self):
+        if self.__heartbeatScript is None:
+            return
+        try:
+            self.__pi.stop_script(self.__heartbeatScript)
+            self.__pi.delete_script(self.__heartbeatScript)
+        except Exception as e:
+            self.__logger.log("WARN", "unable to stop heartbeat script", e)
+        self.__heartbeatScript = None
         return
 
     def switchPiActiveLed(self, state=False):
@@ -125,52 +410,136 @@ class outputHandler:
         if state is not False:
             if state == "on":
                 self.__piActiveLedState = "on"
-                self.__pi.write(self.__pinDef.pins["piActiveLed"], 1)
+                self.__write("piActiveLed", 1)
                 pass
             if state == "off":
                 self.__piActiveLedState = "off"
-                self.__pi.write(self.__pinDef.pins["piActiveLed"], 0)
+                self.__write("piActiveLed", 0)
                 pass
             return
         # state not specified, do a toggle
         if self.__piActiveLedState == "on":
             self.__piActiveLedState = "off"
-            self.__pi.write(self.__pinDef.pins["piActiveLed"], 0)
+            self.__write("piActiveLed", 0)
         elif self.__piActiveLedState == "off":
             self.__piActiveLedState = "on"
-            self.__pi.write(self.__pinDef.pins["piActiveLed"], 1)
+            self.__write("piActiveLed", 1)
         return
 
     #
-    # open and close the door
+    # open the door
     # this is for when a token has been read and approved
+    # a grant while the door is already open only moves the deadline
     def openDoor(self):
-        openDoorThread = threading.Thread(name='openDoorThread', target=self.__openDoorThreadFunc)
-        openDoorThread.start()
-
-    def __openDoorThreadFunc(self):
-        # open
-        self.setDoor("open")
-
-        # wait
-        time.sleep(self.__params["doorOpenTime"])
-
-        # Now let's warn that the door is about to close by flashing the Reader's LED
-        # l.log("DBUG", "Door Closing soon")
-        # i = 5
-        # while i < 5:
-        #   __pi.write(p.pins["readerLed"],1)
-        #   time.sleep(0.1)
-        #   __pi.write(p.pins["readerLed"],0)
-        #   time.sleep(0.1)
-        #   i += 1
-
-        # close
-        self.setDoor("closed")
-
-        # done
+        with self.__doorCondition:
+            if self.__stopping is True:
+                self.__logger.log("WARN", "Shutting down - door not opened")
+                return False
+            # never bring the deadline closer
+            self.__doorDeadline = max(self.__doorDeadline, time.monotonic() + self.__params["doorOpenTime"])
+            if self.__doorState == "open":
+                self.__logger.log("DBUG", "Door already open - extending open time")
+            else:
+                # this is the caller's thread, the grant still has to be logged if pigpiod has gone away
+                try:
+                    self.setDoor("open")
+                except Exception as e:
+                    self.__logger.log("ERRR", "Unable to open the door", e)
+                    return False
+            self.__doorCondition.notify()
+        return True
+
+    #
+    # door thread
+    # there is only one of these, it closes the door when the deadline has passed
+    def __doorThreadFunc(self):
+        with self.__doorCondition:
+            # shutdown closes the door itself, once it's done with it
+            while self.__stopping is False or self.__doorState == "open":
+                self.__systemHandler.loopAlive("door")
+
+                # closed - nothing to do until someone opens it
+                if self.__doorState == "closed":
+                    self.__doorCondition.wait(self.__params["doorLoopTime"])
+                    continue
+
+                # open - wait for the deadline, it may have moved by the time we wake
+                remaining = self.__doorDeadline - time.monotonic()
+                if remaining > 0:
+                    self.__doorCondition.wait(min(remaining, self.__params["doorLoopTime"]))
+                    continue
+
+                # how late are we closing
+                self.__systemHandler.loopAlive("door", -remaining)
+
+                # close
+                # if pigpiod has gone away, keep trying - the door must not be left open
+                try:
+                    self.setDoor("closed")
+                except Exception as e:
+                    self.__logger.log("ERRR", "Unable to close the door, will try again", e)
+                    self.__doorCondition.wait(1)
         return
 
+    #
+    # shutdown
+    # an open door is left to close when it should, if that's before timeout - otherwise it's closed now
+    # same for a pattern that's playing
+    def shutdown(self, timeout):
+        deadline = time.monotonic() + timeout
+        result = {"door": "closed", "pattern": "none"}
+
+        # the door
+        with self.__doorCondition:
+            self.__stopping = True
+            if self.__doorState == "open":
+                if self.__doorDeadline <= deadline:
+                    # the door thread will close it
+                    while self.__doorState == "open" and time.monotonic() < deadline:
+                        self.__doorCondition.wait(deadline - time.monotonic())
+                    result["door"] = "finished"
+                if self.__doorState == "open":
+                    result["door"] = "fastForwarded"
+                    try:
+                        self.setDoor("closed")
+                    except Exception as e:
+                        result["door"] = "failed"
+                        self.__logger.log("ERRR", "Unable to close the door", e)
+            self.__doorCondition.notify()
+        self.__doorThread.join(max(deadline - time.monotonic(), 0))
+
+        # patterns - nothing new will start, wait for anything playing
+        with self.__waveLock:
+            try:
+                if self.__pi.wave_tx_busy():
+                    result["pattern"] = "finished"
+                    while self.__pi.wave_tx_busy():
+                        if time.monotonic() >= deadline:
+                            self.__pi.wave_tx_stop()
+                            result["pattern"] = "stopped"
+                            break
+                        time.sleep(0.05)
+            except Exception as e:
+                self.__logger.log("WARN", "Unable to stop output pattern", e)
+            self.__waveCache = {}
+
+            # a stopped pattern can leave its outputs anywhere, put them where an "off" step would
+            if result["pattern"] == "stopped":
+                for patternId in self.__patterns:
+                    for out in self.__patterns[patternId]["outputs"]:
+                        try:
+                            self.__write(out["name"], 1 if out["inverted"] is True else 0, force=True)
+                        except Exception as e:
+                            self.__logger.log("WARN", "Unable to set output to idle", {"output": out["name"], "error": e})
+
+        # the led
+        self.stopHeartbeat()
+        try:
+            self.switchPiActiveLed("off")
+        except Exception as e:
+            self.__logger.log("WARN", "Unable to turn off active led", e)
+        return result
+
     # set the door to an open or closed state
     # will do led and strike
     def setDoor(self, state):
@@ -178,66 +547,159 @@ class outputHandler:
         if state != "open" and state != "closed":
             self.__logger.log("WARN", "No valid state set for changing door state")
             return
-        # open
-        if state == "open":
-            self.__logger.log("DBUG", "Opening door")
-            pinState = [{"name": "doorStrike", "state": 1}, {"name": "readerLed", "state": 0}]
-        # closed
-        if state == "closed":
-            self.__logger.log("DBUG", "Closing door")
-            pinState = [{"name": "doorStrike", "state": 0}, {"name": "readerLed", "state": 1}]
-        # do the pins
-        for pin in pinState:
-            self.__pi.write(self.__pinDef.pins[pin["name"]], pin["state"])
+        with self.__doorCondition:
+            # open
+            if state == "open":
+                self.__logger.log("DBUG", "Opening door")
+                strikeLevel = 1
+                ledLevel = 0
+            # closed
+            if state == "closed":
+                self.__logger.log("DBUG", "Closing door")
+                strikeLevel = 0
+                ledLevel = 1
+            # the strike - the state is whatever the strike is, so the door thread always knows to close it
+            self.__write("doorStrike", strikeLevel)
+            self.__doorState = state
+            self.__doorCondition.notify()
+            # the led is only a light, it doesn't change what the door is doing
+            if "readerLed" in self.__pinDef.pins:
+                try:
+                    self.__write("readerLed", ledLevel)
+                except Exception as e:
+                    self.__logger.log("WARN", "Unable to set the reader led", {"door": state, "error": e})
+        return
 
     def ringDoorbell(self):
-        ringDoorbellThread = threading.Thread(name='doorbellThread', target=self.__ringDoorbellThread)
-        ringDoorbellThread.start()
-
-    # make the doorbell do a ringing
-    def __ringDoorbellThread(self):
         self.__doorbellCount += 1
         self.__logger.log("DBUG", "******* Bell Count *******", self.__doorbellCount)
 
-        if self.__doorRinging is False:
-            self.__doorRinging = True
-            self.__logger.log("INFO", "Start Doorbell")
-
-            # Some kind of nice-enough doorbell ring pattern
-            self.__setDoorbellOutState(1)
-            time.sleep(0.7)
-            self.__setDoorbellOutState(0)
-            time.sleep(0.3)
-            self.__setDoorbellOutState(1)
-            time.sleep(0.4)
-            self.__setDoorbellOutState(0)
-            time.sleep(0.2)
-            self.__setDoorbellOutState(1)
-            time.sleep(0.4)
-            self.__setDoorbellOutState(0)
-
-            # Wait to give a break before hearing more bell, even if the button is pressed again
-            time.sleep(2)
-
-            self.__doorRinging = False
-            self.__logger.log("INFO", "Stop Doorbell")
-        else:
+        # Wait to give a break before hearing more bell, even if the button is pressed again
+        timeNow = time.time()
+        if timeNow < self.__doorbellBusyUntil:
             self.__logger.log("INFO", "NOT Ringing doorbell - it's already ringing")
+            return
+
+        # play it, pigpiod does all the timing
+        # it may be queued behind another pattern, so it's busy until that one has finished too
+        finishesIn = self.playPattern("doorbell")
+        if finishesIn is False:
+            return
+        self.__doorbellBusyUntil = timeNow + finishesIn + self.__params["doorbellCooldown"]
+        self.__logger.log("INFO", "Start Doorbell", {"finishesIn": round(finishesIn, 3)})
         return
 
-    def __setDoorbellOutState(self, state):
-        if state != 1 and state != 0:
+    #
+    # play a pattern
+    # the pigpio wave is sent in sync mode, so it will not cut off a pattern that is already playing
+    # it starts when that one finishes instead, so that's when it's timed from
+    def playPattern(self, patternId):
+        import pigpio  # pigpio is started in main, but this is necessary here for wave modes
+        if patternId not in self.__patterns:
+            self.__logger.log("WARN", "Unknown output pattern", {"pattern": patternId})
+            return False
+
+        with self.__waveLock:
+            # nothing new once shutdown has started
+            if self.__stopping is True:
+                return False
+            if patternId not in self.__waveCache:
+                self.__compilePattern(patternId)
+            wave = self.__waveCache[patternId]
+            if wave is False:
+                return False
+            try:
+                self.__pi.wave_send_using_mode(wave["id"], pigpio.WAVE_MODE_ONE_SHOT_SYNC)
+            except Exception as e:
+                self.__logger.log("WARN", "unable to play output pattern", {"pattern": patternId, "error": e})
+                return False
+            timeNow = time.monotonic()
+            self.__waveEndTime = max(timeNow, self.__waveEndTime) + wave["duration"]
+            finishesIn = self.__waveEndTime - timeNow
+
+        # the wave changes the outputs behind our back, so forget what they were
+        with self.__pinLock:
+            for out in self.__patterns[patternId]["outputs"]:
+                self.__pinLevels[self.__pinDef.pins[out["name"]]] = None
+
+        self.__logger.log("DBUG", "Playing output pattern", {"pattern": patternId, "finishesIn": round(finishesIn, 3)})
+        return finishesIn
+
+    #
+    # make a pattern string into a list of (level, seconds)
+    # returns False if it doesn't make sense
+    def __parsePattern(self, patternStr):
+        steps = []
+        try:
+            for step in patternStr.split(","):
+                state, seconds = step.split()
+                if state == "on":
+                    level = 1
+                elif state == "off":
+                    level = 0
+                else:
+                    return False
+                seconds = float(seconds)
+                if seconds < 0:
+                    return False
+                steps.append((level, seconds))
+        except (AttributeError, ValueError):
+            return False
+        if not steps:
+            return False
+        return steps
+
+    #
+    # turn a pattern into a pigpio wave
+    # each step sets/clears every output in one pulse, inverted outputs go the other way
+    # stores False in __waveCache if the pattern can't be played, so it isn't tried again
+    def __compilePattern(self, patternId):
+        # anything waiting to be deleted goes first, to make room
+        self.__deletePendingWaves()
+        self.__waveCache[patternId] = False
+        pattern = self.__patterns[patternId]
+        if pattern["pattern"] is None:
+            return
+        import pigpio  # pigpio is started in main, but this is necessary here for pulses
+
+        steps = self.__parsePattern(pattern["pattern"])
+        if steps is False:
+            self.__logger.log("WARN", "output pattern is not valid, it will not be played", {"pattern": patternId, "value": pattern["pattern"]})
             return
 
-        for out in self.__doorbellOutputs:
-            # set state
-            newState = state
-            # invert if necessary
+        # masks for the outputs that are set by an "on" step, and those cleared by it
+        onMask = 0
+        offMask = 0
+        for out in pattern["outputs"]:
+            if out["name"] not in self.__pinDef.pins:
+                self.__logger.log("WARN", "output pattern uses a pin that is not defined", {"pattern": patternId, "pin": out["name"]})
+                return
             if out["inverted"] is True:
-                newState ^= 1
-            # do the output
-            self.__pi.write(self.__pinDef.pins[out["name"]], newState)
-            del newState
+                offMask |= 1 << self.__pinDef.pins[out["name"]]
+            else:
+                onMask |= 1 << self.__pinDef.pins[out["name"]]
+
+        pulses = []
+        duration = 0
+        for level, seconds in steps:
+            if level == 1:
+                pulses.append(pigpio.pulse(onMask, offMask, int(seconds * 1000000)))
+            else:
+                pulses.append(pigpio.pulse(offMask, onMask, int(seconds * 1000000)))
+            duration += seconds
+
+        try:
+            for out in pattern["outputs"]:
+                self.__pi.set_mode(self.__pinDef.pins[out["name"]], pigpio.OUTPUT)
+            self.__pi.wave_add_new()
+            self.__pi.wave_add_generic(pulses)
+            waveId = self.__pi.wave_create()
+        except Exception as e:
+            self.__logger.log("WARN", "unable to make pigpio wave for output pattern", {"pattern": patternId, "error": e})
+            return
+
+        self.__waveCache[patternId] = {"id": waveId, "duration": duration}
+        self.__logger.log("DBUG", "output pattern compiled", {"pattern": patternId, "wave": waveId, "duration": duration})
         return
 
     def gpoCallback(self, gpio, level, tick, gpoName):
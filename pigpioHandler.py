@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+import time
+import threading
+
+#
+# PiGPIO Handler
+#
+# Description:
+#  look after the connection to pigpiod
+#  connect straight to the daemon with a bounded retry and backoff
+#  rather than asking systemctl if it's running first
+#  the connection can be made in the background, so other startup work can happen at the same time
+#  once running, a supervisor thread checks the connection and reconnects if pigpiod goes away
+#
+# Variables:
+#  pi - obj - the pigpio.pi connection, False if not connected
+#  __params - dict
+#   connectTimeout - float - seconds to keep trying to connect before giving up
+#   retryDelayStart - float - seconds to wait after the first failed attempt
+#   retryDelayMax - float - longest wait between attempts, the wait doubles each time up to this
+#   checkInterval - float - seconds between supervisor checks of the connection
+#   reconnectDelayMax - float - longest wait between reconnect attempts
+#   livenessEvent - int - pigpio event number triggered by the supervisor, to prove the callback thread is alive - 0 to 30, pigpio uses 31 for BSC
+#  __connectThread - threading.Thread - the background connection, None if not started
+#  __onReconnect - list - functions to call with the new pigpio.pi after a reconnect
+#  __supervising - threading.Event - set while the supervisor should keep running
+#  outages - int - number of times the connection has been lost
+#  lastOutageTime - float - seconds the last outage lasted
+#
+# Functions:
+#
+#  __init__(systemHandler, logger)
+#   store objects for later use
+#
+#  connect()
+#   try to connect until connected or connectTimeout has passed
+#   returns the pigpio.pi object, or False
+#
+#  connectInBackground()
+#   runs connect() in its own thread
+#
+#  waitForConnection()
+#   waits for the background connection to finish
+#   returns the pigpio.pi object, or False
+#
+#  onReconnect(callback)
+#   add a function to be called with the new pigpio.pi after a reconnect
+#   this is where callbacks, the wiegand decoder and outputs get set up again
+#
+#  startSupervisor()
+#   start the supervisor thread
+#
+#  stopSupervisor()
+#   stop the supervisor, so a deliberate pi.stop() isn't seen as an outage
+#
+#  __supervisorThreadFunc()
+#   check the connection every checkInterval
+#   if it's gone, __reconnect()
+#   trigger livenessEvent - it comes back through the same thread as gpio callbacks
+#   both this loop and the callback thread report to the systemHandler watchdog
+#
+#  __livenessCallback(event, tick)
+#   the callback thread is alive
+#
+#  __reconnect()
+#   connect again with exponential backoff until it works (or the supervisor is stopped)
+#   reports to the watchdog every checkInterval while it waits, as the backoff can be longer than the loop deadlines
+#   run the onReconnect callbacks
+#   log and notify systemd of the outage
+#
+
+
+class pigpioHandler:
+    pi = False
+    __params = {
+        "connectTimeout": 4,
+        "retryDelayStart": 0.05,
+        "retryDelayMax": 1,
+        "checkInterval": 1,
+        "reconnectDelayMax": 10,
+        "livenessEvent": 30
+    }
+    __connectThread = None
+    outages = 0
+    lastOutageTime = 0
+
+    def __init__(self, systemHandler, logger):
+        # internalise the stuff
+        self.__systemHandler = systemHandler
+        del systemHandler
+        self.__logger = logger
+        del logger
+        self.__onReconnect = []
+        self.__supervising = threading.Event()
+        return
+
+    #
+    # connect to pigpiod
+    # pigpio.pi() fails straight away if pigpiod isn't listening yet, so wait a bit and try again
+    #
+    def connect(self):
+        import pigpio  # imported by main first, so it will be there
+        startTime = time.monotonic()
+        retryDelay = self.__params["retryDelayStart"]
+        attempts = 0
+        while True:
+            attempts += 1
+            pi = pigpio.pi(show_errors=False)
+            if pi.connected:
+                self.pi = pi
+                self.__logger.log("DBUG", "PiGPIO - connected", {"attempts": attempts, "time": round(time.monotonic() - startTime, 3)})
+                return self.pi
+
+            # out of time?
+            if time.monotonic() - startTime + retryDelay > self.__params["connectTimeout"]:
+                self.__logger.log("ERRR", "PiGPIO - Unable to connect, is pigpiod running?", {"attempts": attempts})
+                return False
+
+            self.__logger.log("DBUG", "PiGPIO - not connected, will try again", {"attempt": attempts, "retryDelay": retryDelay})
+            time.sleep(retryDelay)
+            retryDelay = min(retryDelay * 2, self.__params["retryDelayMax"])
+
+    def connectInBackground(self):
+        self.__connectThread = threading.Thread(name='pigpioConnectThread', target=self.connect, daemon=True)
+        self.__connectThread.start()
+        return
+
+    def waitForConnection(self):
+        if self.__connectThread is not None:
+            self.__connectThread.join()
+            self.__connectThread = None
+        return self.pi
+
+    def onReconnect(self, callback):
+        self.__onReconnect.append(callback)
+        return
+
+    def startSupervisor(self):
+        self.__systemHandler.registerLoop("pigpioSupervisor", self.__params["checkInterval"] * 10)
+        self.__systemHandler.registerLoop("pigpioCallbacks", self.__params["checkInterval"] * 10)
+        self.__registerLivenessCallback()
+        self.__supervising.set()
+        supervisorThread = threading.Thread(name='pigpioSupervisorThread', target=self.__supervisorThreadFunc, daemon=True)
+        supervisorThread.start()
+        return
+
+    def stopSupervisor(self):
+        self.__supervising.clear()
+        return
+
+    #
+    # supervisor
+    # pigpio doesn't tell us when the socket goes, but any command on a dead socket will fail
+    #
+    def __supervisorThreadFunc(self):
+        while self.__supervising.is_set():
+            self.__systemHandler.loopAlive("pigpioSupervisor")
+            time.sleep(self.__params["checkInterval"])
+            if not self.__supervising.is_set():
+                break
+            try:
+                self.pi.get_current_tick()
+                self.pi.event_trigger(self.__params["livenessEvent"])
+            except Exception as e:
+                self.__logger.log("ERRR", "PiGPIO - connection to pigpiod lost, will reconnect", e)
+                self.__reconnect()
+        return
+
+    #
+    # the liveness event goes through pigpio's callback thread
+    # so if a callback is stuck, this won't be called
+    def __registerLivenessCallback(self):
+        try:
+            self.pi.event_callback(self.__params["livenessEvent"], self.__livenessCallback)
+        except Exception as e:
+            self.__logger.log("WARN", "PiGPIO - unable to register liveness event callback", e)
+        return
+
+    def __livenessCallback(self, event, tick):
+        self.__systemHandler.loopAlive("pigpioCallbacks")
+        return
+
+    def __reconnect(self):
+        import pigpio  # imported by main first, so it will be there
+        self.outages += 1
+        lostTime = time.monotonic()
+        self.__systemHandler.notifyUp("STATUS=Reconnecting to pigpiod (outage " + str(self.outages) + ")")
+
+        # get rid of the old one
+        try:
+            self.pi.stop()
+        except Exception:
+            pass
+
+        # keep trying, waiting longer each time
+        retryDelay = self.__params["retryDelayStart"]
+        attempts = 0
+        while self.__supervising.is_set():
+            attempts += 1
+            pi = pigpio.pi(show_errors=False)
+            if pi.connected:
+                break
+            self.__logger.log("DBUG", "PiGPIO - reconnect failed, will try again", {"attempt": attempts, "retryDelay": retryDelay})
+            # still alive, just waiting for pigpiod
+            # callbacks can't come in without pigpiod, that's not a hang
+            # the wait is done in checkInterval steps, reporting in each time
+            waitUntil = time.monotonic() + retryDelay
+            while self.__supervising.is_set():
+                self.__systemHandler.loopAlive("pigpioSupervisor")
+                self.__systemHandler.loopAlive("pigpioCallbacks")
+                remaining = waitUntil - time.monotonic()
+                if remaining <= 0:
+                    break
+                time.sleep(min(remaining, self.__params["checkInterval"]))
+            retryDelay = min(retryDelay * 2, self.__params["reconnectDelayMax"])
+        else:
+            # stopped while we were trying
+            return
+        self.pi = pi
+
+        # set everything up again
+        self.__registerLivenessCallback()
+        for callback in self.__onReconnect:
+            try:
+                callback(self.pi)
+            except Exception as e:
+                self.__logger.log("ERRR", "PiGPIO - error while setting up after reconnect", e)
+
+        self.lastOutageTime = round(time.monotonic() - lostTime, 3)
+        self.__logger.log("NOTE", "PiGPIO - reconnected to pigpiod", {"attempts": attempts, "outageTime": self.lastOutageTime, "outages": self.outages})
+        self.__systemHandler.notifyUp("STATUS=Running - reconnected to pigpiod after " + str(self.lastOutageTime) + "s (" + str(self.outages) + " outages)")
+        return
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+from types import MappingProxyType  # for read only dicts
 
 #
 # Pin Definitions
@@ -8,6 +9,10 @@
 #
 # Variables:
 #  pins - dict of all pin names and numbers, this is what is used by other functions
+#  gpioLookup - read only dict of gpio number: (pin name, role) - role is "input", "output" or "wiegand"
+#   built once, for callbacks that need to know which pin a gpio is
+#  inputMasks - read only dict of input pin name: bit mask in a pigpio bank read (1 << gpio)
+#  inputMask - int - all of inputMasks together
 #  __pcbVersion - the pcb version specified in __settings file
 #  __pcbVersionsAvailable - allowable values of __pcbVersion
 #  pcbPinout - what each pin definition is by PCB version
@@ -26,6 +31,18 @@
 #  __setByCustom()
 #   get pin definitions as defined in the __settings file
 #
+#  __sortInputOutputPins()
+#   make pins["input"] and pins["output"]
+#
+#  __buildGpioLookup()
+#   make gpioLookup from the sorted pins
+#
+#  __buildInputMasks()
+#   make inputMasks and inputMask from the sorted pins
+#
+#  inputLevels(bank)
+#   every input pin name: level, from one pi.read_bank_1()
+#
 
 
 class pinDef:
@@ -154,6 +171,8 @@ class pinDef:
             self.__systemHandler.quit(1, "Failed - Critical pin/s not defined", "ERRR", "Critical pin/s not defined", missingCriticalPins)
 
         self.__sortInputOutputPins()
+        self.__buildGpioLookup()
+        self.__buildInputMasks()
 
         # done
         return
@@ -163,12 +182,8 @@ class pinDef:
     #
     def __setByPcb(self):
         # see if it's set
-        try:
-            self.__settings.allSettings["pinDef"]["pcbVersion"]
-        except KeyError:
-            pass
-        else:
-            self.__pcbVersion = self.__settings.allSettings["pinDef"]["pcbVersion"]
+        if self.__settings.config.pinDef.pcbVersion is not None:
+            self.__pcbVersion = self.__settings.config.pinDef.pcbVersion
             # make sure it's a valid value
             if self.__pcbVersion in self.__pcbVersionsAvailable:
                 # store it
@@ -190,22 +205,13 @@ class pinDef:
     # set individual pins from __settings
     #
     def __setByCustom(self):
-        # is it set?
-        try:
-            self.__settings.allSettings["pinDef"]
-        except KeyError:
-            pass
-        else:
-            # grab it all in
-            for p in self.pins:
-                # but first make sure it's been set in settings
-                try:
-                    self.__settings.allSettings["pinDef"][p]
-                except KeyError:
-                    pass
-                else:
-                    self.pins[p] = self.__settings.allSettings["pinDef"][p]
-                    self.__logger.log("DBUG", "custom pin set", {"name": p, "pin": self.pins[p]})
+        # grab it all in
+        pinConfig = self.__settings.config.pinDef
+        for p in self.pins:
+            # but first make sure it's been set in settings
+            if getattr(pinConfig, p, None) is not None:
+                self.pins[p] = getattr(pinConfig, p)
+                self.__logger.log("DBUG", "custom pin set", {"name": p, "pin": self.pins[p]})
 
         # done
         return
@@ -223,3 +229,37 @@ class pinDef:
                 outputPins = {**outputPins, pin: self.pins[pin]}
         self.pins["input"] = inputPins
         self.pins["output"] = outputPins
+
+    #
+    # reverse lookup, gpio number to name and role
+    # read only, as nothing should change pins after this
+    #
+    def __buildGpioLookup(self):
+        lookup = {}
+        for role in ["input", "output"]:
+            for pin in self.pins[role]:
+                lookup[self.pins[role][pin]] = (pin, role)
+        for pin in ["wiegand0", "wiegand1"]:
+            lookup[self.pins[pin]] = (pin, "wiegand")
+        self.gpioLookup = MappingProxyType(lookup)
+
+    #
+    # bit masks for the inputs, so they can all be read at once with read_bank_1
+    #
+    def __buildInputMasks(self):
+        masks = {}
+        allMasks = 0
+        for pin in self.pins["input"]:
+            masks[pin] = 1 << self.pins["input"][pin]
+            allMasks |= masks[pin]
+        self.inputMasks = MappingProxyType(masks)
+        self.inputMask = allMasks
+
+    #
+    # split a bank read into the inputs
+    #
+    def inputLevels(self, bank):
+        levels = {}
+        for pin, mask in self.inputMasks.items():
+            levels[pin] = 1 if bank & mask else 0
+        return levels
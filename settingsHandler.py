@@ -1,23 +1,208 @@
 #!/usr/bin/env python
 import os  # useful for file operations
 import json  # for gettings settings and tokens
+from types import MappingProxyType  # for read only dicts
+
+#
+# Settings Handler
+#
+# Description:
+#  load settings.json, check it against __schema, and make config
+#  config is read only, with attribute access, eg. config.outputHandling.doorOpenTime
+#  every setting in __schema is there - None if it's not in settings.json, so modules keep their own defaults
+#  paths are made absolute (from root) once, here
+#  every problem is found and reported together, before anything uses the settings
+#
+# Variables:
+#  allSettings - dict - settings.json as it was loaded, False if not loaded
+#  config - settingsSection - checked settings, False if not loaded
+#  __schema - dict - what settings.json should look like
+#   a dict is a section, anything else is a setting - (type, rule)
+#   rules - None, a list of allowed values, or positive, notNegative, gpio, path (made absolute), strings (a list, made a frozenset) or patterns
+#  __canBeFalse - set - sections that can be set to false, to turn something off
+#  __restartSections - list - sections that are only used at startup, so can't be changed by a reload
+#  __levels - list - log levels
+#
+# Functions:
+#
+#  __init__(systemHandler, [logger], [allSettings])
+#   load settings.json (or use allSettings if given), check it and make config
+#   quits if it can't be loaded or has errors
+#
+#  reload()
+#   load settings.json again, check it, and use it if nothing that needs a restart has changed
+#   returns a list of the sections that have changed, or False if the new settings weren't used
+#
+#  compile(allSettings)
+#   check settings and make a config from them
+#   returns (config, errors, warnings) - config is False if there are errors
+#
+#  __compileSection(schema, values, name, root, errors, warnings)
+#   check one section and make a settingsSection, going down into sections inside it
+#
+#  __compileValue(spec, value, name, root, errors)
+#   check one setting, returns the value to store
+#
+#  __loadFromFile()
+#   load settings.json into allSettings
+#
+#  __checkRoot(action)
+#   get the default root, or set root in allSettings if it's not there
+#
+
+
+#
+# a read only section of settings
+# every setting in the schema is an attribute
+class settingsSection:
+    def __init__(self, values):
+        for key in values:
+            object.__setattr__(self, key, values[key])
+
+    def __setattr__(self, key, value):
+        raise AttributeError("settings are read only")
+
+    def __delattr__(self, key):
+        raise AttributeError("settings are read only")
+
+    def __eq__(self, other):
+        return isinstance(other, settingsSection) and vars(self) == vars(other)
+
+    def __repr__(self):
+        return "settingsSection(" + repr(vars(self)) + ")"
+
+    def asDict(self):
+        out = {}
+        for key, value in vars(self).items():
+            if isinstance(value, settingsSection):
+                value = value.asDict()
+            elif isinstance(value, MappingProxyType):
+                value = dict(value)
+            out[key] = value
+        return out
 
 
 #
 # here's a class for keeping all of the settings
 class settingsHandler:
     allSettings = False
+    config = False
+
+    __levels = ["DBUG", "INFO", "NOTE", "WARN", "ERRR", "NONE"]
+    __schema = {
+        "root": (str, None),
+        "allowedTokens": {
+            "path": (str, "path")
+        },
+        "wiegandLength": (int, [26, 34]),
+        "modules": (object, None),
+        "logging": {
+            "redact": (list, "strings"),
+            "rateLimit": {
+                "burst": (int, "positive"),
+                "rate": (float, "positive"),
+                "summaryTime": (float, "positive"),
+                "maxKeys": (int, "positive")
+            },
+            "flightRecorder": {
+                "size": (int, "notNegative"),
+                "level": (str, __levels),
+                "path": (str, "path"),
+                "keep": (int, "notNegative"),
+                "minInterval": (float, "notNegative")
+            },
+            "syslog": {
+                "level": (str, __levels)
+            },
+            "journal": {
+                "level": (str, __levels),
+                "redact": (list, "strings")
+            },
+            "display": {
+                "level": (str, __levels),
+                "colour": (bool, None),
+                "redact": (list, "strings")
+            },
+            "file": {
+                "level": (str, __levels),
+                "path": (str, "path"),
+                "queueSize": (int, "positive"),
+                "flushSize": (int, "notNegative"),
+                "flushTime": (float, "positive"),
+                "maxSize": (int, "notNegative"),
+                "rotateDaily": (bool, None),
+                "keep": (int, "notNegative"),
+                "redact": (list, "strings")
+            }
+        },
+        "pinDef": {
+            "pcbVersion": (float, None),
+            "doorStrike": (int, "gpio"),
+            "doorbell12": (int, "gpio"),
+            "doorbellCc": (int, "gpio"),
+            "readerLed": (int, "gpio"),
+            "readerBuzz": (int, "gpio"),
+            "doorbellButton": (int, "gpio"),
+            "doorSensor": (int, "gpio"),
+            "piActiveLed": (int, "gpio"),
+            "spareLed": (int, "gpio"),
+            "wiegand0": (int, "gpio"),
+            "wiegand1": (int, "gpio"),
+            "exitButton": (int, "gpio")
+        },
+        "inputHandling": {
+            "delimiter": (str, ["#", "*"]),
+            "timeout": (float, "positive"),
+            "bruteforceThresholdAttempts": (int, "positive"),
+            "bruteforceThresholdTime": (float, "positive"),
+            "overspeedThresholdTime": (float, "notNegative"),
+            "lockoutTime": (float, "notNegative"),
+            "doorSensorOpen": (int, [0, 1])
+        },
+        "outputHandling": {
+            "doorOpenTime": (float, "positive"),
+            "doorbellCcTime": (float, "positive"),
+            "doorbellCooldown": (float, "notNegative"),
+            "heartbeatTime": (float, "positive"),
+            "patterns": (dict, "patterns")
+        },
+        "audit": {
+            "path": (str, "path"),
+            "queueSize": (int, "positive"),
+            "batchTime": (float, "notNegative"),
+            "redact": (list, "strings")
+        },
+        "status": {
+            "path": (str, "path")
+        },
+        "control": {
+            "path": (str, "path"),
+            "redact": (list, "strings")
+        },
+        "metrics": {
+            "address": (str, None),
+            "port": (int, "positive")
+        }
+    }
+    __canBeFalse = {"logging.rateLimit", "logging.flightRecorder", "audit", "status", "control"}
+    __patternIds = ["doorbell", "accessDenied", "lockout"]
+    # pins are set up, and the wiegand decoder, audit database, control socket and metrics endpoint opened, once at startup
+    __restartSections = ["root", "pinDef", "wiegandLength", "audit", "control", "metrics"]
 
     # load all settings on initialisation
-    def __init__(self, systemHandler, logger=False):
+    def __init__(self, systemHandler, logger=False, allSettings=False):
         # sort out the logger
         self.__logger = logger
         del logger
         self.__systemHandler = systemHandler
         del systemHandler
 
-        # load the stuff
-        successfulLoad = self.__loadFromFile()
+        # load the stuff - unless we've been given them
+        if allSettings is not False:
+            self.allSettings = allSettings
+            successfulLoad = True
+        else:
+            successfulLoad = self.__loadFromFile()
 
         # see if it worked
         if successfulLoad is False:
@@ -30,6 +215,161 @@ class settingsHandler:
         # work out root - set if unset
         self.__checkRoot("set")
 
+        # check them, all in one go
+        config, errors, warnings = self.compile(self.allSettings)
+        if warnings:
+            self.__log("WARN", "settings.json has settings that aren't used", warnings)
+        if errors:
+            self.__log("ERRR", "settings.json has errors, will stop execution", errors)
+            self.__systemHandler.quit(1, status="Failed - settings.json has " + str(len(errors)) + " errors")
+        self.config = config
+
+    #
+    # reload - for SIGHUP
+    # all or nothing - if anything is wrong, or needs a restart, the old settings are kept
+    #
+    def reload(self):
+        oldSettings = self.allSettings
+        if self.__loadFromFile() is False:
+            self.__log("ERRR", "unable to reload settings.json - settings not changed")
+            self.allSettings = oldSettings
+            return False
+        self.__checkRoot("set")
+
+        config, errors, warnings = self.compile(self.allSettings)
+        if warnings:
+            self.__log("WARN", "settings.json has settings that aren't used", warnings)
+        if errors:
+            self.__log("ERRR", "settings.json has errors - settings not changed", errors)
+            self.allSettings = oldSettings
+            return False
+
+        # what's changed
+        changed = []
+        for section in vars(config):
+            if getattr(config, section) != getattr(self.config, section):
+                changed.append(section)
+        needRestart = [section for section in changed if section in self.__restartSections]
+        if needRestart:
+            self.__log("ERRR", "settings.json has changes that need a restart - settings not changed", {"sections": needRestart})
+            self.allSettings = oldSettings
+            return False
+
+        self.config = config
+        return changed
+
+    #
+    # checking
+    #
+    def compile(self, allSettings):
+        errors = []
+        warnings = []
+        if not isinstance(allSettings, dict):
+            return False, ["settings.json should be an object"], warnings
+
+        # root first, everything else uses it
+        root = allSettings.get("root", self.__checkRoot("get"))
+        if not isinstance(root, str) or root == "":
+            errors.append("root - should be a path")
+            root = self.__checkRoot("get")
+        if root[-1] != "/":
+            root += "/"
+
+        config = self.__compileSection(self.__schema, allSettings, "", root, errors, warnings)
+        if errors:
+            return False, errors, warnings
+        return config, errors, warnings
+
+    def __compileSection(self, schema, values, name, root, errors, warnings):
+        out = {}
+        for key in values:
+            if key not in schema:
+                warnings.append(name + key + " - unknown setting")
+        for key, spec in schema.items():
+            value = values.get(key)
+            if isinstance(spec, dict):
+                # section
+                if value is False and name + key in self.__canBeFalse:
+                    out[key] = False
+                    continue
+                if value is None:
+                    value = {}
+                if not isinstance(value, dict):
+                    errors.append(name + key + " - should be an object" + (" or false" if name + key in self.__canBeFalse else ""))
+                    value = {}
+                out[key] = self.__compileSection(spec, value, name + key + ".", root, errors, warnings)
+            elif value is None:
+                out[key] = None
+            else:
+                out[key] = self.__compileValue(spec, value, name + key, root, errors)
+        # root is stored how everything else uses it
+        if name == "":
+            out["root"] = root
+        return settingsSection(out)
+
+    def __compileValue(self, spec, value, name, root, errors):
+        valueType, rule = spec
+
+        # type - json numbers can be int or float, but bool is not a number
+        if valueType is float:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                errors.append(name + " - should be a number")
+                return None
+        elif valueType is int:
+            if isinstance(value, bool) or not isinstance(value, int):
+                errors.append(name + " - should be a whole number")
+                return None
+        elif valueType is not object and not isinstance(value, valueType):
+            errors.append(name + " - should be a " + {str: "string", bool: "true or false", list: "list", dict: "object"}[valueType])
+            return None
+
+        # rule
+        if rule is None:
+            return value
+        if isinstance(rule, list):
+            if value not in rule:
+                errors.append(name + " - should be one of " + ", ".join(str(r) for r in rule))
+                return None
+            return value
+        if rule == "positive":
+            if value <= 0:
+                errors.append(name + " - should be more than 0")
+                return None
+            return value
+        if rule == "notNegative":
+            if value < 0:
+                errors.append(name + " - should not be negative")
+                return None
+            return value
+        if rule == "gpio":
+            if value < 0 or value > 31:
+                errors.append(name + " - should be a gpio number, 0 to 31")
+                return None
+            return value
+        if rule == "path":
+            if value == "":
+                errors.append(name + " - should be a path")
+                return None
+            if value[0] != "/":
+                value = root + value
+            return value
+        if rule == "strings":
+            if not all(isinstance(v, str) for v in value):
+                errors.append(name + " - should be a list of strings")
+                return None
+            return frozenset(value)
+        if rule == "patterns":
+            patterns = {}
+            for patternId, pattern in value.items():
+                if patternId not in self.__patternIds:
+                    errors.append(name + "." + patternId + " - unknown pattern, should be one of " + ", ".join(self.__patternIds))
+                elif pattern is not None and not isinstance(pattern, str):
+                    errors.append(name + "." + patternId + " - should be a string or null")
+                else:
+                    patterns[patternId] = pattern
+            return MappingProxyType(patterns)
+        return value
+
     # load the settings from the settings.json file
     #  test if file exists, return if not
     #  open, return if unable
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+import os  # for the status file
+import json  # for the status file
+import time
+
+#
+# Status Handler
+#
+# Description:
+#  tell systemd and anything watching how things are going, without having to read the log
+#  a one line summary goes to systemd as STATUS= (shown by systemctl status)
+#  everything goes to a json file, in /run by default so it's not written to the sd card
+#  the file is written to a temporary file and then renamed, so it's never seen half written
+#  publish is called by main each time round its loop
+#
+# Variables:
+#  __params - dict
+#   path - str - status file, relative to root unless it starts with /
+#  __path - str - path to the status file, False if it's turned off
+#  __fileWarned - bool - true once a problem writing the file has been logged, so it's not logged every time
+#
+# Functions:
+#
+#  __init__(systemHandler, settings, logger)
+#   store things, get settings
+#
+#  loadSettings()
+#   get settings, at startup and when settings are reloaded
+#
+#  publish(status)
+#   send the status line to systemd and write the status file
+#
+#  __statusLine(status)
+#   one line summary of status, for systemd
+#
+#  __writeFile(status)
+#   write the status file
+#
+
+
+class statusHandler:
+    __params = {
+        "path": "/run/diyac/status.json"
+    }
+    __path = False
+    __fileWarned = False
+
+    def __init__(self, systemHandler, settings, logger):
+        # internalise the stuff
+        self.__systemHandler = systemHandler
+        del systemHandler
+        self.__settings = settings
+        del settings
+        self.__logger = logger
+        del logger
+
+        # get settings
+        self.loadSettings()
+        return
+
+    def loadSettings(self):
+        # they've been checked already, None if not set
+        statusConfig = self.__settings.config.status
+        if statusConfig is False:
+            self.__path = False
+            self.__logger.log("INFO", "status: status file turned off in settings")
+            return
+        params = dict(statusHandler.__params)
+        for param in params:
+            if getattr(statusConfig, param) is not None:
+                params[param] = getattr(statusConfig, param)
+        self.__params = params
+        self.__path = params["path"]
+        self.__fileWarned = False
+        self.__logger.log("DBUG", "status: status file set", {"path": self.__path})
+        return
+
+    #
+    # publish
+    #
+    def publish(self, status):
+        status = dict(status)
+        status["time"] = round(time.time(), 3)
+        self.__systemHandler.notifyUp("STATUS=" + self.__statusLine(status))
+        if self.__path is not False:
+            self.__writeFile(status)
+        return
+
+    def __statusLine(self, status):
+        line = "Running - " + str(status["tokens"]) + " tokens"
+        line += ", last minute " + str(status["allowedLastMinute"]) + " allowed " + str(status["deniedLastMinute"]) + " denied"
+        if status["lockout"] == "locked":
+            line += ", LOCKED OUT"
+        if status["decisionP95ms"] is not None:
+            line += ", p95 decision " + str(status["decisionP95ms"]) + "ms"
+        line += ", queued log " + str(status["logQueue"]) + " audit " + str(status["auditQueue"])
+        line += ", loop lag " + str(status["loopLag"]) + "s"
+        return line
+
+    def __writeFile(self, status):
+        path = self.__path
+        tmpPath = path + ".tmp"
+        try:
+            # make the directory if it's not there
+            dirName = os.path.dirname(path)
+            if dirName and not os.path.isdir(dirName):
+                os.makedirs(dirName)
+            with open(tmpPath, "w") as f:
+                json.dump(status, f)
+            os.replace(tmpPath, path)
+        except OSError as e:
+            if self.__fileWarned is False:
+                self.__logger.log("WARN", "status: unable to write status file", {"path": path, "error": e})
+                self.__fileWarned = True
+            return
+        if self.__fileWarned is True:
+            self.__logger.log("INFO", "status: status file is being written again", {"path": path})
+            self.__fileWarned = False
+        return
@@ -1,5 +1,10 @@
 #!/usr/bin/env python
 import signal  # for nice exit
+import time
+import os  # for the signal pipe
+import sys
+import threading  # for the signal dispatcher
+import faulthandler  # for dumping thread stacks when a loop stalls
 
 
 #
@@ -14,15 +19,26 @@ import signal  # for nice exit
 #    log/systemd __notify
 #    run speficied callback
 #    exit with given code
+#  signals are not dealt with in the signal handler
+#    the signal number is written to a pipe (by python's C level handler, see signal.set_wakeup_fd)
+#    and the signal dispatcher thread runs the handler, so a slow reload never holds up the main thread
 #
 # Variables:
 #  for each signal, a dict exists with callback function, exit code and runQuit
 #  __sigInt
 #  __sigTerm
 #  __sigHup
+#  __sigUsr1
 #  __quitFunc is similar to above, but does not contain runQuit
+#  __quitLock - threading.RLock - so the quit callback is only run once, even if quit is called from more than one thread
+#  __quitting - bool - true once quit has started
+#  __signalPipe - tuple - (read fd, write fd) of the signal pipe, False until the first signal is set up
+#  __signalHandlers - dict - signal number: handler, run by the dispatcher
+#  __signalStats - dict - signal name: {count, lastTime, maxTime} - how long each handler has taken
 #  __logger - obj - for the __logger
 #  __notify - obj - for the sdNotify
+#  __loops - dict - name: {deadline, last, lag} - critical loops that have to keep reporting in
+#  __stalled - bool - true while a stall has been found (so the stack dump is only done once)
 #
 # Functions:
 #
@@ -32,7 +48,7 @@ import signal  # for nice exit
 #
 #  setup(type, _callback, code, runQuit)
 #   saves settings for callback function, exit code, runQuit
-#   type must be quit, __sigInt, __sigTerm, __sigHup
+#   type must be quit, __sigInt, __sigTerm, __sigHup, __sigUsr1
 #
 #  __sigIntHandler(sig, frame)
 #   log/__notify (different if going to runQuit or not)
@@ -49,14 +65,50 @@ import signal  # for nice exit
 #   if not going to quit, __notify READY=1
 #   run quit if appropriate
 #
+#  __sigUsr1Handler(sig, frame)
+#   log, run callback - never quits
+#
+#  __installSignal(signalNumber, handler)
+#   point a signal at the signal pipe, and store the handler for the dispatcher
+#
+#  __signalNoop(sig, frame)
+#   the python level signal handler - does nothing, the pipe has already been written to
+#
+#  __signalDispatcherFunc()
+#   the signal dispatcher thread - read signal numbers from the pipe and run their handlers, timing each one
+#
+#  getSignalStats()
+#   how many times each signal has been handled, and how long the handlers took
+#
 #  quit(code, status, logLevel, logMessage, logData)
-#   run callback
+#   run callback (only once)
 #   sdNotify
 #   log (if appropriate)
-#   exit with given code
+#   exit with given code - from any thread
 #
 #  notifyUp(message)
 #   just does an sdNotify
+#
+#  registerLoop(name, deadline)
+#   add a critical loop (or worker) that must call loopAlive at least every deadline seconds
+#
+#  loopAlive(name, [lag])
+#   called by a loop each time it goes round, with how late it was if it knows
+#
+#  checkLoops()
+#   true if every registered loop has reported within its deadline
+#   if not, logs which ones and dumps the stack of every thread to stderr (once per stall)
+#   main only hits the systemd watchdog when this is true
+#
+#  getLoopStats()
+#   seconds since each loop last reported, and its last lag
+#
+#  armStackDump(timeout)
+#   dump the stack of every thread to stderr if this isn't called again within timeout
+#   for the loop that calls checkLoops - if it stalls, nothing else will notice before systemd kills us
+#
+#  disarmStackDump()
+#   cancel the stack dump, for when that loop is stopping on purpose
 
 
 class systemHandler:
@@ -77,11 +129,17 @@ class systemHandler:
         "code": 0,
         "runQuit": False
     }
+    __sigUsr1 = {
+        "callback": False
+    }
     __quitFunc = {
         "callback": False,
         "code": 0
     }
     __logger = False
+    __stalled = False
+    __quitting = False
+    __signalPipe = False
 
     #
     # init
@@ -97,6 +155,10 @@ class systemHandler:
             exit()
         # systemd notifier
         self.__notify = sdnotify.SystemdNotifier()
+        self.__loops = {}
+        self.__quitLock = threading.RLock()
+        self.__signalHandlers = {}
+        self.__signalStats = {}
         return
 
     #
@@ -111,25 +173,30 @@ class systemHandler:
             pass
         elif type == "sigInt":
             self.__logger.log("DBUG", "Setup for sigInt", {"callback": _callback, "code": code, "runQuit": runQuit})
-            signal.signal(signal.SIGINT, self.__sigIntHandler)
+            self.__installSignal(signal.SIGINT, self.__sigIntHandler)
             self.__sigInt["callback"] = _callback
             self.__sigInt["code"] = code
             self.__sigInt["runQuit"] = runQuit
             pass
         elif type == "sigTerm":
             self.__logger.log("DBUG", "Setup for sigTerm", {"callback": _callback, "code": code, "runQuit": runQuit})
-            signal.signal(signal.SIGTERM, self.__sigTermHandler)
+            self.__installSignal(signal.SIGTERM, self.__sigTermHandler)
             self.__sigTerm["callback"] = _callback
             self.__sigTerm["code"] = code
             self.__sigTerm["runQuit"] = runQuit
             pass
         elif type == "sigHup":
             self.__logger.log("DBUG", "Setup for sigHup", {"callback": _callback, "code": code, "runQuit": runQuit})
-            signal.signal(signal.SIGHUP, self.__sigHupHandler)
+            self.__installSignal(signal.SIGHUP, self.__sigHupHandler)
             self.__sigHup["callback"] = _callback
             self.__sigHup["code"] = code
             self.__sigHup["runQuit"] = runQuit
             pass
+        elif type == "sigUsr1":
+            self.__logger.log("DBUG", "Setup for sigUsr1", {"callback": _callback})
+            self.__installSignal(signal.SIGUSR1, self.__sigUsr1Handler)
+            self.__sigUsr1["callback"] = _callback
+            pass
         else:
             # default?
             self.__logger.log("WARN", "systemHandler: invalid type passed to setCallback", type)
@@ -204,11 +271,71 @@ class systemHandler:
         # done
         return
 
+    def __sigUsr1Handler(self, sig=False, frame=False):
+        self.__logger.log("NOTE", "SIGUSR1 received")
+        # callback
+        if self.__sigUsr1["callback"] is not False:
+            self.__sigUsr1["callback"]()
+        return
+
+    #
+    # signal pipe and dispatcher
+    #
+    def __installSignal(self, signalNumber, handler):
+        # the pipe and dispatcher are made with the first signal
+        if self.__signalPipe is False:
+            readFd, writeFd = os.pipe()
+            os.set_blocking(writeFd, False)
+            self.__signalPipe = (readFd, writeFd)
+            signal.set_wakeup_fd(writeFd, warn_on_full_buffer=False)
+            dispatcherThread = threading.Thread(name='signalDispatcherThread', target=self.__signalDispatcherFunc, daemon=True)
+            dispatcherThread.start()
+        self.__signalHandlers[signalNumber] = handler
+        signal.signal(signalNumber, self.__signalNoop)
+        return
+
+    def __signalNoop(self, sig, frame):
+        # set_wakeup_fd has already written the signal number to the pipe
+        return
+
+    def __signalDispatcherFunc(self):
+        while True:
+            try:
+                received = os.read(self.__signalPipe[0], 64)
+            except InterruptedError:
+                continue
+            for signalNumber in received:
+                handler = self.__signalHandlers.get(signalNumber)
+                if handler is None:
+                    continue
+                name = signal.Signals(signalNumber).name
+                handlerStart = time.monotonic()
+                try:
+                    handler(signalNumber, None)
+                except Exception as e:
+                    self.__logger.log("ERRR", "signal handler failed", {"signal": name, "error": e})
+                handlerTime = time.monotonic() - handlerStart
+                stats = self.__signalStats.setdefault(name, {"count": 0, "lastTime": 0, "maxTime": 0})
+                stats["count"] += 1
+                stats["lastTime"] = round(handlerTime, 3)
+                stats["maxTime"] = max(stats["maxTime"], stats["lastTime"])
+                self.__logger.log("DBUG", "signal handled", {"signal": name, "time": stats["lastTime"]})
+        return
+
+    def getSignalStats(self):
+        stats = {}
+        for name in list(self.__signalStats):
+            stats[name] = dict(self.__signalStats[name])
+        return stats
+
     def quit(self, code, status=False, logLevel=False, logMessage=False, logData=False):
-        # run the callback
-        if self.__quitFunc["callback"] is not False:
-            self.__quitFunc["callback"]()
-            pass
+        # run the callback - once
+        # anything else that quits while it's running waits for it to finish
+        with self.__quitLock:
+            if self.__quitting is False:
+                self.__quitting = True
+                if self.__quitFunc["callback"] is not False:
+                    self.__quitFunc["callback"]()
         # stopping to systemd
         self.__notify.notify("STOPPING=1")
         # status to systemd
@@ -234,13 +361,82 @@ class systemHandler:
                 pass
         # exit
         if code is False:
-            exit(0)
-            pass
-        else:
-            exit(code)
-            pass
+            code = 0
+        # from any other thread (like the signal dispatcher) SystemExit would only end that thread
+        # the callback has already cleaned up, so go straight out
+        if threading.current_thread() is not threading.main_thread():
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+        exit(code)
         return
 
     def notifyUp(self, message):
         self.__notify.notify(message)
         return
+
+    #
+    # loop liveness
+    # each critical loop reports in, the watchdog only gets hit if they all have
+    #
+    def registerLoop(self, name, deadline):
+        self.__loops[name] = {"deadline": deadline, "last": time.monotonic(), "lag": 0}
+        self.__logger.log("DBUG", "Loop registered for watchdog", {"loop": name, "deadline": deadline})
+        return
+
+    def loopAlive(self, name, lag=False):
+        loop = self.__loops[name]
+        loop["last"] = time.monotonic()
+        if lag is not False:
+            loop["lag"] = lag
+        return
+
+    def checkLoops(self):
+        timeNow = time.monotonic()
+        stalled = []
+        for name in list(self.__loops):
+            loop = self.__loops[name]
+            if timeNow - loop["last"] > loop["deadline"]:
+                stalled.append({"loop": name, "age": round(timeNow - loop["last"], 3), "deadline": loop["deadline"]})
+
+        # all good
+        if not stalled:
+            if self.__stalled is True:
+                self.__logger.log("WARN", "Stalled loops have recovered")
+                self.__stalled = False
+            return True
+
+        # only dump once per stall, systemd will kill us soon enough
+        if self.__stalled is False:
+            self.__stalled = True
+            self.__logger.log("ERRR", "Loop stalled - not hitting the watchdog, dumping thread stacks", stalled)
+            # faulthandler doesn't need any locks, so this works even if the stall is a deadlock
+            # stderr goes to the journal when run by systemd
+            try:
+                faulthandler.dump_traceback(all_threads=True)
+            except Exception as e:
+                self.__logger.log("WARN", "Unable to dump thread stacks", e)
+        return False
+
+    def getLoopStats(self):
+        timeNow = time.monotonic()
+        stats = {}
+        for name in list(self.__loops):
+            loop = self.__loops[name]
+            stats[name] = {"age": round(timeNow - loop["last"], 3), "lag": round(loop["lag"], 3)}
+        return stats
+
+    #
+    # the watchdog loop can't check itself
+    # faulthandler's own thread does the dump, so this works even if that loop is deadlocked
+    # each call replaces the last one, so it only goes off if the calls stop
+    def armStackDump(self, timeout):
+        try:
+            faulthandler.dump_traceback_later(timeout, repeat=False)
+        except Exception as e:
+            self.__logger.log("WARN", "Unable to arm stack dump", e)
+        return
+
+    def disarmStackDump(self):
+        faulthandler.cancel_dump_traceback_later()
+        return
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+import time
+import tempfile
+import threading
+import unittest
+
+import outputHandler
+import pinDef
+import settingsHandler
+
+#
+# Output Handler Tests
+#
+# Description:
+#  the door, without any hardware - pigpiod is a fake that records writes
+#  run from the project root: python3 test_outputHandler.py
+#
+# Classes:
+#
+#  recordingPi
+#   the bits of a pigpio connection the door uses, every write is kept with the time it happened
+#   failWrites - set of gpios that raise on write, like pigpiod going away
+#
+#  nullLogger, nullSystem
+#   nothing logged, no watchdog
+#
+#  doorTest
+#   testBurst - a burst of grants, like people swiping one after another
+#    the strike is opened once and closed once, doorOpenTime after the last grant, with no extra threads
+#   testOpenFails - openDoor returns False if the strike can't be written, and doesn't raise
+#   testReaderLedFails - the door is still open (and closes) if only the reader led can't be written
+#
+
+
+class recordingPi:
+    def __init__(self):
+        self.writes = []
+        self.failWrites = set()
+
+    def write(self, gpio, level):
+        if gpio in self.failWrites:
+            raise ConnectionError("pigpiod has gone away")
+        self.writes.append((time.monotonic(), gpio, level))
+
+    def wave_clear(self):
+        return
+
+    def wave_tx_busy(self):
+        return 0
+
+
+class nullLogger:
+    def log(self, level, message, data=None):
+        return
+
+
+class nullSystem:
+    def registerLoop(self, name, maxTime):
+        return
+
+    def loopAlive(self, name, lag=0):
+        return
+
+
+class doorTest(unittest.TestCase):
+    doorOpenTime = 0.5
+
+    def setUp(self):
+        # patterns off, so no waves are needed
+        settings = settingsHandler.settingsHandler(False, allSettings={
+            "root": tempfile.gettempdir() + "/",
+            "pinDef": {"pcbVersion": 2.1},
+            "outputHandling": {"doorOpenTime": self.doorOpenTime, "patterns": {"doorbell": None}}
+        })
+        p = pinDef.pinDef(False, settings, nullLogger())
+        self.pins = p.pins
+        self.pi = recordingPi()
+        self.outH = outputHandler.outputHandler(nullSystem(), settings, nullLogger(), self.pi, p)
+        self.writesBefore = len(self.pi.writes)
+
+    def tearDown(self):
+        self.pi.failWrites = set()
+        self.outH.shutdown(0)
+
+    def __levels(self, name):
+        return [(writeTime, level) for writeTime, gpio, level in self.pi.writes[self.writesBefore:] if gpio == self.pins[name]]
+
+    def testBurst(self, opens=10, gap=0.1):
+        threadsBefore = threading.active_count()
+        for i in range(opens):
+            self.assertTrue(self.outH.openDoor())
+            lastOpen = time.monotonic()
+            self.assertEqual(threading.active_count(), threadsBefore, "openDoor should not start threads")
+            time.sleep(gap)
+        time.sleep(self.doorOpenTime + 0.5)
+
+        strike = self.__levels("doorStrike")
+        self.assertEqual([level for writeTime, level in strike], [1, 0], "door strike should be opened once and closed once")
+        closeLate = strike[1][0] - (lastOpen + self.doorOpenTime)
+        self.assertTrue(-0.01 <= closeLate <= 0.1, "door should close doorOpenTime after the last grant, it was " + str(round(closeLate, 3)) + "s out")
+
+    def testOpenFails(self):
+        self.pi.failWrites = {self.pins["doorStrike"]}
+        self.assertFalse(self.outH.openDoor())
+        self.assertEqual(self.__levels("doorStrike"), [])
+
+    def testReaderLedFails(self):
+        self.pi.failWrites = {self.pins["readerLed"]}
+        self.assertTrue(self.outH.openDoor())
+        time.sleep(self.doorOpenTime + 0.5)
+        self.assertEqual([level for writeTime, level in self.__levels("doorStrike")], [1, 0], "the door thread should still close the strike")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import os  # useful for file operations
 import json  # for gettings settings and tokens
+import threading  # for changing the tokens file
 
 #
 # Tokens
@@ -9,7 +10,8 @@ import json  # for gettings settings and tokens
 #  basically for getting, storing and comparing tokens
 #
 # Vars:
-#  __allowedTokens - dict- list of allowed tokens - default False
+#  __allowedTokens - list - allowed tokens - default False
+#  __fileLock - threading.RLock - so only one change or load of the tokens file happens at a time
 #  __wiegandLength - int - number of bits that wiegand will read
 #
 # Functions:
@@ -22,12 +24,16 @@ import json  # for gettings settings and tokens
 #   get from __settings if the reader is 26 or 34 bit
 #
 #  getAllowedTokens()
-#   load tokens from file
-#   perform validity/sanity/other checks
-#   store tokens
+#   load tokens from file into a new list
+#   perform validity/sanity/other checks on it
+#   store tokens - the new list replaces the old one in one assignment, so checkToken never sees it half done
+#
+#  __tokensFilePath()
+#   absolute path to the tokens file, False if not set
 #
 #  __loadFromFile()
 #   load tokens in from file specified in __settings
+#   returns the list, or False if it can't be read
 #
 #  moveValueToToked()
 #   for backwards compatibility
@@ -52,12 +58,28 @@ import json  # for gettings settings and tokens
 #  checkToken(token, tokenType)
 #   return true if given token is in __allowedTokens
 #   otherwise return false
+#
+#  addToken(token, tokenType, user)
+#  revokeToken(token, tokenType)
+#   change the tokens file, and load it again
+#   returns {"changed": bool, "reason": str if not changed}
+#
+#  __sameToken(entry, token, tokenType)
+#   true if an entry from the tokens file is the given token, after formatting
+#
+#  __readTokensFile()
+#  __writeTokensFile(entries)
+#   the tokens file as it is - written to a temporary file and renamed, so it's never half written
+#
+#  tokenCount()
+#   number of allowed tokens, for status
 
 
 class tokenHandler:
     # vars
     __allowedTokens = False
     __wiegandLength = 36
+    __tokenTypes = ["card", "code"]
 
     #
     # initialisation function
@@ -71,6 +93,7 @@ class tokenHandler:
         del settings
         self.__logger = logger
         del logger
+        self.__fileLock = threading.RLock()
         self.__getWiegandLength()
         self.getAllowedTokens()
 
@@ -122,19 +145,35 @@ class tokenHandler:
             self.__logger.log("WARN", "no __settings - will not get __allowedTokens")
             return
 
-        # get the tokens from the file
-        self.__loadFromFile()
-
-        # do some actions on our new shiny list of tokens
-        self.__moveValueToToken()
-        self.__sanitiseAllowedTokens()
-        self.__formatTokens()
-        self.__transformOverlengthTokens()
-        self.__transformFor26()
-        self.__removeDuplicateTokens()
-        self.__logger.log("DBUG", "allowedTokens: loaded list of tokens", self.__allowedTokens)
+        with self.__fileLock:
+            # get the tokens from the file - a new list, checkToken keeps using the old one until it's ready
+            tokens = self.__loadFromFile()
+            if tokens is False:
+                return
+
+            # do some actions on our new shiny list of tokens
+            self.__moveValueToToken(tokens)
+            self.__sanitiseAllowedTokens(tokens)
+            self.__formatTokens(tokens)
+            self.__transformOverlengthTokens(tokens)
+            self.__transformFor26(tokens)
+            self.__removeDuplicateTokens(tokens)
+
+            # swapped in one go
+            self.__allowedTokens = tokens
+        self.__logger.log("DBUG", "allowedTokens: loaded list of tokens", tokens)
         return
 
+    def __tokensFilePath(self):
+        try:
+            path = self.__settings.allSettings["allowedTokens"]["path"]
+        except Exception as err:
+            self.__logger.log("WARN", "Allowed tokens file path not set in settings", err)
+            return False
+        if path[0] != "/":
+            path = self.__settings.allSettings["root"] + path
+        return path
+
     def __loadFromFile(self):
         # set file path
         #
@@ -152,16 +191,10 @@ class tokenHandler:
         # check file path exists
         # if relative, make absolute
         # open / read / decode / close
-        try:
-            self.__settings.allSettings["allowedTokens"]["path"]
-        except Exception as err:
-            self.__logger.log("WARN", "Allowed tokens file path not set in settings", err)
-            return
-
-        if self.__settings.allSettings["allowedTokens"]["path"][0] != "/":
-            allowedTokensFilePath = self.__settings.allSettings["root"] + self.__settings.allSettings["allowedTokens"]["path"]
-        else:
-            allowedTokensFilePath = self.__settings.allSettings["allowedTokens"]["path"]
+        allowedTokensFilePath = self.__tokensFilePath()
+        if allowedTokensFilePath is False:
+            return False
+        tokens = False
 
         # open / read / decode / close
         if os.path.exists(allowedTokensFilePath):
@@ -172,11 +205,11 @@ class tokenHandler:
                 self.__logger.log("WARN", "os error while opening allowedTokensFile", err)
             except Exception as err:
                 self.__logger.log("WARN", "unknown error while opening allowedTokensFile", err)
-                return
+                return False
 
             # read + decode
             try:
-                self.__allowedTokens = json.load(allowedTokensFile)
+                tokens = json.load(allowedTokensFile)
             except ValueError as err:
                 self.__logger.log("WARN", "JSON Decode error while reading allowedTokensFile", err)
             except Exception as err:
@@ -191,7 +224,8 @@ class tokenHandler:
                 self.__logger.log("WARN", "unknown error while closing allowedTokensFile", err)
         else:
             self.__logger.log("WARN", "allowedTokensFile does not exist")
-            return
+            return False
+        return tokens
 
     #
     # key change
@@ -199,13 +233,13 @@ class tokenHandler:
     #  don't worry, it's a music joke
     # move all keys of "value" to "token"
     # backwards compatibility
-    def __moveValueToToken(self):
+    def __moveValueToToken(self, tokens):
         # sanity
-        if self.__allowedTokens is False:
+        if tokens is False:
             return
 
         # iterate
-        for i in self.__allowedTokens:
+        for i in tokens:
             # if value exists, copy to token and then delete
             if "value" in i:
                 i["token"] = i["value"]
@@ -220,16 +254,16 @@ class tokenHandler:
     #  remove from __allowedTokens if no type set
     #  add empty user string if user not set
     #
-    def __sanitiseAllowedTokens(self):
+    def __sanitiseAllowedTokens(self, tokens):
         # sanity
-        if self.__allowedTokens is False:
+        if tokens is False:
             return
 
         indexesToDelete = []
 
         # check for no or invalid token
         counter = 0
-        for i in self.__allowedTokens:
+        for i in tokens:
             # if token not set
             if "token" not in i:
                 indexesToDelete.append(counter)
@@ -247,10 +281,10 @@ class tokenHandler:
         else:
             indexesToDelete.sort(reverse=True)  # have to sort and do from the highest index first
             for ind in indexesToDelete:
-                del self.__allowedTokens[ind]
+                del tokens[ind]
 
         # user cleaning
-        for i in self.__allowedTokens:
+        for i in tokens:
             if "user" not in i:
                 i["user"] = "USER NOT GIVEN"
                 self.__logger.log("WARN", "allowedTokens - user not set", i)
@@ -262,11 +296,11 @@ class tokenHandler:
     # format token values
     #  remove ":"
     #  make uppercase
-    def __formatTokens(self):
-        if self.__allowedTokens is False:
+    def __formatTokens(self, tokens):
+        if tokens is False:
             return
         # remove ":" and make uppercase
-        for tkn in self.__allowedTokens:
+        for tkn in tokens:
             # check token is there
             if "token" not in tkn:
                 continue
@@ -278,11 +312,11 @@ class tokenHandler:
     #
     # for mifare ultralight and other tokens that are more than 4 bytes long
     #
-    def __transformOverlengthTokens(self):
-        if self.__allowedTokens is False:
+    def __transformOverlengthTokens(self, tokens):
+        if tokens is False:
             return
         # Perform transform for mifare ultralight
-        for tkn in self.__allowedTokens:
+        for tkn in tokens:
             # check token is there
             if "token" not in tkn:
                 continue
@@ -297,7 +331,7 @@ class tokenHandler:
     #
     # remove duplicate tokens
     #  because having duplicates would be bad
-    def __removeDuplicateTokens(self):
+    def __removeDuplicateTokens(self, tokens):
         #  i and j are both index counters
         #  iterate allowed tokens
         #   iterate again to compare
@@ -309,7 +343,7 @@ class tokenHandler:
         #    delete the duplicates
 
         # die if nothing there
-        if self.__allowedTokens is False:
+        if tokens is False:
             return
 
         # initialise
@@ -317,21 +351,21 @@ class tokenHandler:
 
         # main iterate
         i = 0
-        for original in self.__allowedTokens:
+        for original in tokens:
             # second iterate
             j = 0
-            for check in self.__allowedTokens:
+            for check in tokens:
                 # check token is there
                 if "token" not in original or "token" not in check:
                     continue
                 # if tokens match, types match, it's not the same entry, and not listed in duplicate indexes
                 if original["token"] == check["token"] and original["type"] == check["type"] and i != j and i not in duplicateIndexes:
                     # log - it only takes 3 lines because it wou;'dnt nicely fit on one
-                    logData = {"token": self.__allowedTokens[j]["token"], "type": self.__allowedTokens[j]["type"], "user": self.__allowedTokens[j]["user"]}
+                    logData = {"token": tokens[j]["token"], "type": tokens[j]["type"], "user": tokens[j]["user"]}
                     self.__logger.log("WARN", "allowedTokens - duplicate token found", logData)
                     del logData
                     # append duplicate username to original username
-                    self.__allowedTokens[i]["user"] += " DOR " + self.__allowedTokens[j]["user"]
+                    tokens[i]["user"] += " DOR " + tokens[j]["user"]
                     # add to list of duplicates
                     duplicateIndexes.append(j)
 
@@ -344,14 +378,14 @@ class tokenHandler:
         else:
             duplicateIndexes.sort(reverse=True)  # have to sort and do from the highest index first
             for dup in duplicateIndexes:
-                del self.__allowedTokens[dup]
+                del tokens[dup]
 
         # done
         return
 
-    def __transformFor26(self):
+    def __transformFor26(self, tokens):
         # make sure we've got tokens to act on
-        if self.__allowedTokens is False:
+        if tokens is False:
             return
 
         # make sure we need to do this in the first place
@@ -360,7 +394,7 @@ class tokenHandler:
 
         # iterate
         # if type is card and length is the length we want
-        for t in self.__allowedTokens:
+        for t in tokens:
             if t["type"] == "card" and len(t["token"]) == 8:
                 t["token"] = t["token"][0:6]
                 pass
@@ -384,3 +418,87 @@ class tokenHandler:
                     return {"allow": True, "user": t["user"]}
         # all done
         return {"allow": False}
+
+    #
+    # change the tokens file
+    # the file is what's changed, so a change is kept over a restart, and a reload doesn't undo it
+    #
+    def addToken(self, token, tokenType, user):
+        if not isinstance(token, str) or token.replace(":", "") == "":
+            return {"changed": False, "reason": "token should be a string"}
+        if tokenType not in self.__tokenTypes:
+            return {"changed": False, "reason": "type should be one of " + ", ".join(self.__tokenTypes)}
+        if not isinstance(user, str) or user == "":
+            return {"changed": False, "reason": "user should be a string"}
+        with self.__fileLock:
+            entries = self.__readTokensFile()
+            if entries is False:
+                return {"changed": False, "reason": "unable to read tokens file"}
+            for entry in entries:
+                if self.__sameToken(entry, token, tokenType):
+                    return {"changed": False, "reason": "token already allowed"}
+            entries.append({"token": token, "type": tokenType, "user": user})
+            if self.__writeTokensFile(entries) is False:
+                return {"changed": False, "reason": "unable to write tokens file"}
+            self.getAllowedTokens()
+        self.__logger.log("NOTE", "allowedTokens: token added", {"token": token, "type": tokenType, "user": user})
+        return {"changed": True}
+
+    def revokeToken(self, token, tokenType):
+        if not isinstance(token, str) or tokenType not in self.__tokenTypes:
+            return {"changed": False, "reason": "token and type should be given"}
+        with self.__fileLock:
+            entries = self.__readTokensFile()
+            if entries is False:
+                return {"changed": False, "reason": "unable to read tokens file"}
+            keep = [entry for entry in entries if not self.__sameToken(entry, token, tokenType)]
+            if len(keep) == len(entries):
+                return {"changed": False, "reason": "token not found"}
+            if self.__writeTokensFile(keep) is False:
+                return {"changed": False, "reason": "unable to write tokens file"}
+            self.getAllowedTokens()
+        self.__logger.log("NOTE", "allowedTokens: token revoked", {"token": token, "type": tokenType})
+        return {"changed": True}
+
+    # same as the formatting done on load - no ":", and upper case
+    def __sameToken(self, entry, token, tokenType):
+        if not isinstance(entry, dict) or entry.get("type") != tokenType:
+            return False
+        entryToken = entry.get("token", entry.get("value"))
+        if not isinstance(entryToken, str):
+            return False
+        return entryToken.replace(":", "").upper() == token.replace(":", "").upper()
+
+    def __readTokensFile(self):
+        path = self.__tokensFilePath()
+        if path is False:
+            return False
+        if not os.path.exists(path):
+            return []
+        try:
+            with open(path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as err:
+            self.__logger.log("WARN", "unable to read allowedTokensFile", err)
+            return False
+        if not isinstance(entries, list):
+            return False
+        return entries
+
+    def __writeTokensFile(self, entries):
+        path = self.__tokensFilePath()
+        if path is False:
+            return False
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(entries, f, indent=4)
+            os.replace(path + ".tmp", path)
+        except OSError as err:
+            self.__logger.log("WARN", "unable to write allowedTokensFile", err)
+            return False
+        return True
+
+    def tokenCount(self):
+        if self.__allowedTokens is False:
+            return 0
+        return len(self.__allowedTokens)